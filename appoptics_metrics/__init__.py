@@ -4,15 +4,22 @@ import platform
 import time
 import logging
 import os
-from six.moves import http_client
 from six.moves import map
 from six import string_types
 import urllib
 import base64
-import json
+import zlib
 import email.message
 from appoptics_metrics import exceptions
-from appoptics_metrics.queue import Queue
+from appoptics_metrics.pool import ConnectionPool
+from appoptics_metrics.transport import Transport, HTTPClientTransport
+from appoptics_metrics.codec import JSONCodec, default_codec
+from appoptics_metrics.tracing import Trace, Tracer, LoggingTracer
+from appoptics_metrics.retry import RetryPolicy, NO_RETRY, parse_retry_after
+from appoptics_metrics.circuit import CircuitBreaker
+from appoptics_metrics.pagination import Paginator
+from appoptics_metrics.jsonstream import ItemStream
+from appoptics_metrics.queue import Queue, BackgroundQueue, SubmitReport, ThreadSafeQueue
 from appoptics_metrics.metrics import Gauge, Metric
 from appoptics_metrics.alerts import Alert, Service
 from appoptics_metrics.annotations import Annotation
@@ -24,13 +31,17 @@ __version__ = "5.1.0"
 HOSTNAME = "api.appoptics.com"
 BASE_PATH = "/v1/"
 DEFAULT_TIMEOUT = 10
+# Keep-alive: how long an idle socket is kept around and how many requests it may serve
+DEFAULT_KEEPALIVE_IDLE_TIMEOUT = 30
+DEFAULT_KEEPALIVE_MAX_REQUESTS = 1000
+# Max number of sockets per host shared by the threads using a connection
+DEFAULT_POOL_MAXSIZE = 10
+# Request compression: zlib level and smallest body (in bytes) worth compressing
+DEFAULT_GZIP_LEVEL = 6
+DEFAULT_GZIP_MIN_SIZE = 1024
 
 log = logging.getLogger("appoptics-metrics")
 
-# Alias HTTPSConnection so the tests can mock it out.
-HTTPSConnection = http_client.HTTPSConnection
-HTTPConnection = http_client.HTTPConnection
-
 # Alias urlencode, it moved between py2 and py3.
 try:
     urlencode = urllib.parse.urlencode  # py3
@@ -60,12 +71,35 @@ class AppOpticsConnection(object):
     """
 
     def __init__(self, api_key, hostname=HOSTNAME, base_path=BASE_PATH, sanitizer=sanitize_no_op,
-                 protocol="https", tags=None):
+                 protocol="https", tags=None, keepalive_idle_timeout=DEFAULT_KEEPALIVE_IDLE_TIMEOUT,
+                 keepalive_max_requests=DEFAULT_KEEPALIVE_MAX_REQUESTS, pool=None,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE, pool_block=True, pool_timeout=None, gzip=False,
+                 gzip_level=DEFAULT_GZIP_LEVEL, gzip_min_size=DEFAULT_GZIP_MIN_SIZE, retry_policy=None,
+                 circuit_breaker=None, transport=None, codec=None):
         """Create a new connection to AppOptics Metrics.
         Doesn't actually connect yet or validate until you make a request.
 
         :param api_key: The API Key (token) to use to authenticate
         :type api_key: str
+        :param keepalive_idle_timeout: Seconds an idle socket is kept open for reuse
+        :param keepalive_max_requests: Requests served by one socket before it is recycled
+        :param pool: A ConnectionPool to share with other connections (the
+                     pool_* and keepalive_* arguments are ignored then)
+        :param pool_maxsize: Max number of sockets per host
+        :param pool_block: Wait for a free socket when the pool is exhausted
+                           (instead of raising PoolTimeout right away)
+        :param pool_timeout: Max seconds to wait for a free socket (None: forever)
+        :param gzip: Send POST/PUT bodies with Content-Encoding: gzip and ask
+                     for compressed responses
+        :param gzip_level: zlib compression level (1-9)
+        :param gzip_min_size: Bodies smaller than this many bytes are sent as is
+        :param retry_policy: RetryPolicy for failed requests (default: RetryPolicy())
+        :param circuit_breaker: CircuitBreaker making requests fail fast with
+                                CircuitOpenError while the API is failing
+        :param transport: transport.Transport sending the requests (default:
+                          HTTPClientTransport over the pool)
+        :param codec: codec.Codec encoding and decoding the JSON bodies
+                      (default: orjson or ujson if installed, else json)
         """
         tags = tags or {}
         try:
@@ -80,13 +114,24 @@ class AppOpticsConnection(object):
         self.protocol = protocol
         self.hostname = hostname
         self.base_path = base_path
-        # these two attributes ared used to control fake server errors when doing
-        # unit testing.
-        self.fake_n_errors = 0
-        self.backoff_logic = lambda backoff: backoff * 2
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker
         self.sanitize = sanitizer
         self.timeout = DEFAULT_TIMEOUT
         self.tags = dict(tags)
+        if transport is None:
+            if pool is None:
+                pool = ConnectionPool(maxsize=pool_maxsize, block=pool_block, timeout=pool_timeout,
+                                      idle_timeout=keepalive_idle_timeout, max_requests=keepalive_max_requests)
+            transport = HTTPClientTransport(pool)
+        self.transport = transport
+        # The pool of the default transport, None for other transports
+        self.pool = getattr(transport, 'pool', None)
+        self.gzip = gzip
+        self.gzip_level = gzip_level
+        self.gzip_min_size = gzip_min_size
+        self.codec = codec or default_codec()
+        self.tracers = []
 
     def _compute_ua(self):
         if self.custom_ua:
@@ -116,6 +161,8 @@ class AppOpticsConnection(object):
             headers = {}
         headers['Authorization'] = b"Basic " + base64.b64encode(self.api_key + b":").strip()
         headers['User-Agent'] = self._compute_ua()
+        if self.gzip:
+            headers['Accept-Encoding'] = "gzip"
         return headers
 
     def _url_encode_params(self, params=None):
@@ -130,45 +177,37 @@ class AppOpticsConnection(object):
                 params_list.append((k, v))
         return urlencode(params_list)
 
-    def _make_request(self, conn, path, headers, query_props, method):
-        """ Perform the an https request to the server """
+    def _prepare_request(self, path, headers, query_props, method):
+        """ Build the uri and body of a request, adding the needed headers """
         uri = self.base_path + path
         body = None
         if query_props:
             if method == "POST" or method == "DELETE" or method == "PUT":
-                body = json.dumps(query_props)
+                body = self.codec.dumps(query_props)
                 headers['Content-Type'] = "application/json"
+                if self.gzip and method in ("POST", "PUT") and len(body) >= self.gzip_min_size:
+                    body = _gzip_compress(body, self.gzip_level)
+                    headers['Content-Encoding'] = "gzip"
             else:
                 uri += "?" + self._url_encode_params(query_props)
-        log.info("method=%s uri=%s" % (method, uri))
-        if body is None:
-            log.info("body(->): %s" % body)
-        else:
-            log.info("body(->): %s" % json.dumps(json.loads(body), indent=4, sort_keys=True))
-
-        conn.request(method, uri, body=body, headers=headers)
-
-        return conn.getresponse()
-
-    def _process_response(self, resp, backoff):
-        """ Process the response from the server """
-        success = True
-        resp_data = None
-        log.info("status code(<-): %s" % resp.status)
-
-        not_a_server_error = resp.status < 500
+        return uri, body
 
-        if not_a_server_error:
-            resp_data = _decode_body(resp)
-            a_client_error = resp.status >= 400
-            if a_client_error:
-                raise exceptions.get(resp.status, resp_data)
-            return resp_data, success, backoff
-        else:  # A server error, wait and retry
-            backoff = self.backoff_logic(backoff)
-            log.info("%s: waiting %s before re-trying" % (resp.status, backoff))
-            time.sleep(backoff)
-            return None, not success, backoff
+    def _process_response(self, resp, trace=None):
+        """ Process the response from the server, raising APIError on 4xx/5xx """
+        try:
+            resp_data = _decode_body(resp, trace, self.codec)
+        except ValueError:
+            if resp.status < 500:
+                raise
+            # e.g. an HTML error page from a proxy
+            resp_data = None
+        if trace is not None:
+            self._end_trace(trace, resp.status)
+        if resp.status >= 400:
+            error = exceptions.get(resp.status, resp_data)
+            error.retry_after = parse_retry_after(resp.getheader('retry-after'))
+            raise error
+        return resp_data
 
     def _parse_tags_params(self, tags):
         result = {}
@@ -176,35 +215,104 @@ class AppOpticsConnection(object):
             result["tags[%s]" % k] = v
         return result
 
-    def _mexe(self, path, method="GET", query_props=None, p_headers=None):
+    def _mexe(self, path, method="GET", query_props=None, p_headers=None, retry_policy=None):
         """Internal method for executing a command.
-           If we get server errors we exponentially wait before retrying
+           The request is sent by self.transport; failed attempts are retried
+           as decided by retry_policy (or self.retry_policy).
         """
-        conn = self._setup_connection()
         headers = self._set_headers(p_headers)
-        success = False
-        backoff = 1
-        resp_data = None
-        while not success:
-            resp = self._make_request(conn, path, headers, query_props, method)
+        uri, body = self._prepare_request(path, headers, query_props, method)
+        return self._send(method, uri, body, headers, retry_policy, self._process_response)
+
+    def _stream(self, path, key, subkey=None, query_props=None, retry_policy=None):
+        """Internal method for a GET whose response is decoded as it arrives.
+           Returns a jsonstream.ItemStream over the items of `key` (see there
+           for subkey). Only sending the request and getting an error status
+           are retried, not failures while reading the body.
+        """
+        def open_stream(resp, trace):
+            if resp.status >= 400:
+                # Reads the error body and raises
+                self._process_response(resp, trace)
+            if trace is not None:
+                self._end_trace(trace, resp.status)
+            gzipped = (resp.getheader('content-encoding') or '').lower() == 'gzip'
+            return ItemStream(resp.iter_chunks(), key, subkey, encoding=_getcharset(resp), gzipped=gzipped,
+                              close=resp.close)
+
+        headers = self._set_headers(None)
+        uri, body = self._prepare_request(path, headers, query_props, "GET")
+        return self._send("GET", uri, body, headers, retry_policy, open_stream, stream=True)
+
+    def _send(self, method, uri, body, headers, retry_policy, handle_response, stream=False):
+        """Send a request until handle_response(resp, trace) returns without
+           raising or the retry policy gives up.
+        """
+        url = "%s://%s%s" % (self.protocol, self.hostname, uri)
+        send = self.transport.stream if stream else self.transport.request
+        retry = (retry_policy or self.retry_policy).start()
+        breaker = self.circuit_breaker
+        while True:
+            if breaker is not None:
+                breaker.check()
+            trace = self._start_trace(method, uri, body) if self.tracers else None
             try:
-                resp_data, success, backoff = self._process_response(resp, backoff)
-            except http_client.ResponseNotReady:
-                conn.close()
-                conn = self._setup_connection()
-        conn.close()
-        return resp_data
+                resp = send(method, url, body=body, headers=headers, timeout=self.timeout)
+                result = handle_response(resp, trace)
+            except Exception as e:
+                if trace is not None and trace.elapsed is None:
+                    self._end_trace(trace, error=e)
+                if breaker is not None:
+                    breaker.record(e)
+                delay = retry.next_delay(e)
+                if delay is None:
+                    raise
+                log.info("%s: waiting %.2fs before re-trying", e, delay)
+                time.sleep(delay)
+                continue
+            if breaker is not None:
+                breaker.record_success()
+            return result
+
+    def with_retry_policy(self, retry_policy):
+        """
+        Return a copy of this connection (sharing its pool, tags and tracers)
+        using another retry policy, e.g. for a single call:
+        api.with_retry_policy(NO_RETRY).list_metrics()
+        """
+        conn = object.__new__(self.__class__)
+        conn.__dict__.update(self.__dict__)
+        conn.retry_policy = retry_policy
+        return conn
 
-    def _do_we_want_to_fake_server_errors(self):
-        return self.fake_n_errors > 0
+    #
+    # Tracing
+    #
+    def add_tracer(self, tracer):
+        """
+        Subscribe a tracing.Tracer to the start and end of every request
+        :param tracer:
+        :return:
+        """
+        self.tracers.append(tracer)
 
-    def _setup_connection(self):
-        connection_class = HTTPSConnection if self.protocol == "https" else HTTPConnection
+    def remove_tracer(self, tracer):
+        self.tracers.remove(tracer)
 
-        if self._do_we_want_to_fake_server_errors():
-            return connection_class(self.hostname, fake_n_errors=self.fake_n_errors)
-        else:
-            return connection_class(self.hostname, timeout=self.timeout)
+    def _start_trace(self, method, uri, body):
+        trace = Trace(method, uri, body)
+        for tracer in self.tracers:
+            tracer.request_start(trace)
+        return trace
+
+    def _end_trace(self, trace, status=None, error=None):
+        trace.finish(status, error)
+        for tracer in self.tracers:
+            tracer.request_end(trace)
+
+    def close(self):
+        """Close the idle sockets kept by the transport"""
+        self.transport.close()
 
     def _parse(self, resp, name, cls):
         """Parse to an object"""
@@ -238,25 +346,13 @@ class AppOpticsConnection(object):
 
     def _get_paginated_results(self, entity, klass, **query_props):
         """
-        Return all items for a "list" request
+        Return a pagination.Paginator over all items for a "list" request
         :param entity:
         :param klass:
         :param query_props:
         :return:
         """
-        resp = self._mexe(entity, query_props=query_props)
-
-        results = self._parse(resp, entity, klass)
-        for result in results:
-            yield result
-
-        length = resp.get('query', {}).get('length', 0)
-        offset = query_props.get('offset', 0) + length
-        total = resp.get('query', {}).get('total', length)
-        if offset < total and length > 0:
-            query_props.update({'offset': offset})
-            for result in self._get_paginated_results(entity, klass, **query_props):
-                yield result
+        return Paginator(self, entity, klass, **query_props)
 
     #
     # Metrics
@@ -289,9 +385,10 @@ class AppOpticsConnection(object):
             raise Exception('At least one tag is needed.')
 
     def submit_tagged(self, name, value, **query_props):
+        retry_policy = query_props.pop('retry_policy', None)
         payload = {'measurements': []}
         payload['measurements'].append(self.create_tagged_payload(name, value, **query_props))
-        self._mexe("measurements", method="POST", query_props=payload)
+        self._mexe("measurements", method="POST", query_props=payload, retry_policy=retry_policy)
 
     def create_tagged_payload(self, name, value, **query_props):
         """Create the measurement for forwarding to AppOptics"""
@@ -349,6 +446,24 @@ class AppOpticsConnection(object):
         :param query_props:
         :return:
         """
+        self._check_tagged_query_props(query_props)
+        return self._mexe("measurements/%s" % self.sanitize(name), method="GET", query_props=query_props)
+
+    def stream_tagged(self, name, **query_props):
+        """
+        Like get_tagged, but the response is decoded as it is received:
+        iterating the returned jsonstream.ItemStream yields a
+        (series, measurement) pair per point, where series holds the tags of
+        the series. The other keys of the response are in .meta afterwards.
+        :param name:
+        :param query_props:
+        :return:
+        """
+        self._check_tagged_query_props(query_props)
+        return self._stream("measurements/%s" % self.sanitize(name), 'series', subkey='measurements',
+                            query_props=query_props)
+
+    def _check_tagged_query_props(self, query_props):
         if 'resolution' not in query_props:
             # Default to raw resolution
             query_props['resolution'] = 1
@@ -361,8 +476,6 @@ class AppOpticsConnection(object):
             parsed_tags = self._parse_tags_params(query_props.pop('tags'))
             query_props.update(parsed_tags)
 
-        return self._mexe("measurements/%s" % self.sanitize(name), method="GET", query_props=query_props)
-
     def get_composite(self, compose, **query_props):
         if self.get_tags():
             return self.get_composite_tagged(compose, **query_props)
@@ -635,7 +748,17 @@ class AppOpticsConnection(object):
     #
     # Queue
     #
-    def new_queue(self, **kwargs):
+    def new_queue(self, background=False, thread_safe=False, **kwargs):
+        """
+        :param background: return a BackgroundQueue, posting the measurements
+                           from a sender thread
+        :param thread_safe: return a ThreadSafeQueue, which threads can add()
+                            to concurrently (a BackgroundQueue already is)
+        """
+        if background:
+            return BackgroundQueue(self, **kwargs)
+        if thread_safe:
+            return ThreadSafeQueue(self, **kwargs)
         return Queue(self, **kwargs)
 
     #
@@ -646,35 +769,40 @@ class AppOpticsConnection(object):
 
 
 def connect(api_key=None, hostname=HOSTNAME, base_path=BASE_PATH, sanitizer=sanitize_no_op,
-            protocol="https", tags=None):
+            protocol="https", tags=None, **kwargs):
     """
     Connect to AppOptics Metrics
+    Extra keyword arguments are passed through to AppOpticsConnection.
     """
     api_key = api_key if api_key else os.getenv('APPOPTICS_TOKEN', '')
 
-    return AppOpticsConnection(api_key, hostname, base_path, sanitizer=sanitizer, protocol=protocol, tags=tags)
+    return AppOpticsConnection(api_key, hostname, base_path, sanitizer=sanitizer, protocol=protocol, tags=tags,
+                               **kwargs)
 
 
-def _decode_body(resp):
+def _decode_body(resp, trace=None, codec=None):
     """
     Read and decode HTTPResponse body based on charset and content-type
     """
     body = resp.read()
-    # if body is None:
-    log.info("body(<-): %s" % body)
-    # else:
-    #     log.info("body(<-): %s" % json.dumps(json.loads(body), indent=4, sort_keys=True))
+    if trace is not None:
+        trace.response_body = body
 
     if not body:
         return None
 
-    decoded_body = body.decode(_getcharset(resp))
+    if (resp.getheader('content-encoding') or '').lower() == 'gzip':
+        body = _gzip_decompress(body)
+
+    charset = _getcharset(resp)
     content_type = _get_content_type(resp)
 
     if content_type == "application/json":
-        resp_data = json.loads(decoded_body)
+        if charset.lower().replace('-', '') != 'utf8':
+            body = body.decode(charset)
+        resp_data = (codec or JSONCodec()).loads(body)
     else:
-        resp_data = decoded_body
+        resp_data = body.decode(charset)
 
     return resp_data
 
@@ -700,3 +828,18 @@ def _get_content_type(resp):
     """
     parts = resp.getheader('content-type', "application/json").split(";")
     return parts[0]
+
+
+def _gzip_compress(data, level=DEFAULT_GZIP_LEVEL):
+    """
+    Compress bytes into the gzip format (works on py2 and py3)
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _gzip_decompress(data):
+    """
+    Decompress a gzip'ed response body
+    """
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
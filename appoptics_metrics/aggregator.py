@@ -1,10 +1,29 @@
 import time
+from appoptics_metrics import exceptions
+from appoptics_metrics.queue import ON_CIRCUIT_OPEN_RAISE, ON_CIRCUIT_OPEN_BUFFER
+from appoptics_metrics.sketch import DDSketch, DEFAULT_RELATIVE_ACCURACY
+
+# Name of the gauge of a percentile, e.g. latency.p99
+PERCENTILE_NAME = '%s.p%g'
 
 class Aggregator(object):
     """ Implements client-side *gauge* aggregation to reduce the number of measurements
     submitted.
     Specify a period (default: None) and the aggregator will automatically
     floor the measure_times to that interval.
+
+    add_tagged(name, value, tags) keeps a series per name and tag set, all
+    posted in one request by submit().
+
+    With percentiles (e.g. [50, 95, 99]), the values of each series are
+    also recorded in a DDSketch (within relative_accuracy, in fixed memory),
+    and a gauge per percentile (name.p95...) is sent with the series.
+    merge() adds the series and sketches of another aggregator.
+
+    on_circuit_open (default: 'raise') decides what submit() does when the
+    connection's circuit breaker is open: 'raise' the CircuitOpenError, keep
+    aggregating into the unsent measurements ('buffer'), or a callable that
+    receives the list of unsent payloads (the aggregator is then cleared).
     """
 
     def __init__(self, connection, **args):
@@ -17,6 +36,12 @@ class Aggregator(object):
         self.tagged_measurements = {}
         self.period = args.get('period')
         self.measure_time = args.get('time')
+        self.on_circuit_open = args.get('on_circuit_open', ON_CIRCUIT_OPEN_RAISE)
+        self.percentiles = args.get('percentiles')
+        self.relative_accuracy = args.get('relative_accuracy', DEFAULT_RELATIVE_ACCURACY)
+        # Keys of measurements and tagged_measurements -> DDSketch
+        self.sketches = {}
+        self.tagged_sketches = {}
 
     # Get a shallow copy of the top-level tag set
     def get_tags(self):
@@ -46,28 +71,89 @@ class Aggregator(object):
                 m['min'] = value
             if value > m['max']:
                 m['max'] = value
+        if self.percentiles:
+            self._record(self.sketches, name, value)
 
         return self.measurements
 
-    def add_tagged(self, name, value):
-        if name not in self.tagged_measurements:
-            self.tagged_measurements[name] = {
+    def add_tagged(self, name, value, tags=None):
+        """
+        With tags, measurements are aggregated per series: the name and the
+        tags (added to the aggregator's), e.g. one per endpoint and status
+        """
+        if tags:
+            key = (name, frozenset(tags.items()))
+        else:
+            key = name
+        if key not in self.tagged_measurements:
+            m = self.tagged_measurements[key] = {
                 'count': 1,
                 'sum': value,
                 'min': value,
                 'max': value
             }
+            if tags:
+                m['name'] = name
+                m['tags'] = dict(tags)
         else:
-            m = self.tagged_measurements[name]
+            m = self.tagged_measurements[key]
             m['sum'] += value
             m['count'] += 1
             if value < m['min']:
                 m['min'] = value
             if value > m['max']:
                 m['max'] = value
+        if self.percentiles:
+            self._record(self.tagged_sketches, key, value)
 
         return self.tagged_measurements
 
+    def merge(self, other):
+        """Add the series and sketches of another aggregator, e.g. of another
+        thread; the sketches only if this one has percentiles
+        """
+        for mine, theirs in ((self.measurements, other.measurements),
+                             (self.tagged_measurements, other.tagged_measurements)):
+            for key, m in theirs.items():
+                s = mine.get(key)
+                if s is None:
+                    mine[key] = dict(m)
+                    continue
+                s['sum'] += m['sum']
+                s['count'] += m['count']
+                s['min'] = min(s['min'], m['min'])
+                s['max'] = max(s['max'], m['max'])
+        if not self.percentiles:
+            # Not reported by this aggregator
+            return
+        for mine, theirs in ((self.sketches, other.sketches), (self.tagged_sketches, other.tagged_sketches)):
+            for key, sketch in theirs.items():
+                if key in mine:
+                    mine[key].merge(sketch)
+                else:
+                    mine[key] = sketch.copy()
+
+    def percentile_measurements(self, tagged=True):
+        """The percentile gauges of the (tagged) series, with the tags of each"""
+        series, sketches = (self.tagged_measurements, self.tagged_sketches) if tagged else \
+            (self.measurements, self.sketches)
+        result = []
+        for key, sketch in sketches.items():
+            m = series.get(key, {})
+            name = m.get('name', key)
+            for p, v in zip(self.percentiles, sketch.quantiles([p / 100.0 for p in self.percentiles])):
+                nm = {'name': PERCENTILE_NAME % (name, p), 'sum': v, 'count': 1}
+                if 'tags' in m:
+                    nm['tags'] = dict(m['tags'])
+                result.append(nm)
+        return result
+
+    def _record(self, sketches, key, value):
+        sketch = sketches.get(key)
+        if sketch is None:
+            sketch = sketches[key] = DDSketch(self.relative_accuracy)
+        sketch.add(value)
+
     def to_payload(self):
         # Map measurements into AppOptics POST (array) format
         # {
@@ -87,6 +173,7 @@ class Aggregator(object):
             vals = dict(self.measurements[metric_name])
             vals["name"] = metric_name
             body.append(vals)
+        body.extend(self.percentile_measurements(tagged=False))
 
         result = {'measurements': body}
         if self.source:
@@ -109,15 +196,29 @@ class Aggregator(object):
         # }
 
         body = []
-        for metric_name in self.tagged_measurements:
+        for key in self.tagged_measurements:
             # Create a clone so we don't change self.tagged_measurements
-            vals = dict(self.tagged_measurements[metric_name])
-            vals["name"] = metric_name
+            vals = dict(self.tagged_measurements[key])
+            # Series added with tags know their name
+            vals.setdefault("name", key)
             body.append(vals)
+        body.extend(self.percentile_measurements())
 
         result = {'measurements': body}
-        if self.tags:
-            result['tags'] = self.tags
+        series_tags = [dict(self.tags, **vals.get('tags', {})) for vals in body]
+        if all(tags == series_tags[0] for tags in series_tags):
+            # The same tag set for every series is sent once at the top
+            # level, like Queue's hoisted(): the API only applies top-level
+            # tags to measurements without tags of their own
+            shared = series_tags[0] if series_tags else self.tags
+            for vals in body:
+                vals.pop('tags', None)
+            if shared:
+                result['tags'] = shared
+        else:
+            for vals, tags in zip(body, series_tags):
+                if tags:
+                    vals['tags'] = tags
 
         mt = self.floor_measure_time()
         if mt:
@@ -154,18 +255,122 @@ class Aggregator(object):
     def clear(self):
         self.measurements = {}
         self.tagged_measurements = {}
+        self.sketches = {}
+        self.tagged_sketches = {}
         self.measure_time = None
 
-    def submit(self):
+    def submit(self, retry_policy=None):
         # Submit any legacy or tagged measurements to API
         # This will actually return an empty 200 response (no body)
-        if self.measurements:
-            self.connection._mexe("measurements",
-                                  method="POST",
-                                  query_props=self.to_payload())
-        if self.tagged_measurements:
-            self.connection._mexe("measurements",
-                                  method="POST",
-                                  query_props=self.to_md_payload())
+        # retry_policy overrides the connection's one for these requests
+        try:
+            if self.measurements:
+                self.connection._mexe("measurements",
+                                      method="POST",
+                                      query_props=self.to_payload(),
+                                      retry_policy=retry_policy)
+                self.measurements = {}
+                self.sketches = {}
+            if self.tagged_measurements:
+                self.connection._mexe("measurements",
+                                      method="POST",
+                                      query_props=self.to_md_payload(),
+                                      retry_policy=retry_policy)
+        except exceptions.CircuitOpenError:
+            if self.on_circuit_open == ON_CIRCUIT_OPEN_RAISE:
+                raise
+            if self.on_circuit_open == ON_CIRCUIT_OPEN_BUFFER:
+                return
+            payloads = []
+            if self.measurements:
+                payloads.append(self.to_payload())
+            if self.tagged_measurements:
+                payloads.append(self.to_md_payload())
+            self.clear()
+            self.on_circuit_open(payloads)
+            return
         # Clear measurements
         self.clear()
+
+
+class WindowedAggregator(object):
+    """ Aggregates the values of each `period` seconds apart, in one Aggregator
+    per period (a window) stamped with the start of the period.
+
+    add() and add_tagged() take the time of the value (default: now), so a
+    value lands in the period it belongs to whenever it is added. A window
+    is closed once its period ended `lateness` seconds ago: later values for
+    it are dropped and counted in .late. Values timed more than a period
+    ahead (e.g. from a skewed clock) are dropped and counted in .early.
+    submit() sends the closed windows only, so it can be called at any time.
+
+    The other arguments (tags, source, percentiles, on_circuit_open...) are
+    those of each window's Aggregator.
+    """
+
+    def __init__(self, connection, period=60, lateness=0, **args):
+        if period <= 0:
+            raise ValueError("period must be positive")
+        self.connection = connection
+        self.period = period
+        self.lateness = lateness
+        self.late = 0
+        self.early = 0
+        args.pop('period', None)
+        args.pop('time', None)
+        self._args = args
+        # Period start -> Aggregator
+        self.windows = {}
+
+    def add(self, name, value, time=None):
+        window = self._window(time)
+        if window is not None:
+            window.add(name, value)
+
+    def add_tagged(self, name, value, tags=None, time=None):
+        window = self._window(time)
+        if window is not None:
+            window.add_tagged(name, value, tags)
+
+    def pop_closed(self, force=False):
+        """The closed windows (all of them with force), oldest first, e.g. for Queue.add_aggregator()"""
+        now = _now()
+        starts = sorted(s for s in self.windows if force or self._is_closed(s, now))
+        return [self.windows.pop(s) for s in starts]
+
+    def submit(self, retry_policy=None, force=False):
+        # Submit the closed windows (all of them with force), one period after the other
+        windows = self.pop_closed(force)
+        try:
+            while windows:
+                windows[0].submit(retry_policy)
+                window = windows.pop(0)
+                if window.measurements or window.tagged_measurements:
+                    # Kept with on_circuit_open='buffer'
+                    self.windows[window.measure_time] = window
+        finally:
+            # The windows not sent yet are tried again on the next submit
+            for window in windows:
+                self.windows[window.measure_time] = window
+
+    def _window(self, t):
+        now = _now()
+        if t is not None and t > now + self.period:
+            # Would open a window that does not close for long
+            self.early += 1
+            return None
+        start = int(now if t is None else t) // self.period * self.period
+        if self._is_closed(start, now):
+            self.late += 1
+            return None
+        window = self.windows.get(start)
+        if window is None:
+            window = self.windows[start] = Aggregator(self.connection, time=start, **self._args)
+        return window
+
+    def _is_closed(self, start, now):
+        return start + self.period + self.lateness <= now
+
+
+def _now():
+    return time.time()
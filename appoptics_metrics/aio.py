@@ -0,0 +1,701 @@
+"""
+asyncio flavour of the AppOptics client (Python 3.5+).
+
+    from appoptics_metrics.aio import AsyncAppOpticsConnection
+
+    api = AsyncAppOpticsConnection('token', tags={'host': 'web-1'})
+    await api.submit('temperature', 22.1)
+    async for m in api.list_all_metrics():
+        print(m.name)
+    await api.close()
+
+Requests go over non-blocking keep-alive sockets kept in an
+AsyncConnectionPool, and server errors are retried with asyncio.sleep so
+the event loop is never blocked.
+"""
+import asyncio
+import socket
+import ssl
+import time
+from collections import deque
+from itertools import islice
+from appoptics_metrics import (AppOpticsConnection, Queue, HOSTNAME, BASE_PATH, DEFAULT_TIMEOUT,
+                               DEFAULT_KEEPALIVE_IDLE_TIMEOUT, DEFAULT_KEEPALIVE_MAX_REQUESTS, DEFAULT_POOL_MAXSIZE,
+                               DEFAULT_GZIP_LEVEL, DEFAULT_GZIP_MIN_SIZE,
+                               exceptions, sanitize_no_op, log)
+from six.moves.urllib.parse import urlsplit
+from appoptics_metrics.queue import ON_CIRCUIT_OPEN_RAISE, SubmitReport, hoisted
+from appoptics_metrics.pagination import Paginator
+from appoptics_metrics.pool import PooledConnection
+from appoptics_metrics.retry import CONNECTION_ERROR, CONNECTION_ERRORS
+from appoptics_metrics.transport import httpx, _str_headers, _httpx_response
+from appoptics_metrics.metrics import Gauge, Metric
+from appoptics_metrics.alerts import Alert
+from appoptics_metrics.annotations import Annotation
+from appoptics_metrics.spaces import Space, Chart
+
+# Number of chunks an AsyncQueue posts at the same time
+DEFAULT_SUBMIT_CONCURRENCY = 8
+
+
+class AsyncHTTPResponse(object):
+    """A fully read HTTP response, quacking like http_client.HTTPResponse"""
+
+    def __init__(self, status, reason, headers, body, will_close):
+        self.status = status
+        self.reason = reason
+        self._headers = headers
+        self._body = body
+        self.will_close = will_close
+
+    def getheader(self, name, default=None):
+        return self._headers.get(name.lower(), default)
+
+    def read(self):
+        body, self._body = self._body, b''
+        return body
+
+
+class AsyncHTTPConnection(object):
+    """
+    A minimal HTTP/1.1 client connection over asyncio streams.
+    Like http_client.HTTPConnection it connects lazily on the first request
+    and can be reused for several requests (keep-alive).
+    """
+
+    def __init__(self, host, port=None, use_ssl=True, timeout=DEFAULT_TIMEOUT):
+        self.host = host
+        self.use_ssl = use_ssl
+        self.port = port or (443 if use_ssl else 80)
+        self.timeout = timeout
+        self._reader = None
+        self._writer = None
+
+    @property
+    def is_dropped(self):
+        """True if the server closed the (idle) socket"""
+        return self._reader is not None and (self._reader.at_eof() or self._writer.is_closing())
+
+    async def request(self, method, uri, body=None, headers=None):
+        """Send a request and return the AsyncHTTPResponse once its body is read"""
+        return await asyncio.wait_for(self._request(method, uri, body, headers or {}), self.timeout)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def _request(self, method, uri, body, headers):
+        if self._writer is None:
+            context = ssl.create_default_context() if self.use_ssl else None
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port, ssl=context)
+
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        lines = ["%s %s HTTP/1.1" % (method, uri), "Host: %s" % self.host]
+        for k, v in headers.items():
+            if isinstance(v, bytes):
+                v = v.decode('latin-1')
+            lines.append("%s: %s" % (k, v))
+        lines.append("Content-Length: %d" % len(body or b''))
+        self._writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+        if body:
+            self._writer.write(body)
+        await self._writer.drain()
+
+        return await self._read_response(method)
+
+    async def _read_response(self, method):
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Server closed the connection")
+        version, status, reason = (status_line.decode('latin-1').rstrip("\r\n").split(" ", 2) + [''])[:3]
+        status = int(status)
+
+        headers = {}
+        while True:
+            line = await self._reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            k, _, v = line.decode('latin-1').partition(":")
+            headers[k.strip().lower()] = v.strip()
+
+        will_close = (headers.get('connection', '').lower() == 'close' or
+                      (version == 'HTTP/1.0' and headers.get('connection', '').lower() != 'keep-alive'))
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            body = b''
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = await self._read_chunked()
+        elif 'content-length' in headers:
+            body = await self._reader.readexactly(int(headers['content-length']))
+        else:
+            body = await self._reader.read()
+            will_close = True
+
+        if will_close:
+            self.close()
+        return AsyncHTTPResponse(status, reason, headers, body, will_close)
+
+    async def _read_chunked(self):
+        parts = []
+        while True:
+            size = int((await self._reader.readline()).split(b";")[0].strip(), 16)
+            if size == 0:
+                # Skip trailers
+                while (await self._reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return b"".join(parts)
+            parts.append(await self._reader.readexactly(size))
+            await self._reader.readline()
+
+
+class AsyncConnectionPool(object):
+    """
+    The asyncio counterpart of ConnectionPool: a bounded set of keep-alive
+    AsyncHTTPConnections per key. acquire() waits for a free connection when
+    `maxsize` of them are checked out (up to `timeout` seconds if set, then
+    raises PoolTimeout).
+    """
+
+    def __init__(self, maxsize=DEFAULT_POOL_MAXSIZE, timeout=None,
+                 idle_timeout=DEFAULT_KEEPALIVE_IDLE_TIMEOUT, max_requests=DEFAULT_KEEPALIVE_MAX_REQUESTS):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self._idle = {}        # key -> [PooledConnection]
+        self._semaphores = {}  # key -> asyncio.Semaphore(maxsize), created lazily inside the loop
+
+    async def acquire(self, key, factory):
+        if key not in self._semaphores:
+            self._semaphores[key] = asyncio.Semaphore(self.maxsize)
+        try:
+            await asyncio.wait_for(self._semaphores[key].acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise exceptions.PoolTimeout("Timed out waiting for a connection to %s" % (key,))
+
+        idle = self._idle.get(key, [])
+        pooled = None
+        while idle:
+            candidate = idle.pop()
+            if self._is_healthy(candidate):
+                pooled = candidate
+                break
+            candidate.conn.close()
+        if pooled is None:
+            pooled = PooledConnection(key, factory())
+        pooled.requests += 1
+        return pooled
+
+    def release(self, pooled, reusable=True):
+        if reusable:
+            pooled.last_used = time.time()
+            self._idle.setdefault(pooled.key, []).append(pooled)
+        else:
+            pooled.conn.close()
+        self._semaphores[pooled.key].release()
+
+    def clear(self):
+        idle, self._idle = self._idle, {}
+        for pooled_list in idle.values():
+            for pooled in pooled_list:
+                pooled.conn.close()
+
+    def _is_healthy(self, pooled):
+        if pooled.requests >= self.max_requests:
+            return False
+        if time.time() - pooled.last_used >= self.idle_timeout:
+            return False
+        return not getattr(pooled.conn, 'is_dropped', False)
+
+
+class AsyncHTTPTransport(object):
+    """The default asyncio transport: AsyncHTTPConnections kept in an
+    AsyncConnectionPool, per (scheme, host). Same contract as
+    transport.Transport, but request() and close() are coroutines.
+    """
+
+    def __init__(self, pool=None):
+        self.pool = pool or AsyncConnectionPool()
+
+    async def request(self, method, url, body=None, headers=None, timeout=None):
+        scheme, host, path, query, _ = urlsplit(url)
+        uri = path + "?" + query if query else path
+        while True:
+            pooled = await self.pool.acquire(
+                (scheme, host), lambda: AsyncHTTPConnection(host, use_ssl=scheme == "https", timeout=timeout))
+            pooled.conn.timeout = timeout
+            try:
+                resp = await pooled.conn.request(method, uri, body=body, headers=headers)
+            except asyncio.CancelledError:
+                self.pool.release(pooled, reusable=False)
+                raise
+            except asyncio.TimeoutError as e:
+                self.pool.release(pooled, reusable=False)
+                # Let the retry policy see it as a socket timeout (the same class on py3.10+)
+                if isinstance(e, socket.timeout):
+                    raise
+                raise socket.timeout(str(e))
+            except Exception as e:
+                self.pool.release(pooled, reusable=False)
+                if isinstance(e, CONNECTION_ERRORS) and pooled.reused:
+                    log.info("keep-alive connection was closed by the server, reconnecting")
+                    continue
+                raise
+            self.pool.release(pooled, reusable=not resp.will_close)
+            return resp
+
+    async def close(self):
+        self.pool.clear()
+
+
+class AsyncHttpxTransport(object):
+    """Sends requests with httpx.AsyncClient (pip install httpx[http2]), over
+    HTTP/2 by default. Extra keyword arguments are passed to httpx.AsyncClient.
+    """
+
+    def __init__(self, client=None, http2=True, **client_kwargs):
+        if httpx is None:
+            raise ImportError("AsyncHttpxTransport needs the httpx package")
+        self.client = client or httpx.AsyncClient(http2=http2, **client_kwargs)
+
+    async def request(self, method, url, body=None, headers=None, timeout=None):
+        try:
+            resp = await self.client.request(method, url, content=body, headers=_str_headers(headers),
+                                             timeout=timeout)
+        except httpx.TimeoutException as e:
+            raise socket.timeout(str(e))
+        except httpx.TransportError as e:
+            raise CONNECTION_ERROR(str(e))
+        return _httpx_response(resp)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class AsyncPaginator(Paginator):
+    """The asyncio counterpart of pagination.Paginator, iterated with async for"""
+
+    def __init__(self, connection, entity, klass, stream=False, **kwargs):
+        if stream:
+            raise ValueError("Pages are not streamed by the asyncio connection")
+        Paginator.__init__(self, connection, entity, klass, **kwargs)
+
+    def __iter__(self):
+        raise TypeError("AsyncPaginator is iterated with 'async for'")
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._items.__anext__()
+
+    async def _iter_items(self):
+        async for page_offset, resp in self._iter_pages():
+            results = self.connection._parse(resp, self.entity, self.klass)
+            for i, result in enumerate(results):
+                if self.ordered:
+                    self.offset = page_offset + i + 1
+                yield result
+            if not self.ordered:
+                self._page_done(page_offset, len(results))
+
+    async def _iter_pages(self):
+        offset = self.offset or 0
+        while True:
+            resp = await self._fetch(offset)
+            length, total = self._page_info(resp, offset)
+            next_offset = offset + length
+            if self.parallelism and self.parallelism > 1 and next_offset < total and length > 0:
+                async for page in self._prefetch(resp, offset, range(next_offset, total, length)):
+                    yield page
+                return
+            yield offset, resp
+            if next_offset >= total or length == 0:
+                return
+            offset = next_offset
+
+    async def _prefetch(self, first_resp, first_offset, offsets):
+        offsets = iter(offsets)
+        pending = deque()
+
+        def submit(offset):
+            task = asyncio.ensure_future(self._fetch(offset))
+            task.page_offset = offset
+            pending.append(task)
+
+        try:
+            for offset in islice(offsets, self.parallelism):
+                submit(offset)
+            yield first_offset, first_resp
+            while pending:
+                if self.ordered:
+                    task = pending.popleft()
+                else:
+                    done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    task = done.pop()
+                    pending.remove(task)
+                resp = await task
+                for offset in islice(offsets, 1):
+                    submit(offset)
+                yield task.page_offset, resp
+        finally:
+            # The caller may stop iterating early
+            for task in pending:
+                task.cancel()
+
+
+class AsyncAppOpticsConnection(AppOpticsConnection):
+    """AppOptics API Connection for asyncio applications.
+
+    Same surface as AppOpticsConnection, but every API call is a coroutine
+    and the list_all_* / list_* paginated listings are async generators:
+
+    api = AsyncAppOpticsConnection(api_key)
+    metrics = await api.list_metrics()
+    async for space in api.list_spaces():
+        ...
+    """
+
+    def __init__(self, api_key, hostname=HOSTNAME, base_path=BASE_PATH, sanitizer=sanitize_no_op,
+                 protocol="https", tags=None, keepalive_idle_timeout=DEFAULT_KEEPALIVE_IDLE_TIMEOUT,
+                 keepalive_max_requests=DEFAULT_KEEPALIVE_MAX_REQUESTS, pool=None,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE, pool_timeout=None, gzip=False,
+                 gzip_level=DEFAULT_GZIP_LEVEL, gzip_min_size=DEFAULT_GZIP_MIN_SIZE, retry_policy=None,
+                 circuit_breaker=None, transport=None, codec=None):
+        if transport is None:
+            if pool is None:
+                pool = AsyncConnectionPool(maxsize=pool_maxsize, timeout=pool_timeout,
+                                           idle_timeout=keepalive_idle_timeout, max_requests=keepalive_max_requests)
+            transport = AsyncHTTPTransport(pool)
+        AppOpticsConnection.__init__(self, api_key, hostname, base_path, sanitizer=sanitizer,
+                                     protocol=protocol, tags=tags, gzip=gzip, gzip_level=gzip_level,
+                                     gzip_min_size=gzip_min_size, retry_policy=retry_policy,
+                                     circuit_breaker=circuit_breaker, transport=transport, codec=codec)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+
+    async def _mexe(self, path, method="GET", query_props=None, p_headers=None, retry_policy=None):
+        """Internal method for executing a command.
+           Failed attempts are retried as decided by retry_policy (or
+           self.retry_policy), waiting without blocking the event loop.
+        """
+        headers = self._set_headers(p_headers)
+        uri, body = self._prepare_request(path, headers, query_props, method)
+        url = "%s://%s%s" % (self.protocol, self.hostname, uri)
+        retry = (retry_policy or self.retry_policy).start()
+        breaker = self.circuit_breaker
+        while True:
+            if breaker is not None:
+                breaker.check()
+            trace = self._start_trace(method, uri, body) if self.tracers else None
+            try:
+                resp = await self.transport.request(method, url, body=body, headers=headers, timeout=self.timeout)
+                resp_data = self._process_response(resp, trace)
+            except asyncio.CancelledError:
+                if breaker is not None:
+                    breaker.release_probe()
+                raise
+            except Exception as e:
+                if trace is not None and trace.elapsed is None:
+                    self._end_trace(trace, error=e)
+                if breaker is not None:
+                    breaker.record(e)
+                delay = retry.next_delay(e)
+                if delay is None:
+                    raise
+                log.info("%s: waiting %.2fs before re-trying", e, delay)
+                await asyncio.sleep(delay)
+                continue
+            if breaker is not None:
+                breaker.record_success()
+            return resp_data
+
+    async def close(self):
+        """Close the idle sockets kept by the transport"""
+        await self.transport.close()
+
+    async def stream_tagged(self, name, **query_props):
+        """
+        Like get_tagged, iterated with async for: yields a (series,
+        measurement) pair per point, where series holds the tags of the
+        series. The response is read whole before the first pair though.
+        :param name:
+        :param query_props:
+        :return:
+        """
+        resp = await self.get_tagged(name, **query_props)
+        for series in resp.get('series') or []:
+            parent = dict((k, v) for k, v in series.items() if k != 'measurements')
+            for measurement in series.get('measurements') or []:
+                yield parent, measurement
+
+    def _get_paginated_results(self, entity, klass, **query_props):
+        """
+        Return an AsyncPaginator over all items of a "list" request
+        :param entity:
+        :param klass:
+        :param query_props:
+        :return:
+        """
+        return AsyncPaginator(self, entity, klass, **query_props)
+
+    #
+    # Metrics
+    #
+    async def list_metrics(self, **query_props):
+        """List a page of metrics"""
+        resp = await self._mexe("metrics", query_props=query_props)
+        return self._parse(resp, "metrics", Metric)
+
+    async def submit(self, name, value, **query_props):
+        # silently ignore `type` for measurements submission
+        query_props.pop("type", None)
+
+        if 'tags' in query_props or self.get_tags():
+            await self.submit_tagged(name, value, **query_props)
+        else:  # at least one `tags` is required
+            raise Exception('At least one tag is needed.')
+
+    async def submit_tagged(self, name, value, **query_props):
+        retry_policy = query_props.pop('retry_policy', None)
+        payload = {'measurements': []}
+        payload['measurements'].append(self.create_tagged_payload(name, value, **query_props))
+        await self._mexe("measurements", method="POST", query_props=payload, retry_policy=retry_policy)
+
+    async def get(self, name, **query_props):
+        resp = await self._mexe("metrics/%s" % self.sanitize(name), method="GET", query_props=query_props)
+        if resp['type'] == 'gauge':
+            return Gauge.from_dict(self, resp)
+        else:
+            raise Exception('The server sent me something that is not a Gauge.')
+
+    #
+    # Annotations
+    #
+    async def get_annotation_stream(self, name, **query_props):
+        """Get an annotation stream (add start_date to query props for events)"""
+        resp = await self._mexe("annotations/%s" % name, method="GET", query_props=query_props)
+        return Annotation.from_dict(self, resp)
+
+    async def get_annotation(self, name, id, **query_props):
+        """Get a specific annotation event by ID"""
+        resp = await self._mexe("annotations/%s/%s" % (name, id), method="GET", query_props=query_props)
+        return Annotation.from_dict(self, resp)
+
+    async def update_annotation_stream(self, name, **query_props):
+        """Update an annotation streams metadata"""
+        payload = Annotation(self, name).get_payload()
+        for k, v in query_props.items():
+            payload[k] = v
+        resp = await self._mexe("annotations/%s" % name, method="PUT", query_props=payload)
+        return Annotation.from_dict(self, resp)
+
+    #
+    # Alerts
+    #
+    async def create_alert(self, name, **query_props):
+        """Create a new alert"""
+        payload = Alert(self, name, **query_props).get_payload()
+        resp = await self._mexe("alerts", method="POST", query_props=payload)
+        return Alert.from_dict(self, resp)
+
+    async def delete_alert(self, name):
+        """delete an alert"""
+        alert = await self.get_alert(name)
+        if alert is None:
+            return None
+        return await self._mexe("alerts/%s" % alert._id, method="DELETE")
+
+    async def get_alert(self, name):
+        """Get specific alert"""
+        resp = await self._mexe("alerts", query_props={'name': name})
+        alerts = self._parse(resp, "alerts", Alert)
+        if len(alerts) > 0:
+            return alerts[0]
+        return None
+
+    #
+    # Spaces
+    #
+    async def get_space(self, id, **query_props):
+        """Get specific space by ID"""
+        resp = await self._mexe("spaces/%s" % id, method="GET", query_props=query_props)
+        return Space.from_dict(self, resp)
+
+    async def find_space(self, name):
+        """Find specific space by Name"""
+        if type(name) is int:
+            raise ValueError("This method expects name as a parameter, %s given" % name)
+        async for space in self.list_spaces(name=name):
+            if space.name and space.name.lower() == name.lower():
+                return await self.get_space(space.id)
+        return None
+
+    async def create_space(self, name, **query_props):
+        payload = Space(self, name).get_payload()
+        for k, v in query_props.items():
+            payload[k] = v
+        resp = await self._mexe("spaces", method="POST", query_props=payload)
+        return Space.from_dict(self, resp)
+
+    #
+    # Charts
+    #
+    async def list_charts_in_space(self, space, **query_props):
+        """List all charts from space"""
+        resp = await self._mexe("spaces/%s/charts" % space.id, query_props=query_props)
+        charts = self._parse({"charts": resp}, "charts", Chart)
+        for chart in charts:
+            chart.space_id = space.id
+        return charts
+
+    async def get_chart(self, chart_id, space_or_space_id, **query_props):
+        """Get specific chart by ID from Space"""
+        if type(space_or_space_id) is int:
+            space_id = space_or_space_id
+        elif type(space_or_space_id) is Space:
+            space_id = space_or_space_id.id
+        else:
+            raise ValueError("Space parameter is invalid")
+        resp = await self._mexe("spaces/%s/charts/%s" % (space_id, chart_id), method="GET", query_props=query_props)
+        resp['space_id'] = space_id
+        return Chart.from_dict(self, resp)
+
+    async def find_chart(self, name, space):
+        """Find a chart by name in a space, return the first match"""
+        for chart in await self.list_charts_in_space(space):
+            if chart.name and chart.name.lower() == name.lower():
+                return await self.get_chart(chart.id, space)
+        return None
+
+    async def create_chart(self, name, space, **query_props):
+        """Create a new chart in space"""
+        payload = Chart(self, name).get_payload()
+        for k, v in query_props.items():
+            payload[k] = v
+        resp = await self._mexe("spaces/%s/charts" % space.id, method="POST", query_props=payload)
+        resp['space_id'] = space.id
+        return Chart.from_dict(self, resp)
+
+    #
+    # Queue
+    #
+    def new_queue(self, **kwargs):
+        return AsyncQueue(self, **kwargs)
+
+
+class AsyncQueue(Queue):
+    """A Queue whose submit() is a coroutine posting up to `concurrency`
+    chunks at the same time over the connection's pool.
+
+    async with api.new_queue(tags={'host': 'web-1'}) as q:
+        q.add('temperature', 22.1)
+
+    With auto_submit_count, the flush runs as a background task; submit()
+    waits for those tasks too, and its SubmitReport includes their chunks.
+    add() must then be called from the running event loop: it raises
+    RuntimeError otherwise, the measurements staying queued.
+    """
+
+    def __init__(self, connection, auto_submit_count=None, tags=None, concurrency=DEFAULT_SUBMIT_CONCURRENCY,
+                 on_circuit_open=ON_CIRCUIT_OPEN_RAISE, coalesce=False, coalesce_period=None, compact=False,
+                 max_body_size=None, adaptive=False):
+        Queue.__init__(self, connection, auto_submit_count=auto_submit_count, tags=tags,
+                       on_circuit_open=on_circuit_open, concurrency=concurrency, coalesce=coalesce,
+                       coalesce_period=coalesce_period, compact=compact, max_body_size=max_body_size,
+                       adaptive=adaptive)
+        # Auto-flush task -> its SubmitReport
+        self._pending = {}
+
+    async def submit(self, retry_policy=None):
+        self.last_report = report = SubmitReport()
+        # Taken first: the chunks an auto-flush fails to send are kept for the next submit()
+        chunks = self._detach_chunks()
+        pending, self._pending = self._pending, {}
+        errors = []
+        if pending:
+            results = await asyncio.gather(*pending, return_exceptions=True)
+            for flushed, result in zip(pending.values(), results):
+                report.sent.extend(flushed.sent)
+                report.failed.extend(flushed.failed)
+                if isinstance(result, Exception):
+                    errors.append(result)
+        try:
+            await self._post(*chunks, retry_policy=retry_policy, report=report)
+        except Exception as e:
+            errors.append(e)
+        if len(errors) == 1 or errors and all(isinstance(e, exceptions.CircuitOpenError) for e in errors):
+            raise errors[0]
+        if errors:
+            raise exceptions.SubmitError(report.failed)
+        return report
+
+    def _detach_chunks(self):
+        if self._store:
+            self.tagged_chunks.extend(self._pop_stored_chunks())
+        chunks, tagged_chunks = self.chunks, self.tagged_chunks
+        self.chunks = []
+        self.tagged_chunks = []
+        self._queued = 0
+        self._coalesced = {}
+        return chunks, tagged_chunks
+
+    async def _post(self, chunks, tagged_chunks, retry_policy=None, report=None):
+        report = report if report is not None else SubmitReport()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def post(chunk):
+            async with semaphore:
+                start = time.time()
+                try:
+                    await self.connection._mexe("measurements", method="POST", query_props=hoisted(chunk),
+                                                retry_policy=retry_policy)
+                except Exception as e:
+                    if self.adaptive is not None:
+                        self.adaptive.record(len(chunk['measurements']), time.time() - start, e)
+                    report.failed.append((chunk, e))
+                    raise
+                if self.adaptive is not None:
+                    self.adaptive.record(len(chunk['measurements']), time.time() - start)
+                report.sent.append(chunk)
+
+        all_chunks = chunks + tagged_chunks
+        results = await asyncio.gather(*[post(c) for c in all_chunks], return_exceptions=True)
+        failed = [(c, r) for c, r in zip(all_chunks, results) if isinstance(r, BaseException)]
+        if failed:
+            # Keep what could not be sent for the next submit()
+            failed_ids = set(id(c) for c, _ in failed)
+            self.chunks = [c for c in chunks if id(c) in failed_ids] + self.chunks
+            self.tagged_chunks = [c for c in tagged_chunks if id(c) in failed_ids] + self.tagged_chunks
+            self._count_queued()
+            try:
+                self._raise_submit_errors(failed)
+            except exceptions.CircuitOpenError as e:
+                self._circuit_open(e)
+        return report
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.submit()
+
+    def _auto_submit_if_necessary(self):
+        if self.auto_submit_count and self._num_measurements_in_queue() >= self.auto_submit_count:
+            # Before detaching the chunks, in case there is no running loop
+            loop = asyncio.get_running_loop()
+            report = SubmitReport()
+            task = loop.create_task(self._post(*self._detach_chunks(), report=report))
+            self._pending[task] = report
+            task.add_done_callback(self._flushed)
+
+    def _flushed(self, task):
+        self._pending.pop(task, None)
+        if not task.cancelled() and task.exception() is not None:
+            # Its chunks were queued again, or handed to on_circuit_open
+            log.warning("auto-submit failed: %r", task.exception())
@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import deque
+from appoptics_metrics import exceptions
+from appoptics_metrics.retry import is_connection_error
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+    """Stops sending requests to an API that keeps failing.
+
+    closed:    requests go through; the outcome of the last `window_size`
+               requests is kept, and once at least `min_calls` of them are
+               known and the share of failures reaches
+               `failure_rate_threshold` the circuit opens.
+    open:      requests fail right away with CircuitOpenError, for
+               `open_timeout` seconds.
+    half_open: up to `half_open_max_calls` probe requests go through. A
+               successful probe closes the circuit, a failed one opens it
+               again.
+
+    Failures are 5xx responses, timeouts and connection errors; any other
+    response (including 4xx) shows the API is up. A breaker can be shared by
+    several connections and threads.
+    """
+
+    def __init__(self, failure_rate_threshold=0.5, window_size=20, min_calls=10, open_timeout=30,
+                 half_open_max_calls=1):
+        if not 0 < failure_rate_threshold <= 1:
+            raise ValueError("failure_rate_threshold must be in (0, 1]")
+        self.failure_rate_threshold = failure_rate_threshold
+        self.min_calls = min(min_calls, window_size)
+        self.open_timeout = open_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=window_size)   # True for a failure
+        self._state = CLOSED
+        self._opened_at = None
+        self._probes = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def failure_rate(self):
+        with self._lock:
+            if not self._outcomes:
+                return 0.0
+            return float(sum(self._outcomes)) / len(self._outcomes)
+
+    def allow_request(self):
+        """Return True if a request may be sent now; counts half-open probes"""
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and self._probes < self.half_open_max_calls:
+                self._probes += 1
+                return True
+            return False
+
+    def check(self):
+        """Raise CircuitOpenError unless a request may be sent now"""
+        if not self.allow_request():
+            raise exceptions.CircuitOpenError("Circuit open: the AppOptics API is failing, not sending requests")
+
+    def record(self, error=None):
+        """Record the outcome of a request that allow_request() let through"""
+        if error is not None and self.is_failure(error):
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def record_success(self):
+        with self._lock:
+            if self._current_state() == HALF_OPEN:
+                self._close()
+            else:
+                self._outcomes.append(False)
+
+    def record_failure(self):
+        with self._lock:
+            state = self._current_state()
+            if state == HALF_OPEN:
+                self._open()
+            elif state == CLOSED:
+                self._outcomes.append(True)
+                if (len(self._outcomes) >= self.min_calls and
+                        float(sum(self._outcomes)) / len(self._outcomes) >= self.failure_rate_threshold):
+                    self._open()
+
+    def release_probe(self):
+        """Give back a half-open probe slot when its request was abandoned (e.g. cancelled)"""
+        with self._lock:
+            if self._current_state() == HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def reset(self):
+        with self._lock:
+            self._close()
+
+    @staticmethod
+    def is_failure(error):
+        if isinstance(error, exceptions.APIError):
+            return error.code >= 500
+        return is_connection_error(error)
+
+    # Private, sort of. The caller holds self._lock.
+    #
+    def _current_state(self):
+        if self._state == OPEN and time.time() - self._opened_at >= self.open_timeout:
+            self._state = HALF_OPEN
+            self._probes = 0
+        return self._state
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = time.time()
+        self._outcomes.clear()
+
+    def _close(self):
+        self._state = CLOSED
+        self._outcomes.clear()
@@ -0,0 +1,87 @@
+"""
+Codecs turn request payloads into JSON bytes and response bodies back.
+
+    api = appoptics_metrics.connect('token', codec=JSONCodec())
+
+By default the fastest installed library is used: orjson, then ujson, then
+the stdlib json module. All of them encode straight to UTF-8 bytes.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class Codec(object):
+    """Base class for codecs"""
+    name = None
+
+    def dumps(self, obj):
+        """Encode obj as JSON, returning UTF-8 bytes"""
+        raise NotImplementedError()
+
+    def loads(self, data):
+        """Decode JSON from UTF-8 bytes or a str"""
+        raise NotImplementedError()
+
+
+class JSONCodec(Codec):
+    """The stdlib json module"""
+    name = 'json'
+
+    def dumps(self, obj):
+        # ASCII only, so there is no need for a UTF-8 encoder
+        return json.dumps(obj, separators=(',', ':')).encode('ascii')
+
+    def loads(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+
+class OrjsonCodec(Codec):
+    """orjson (pip install orjson)"""
+    name = 'orjson'
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError("OrjsonCodec needs the orjson package")
+        # Non-str keys are turned into strings, like the json module does
+        self._option = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj):
+        return orjson.dumps(obj, option=self._option)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class UjsonCodec(Codec):
+    """ujson (pip install ujson)"""
+    name = 'ujson'
+
+    def __init__(self):
+        if ujson is None:
+            raise ImportError("UjsonCodec needs the ujson package")
+
+    def dumps(self, obj):
+        return ujson.dumps(obj, escape_forward_slashes=False).encode('ascii')
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+
+def default_codec():
+    """The codec of the fastest JSON library installed"""
+    if orjson is not None:
+        return OrjsonCodec()
+    if ujson is not None:
+        return UjsonCodec()
+    return JSONCodec()
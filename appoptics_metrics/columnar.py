@@ -0,0 +1,167 @@
+from array import array
+from math import isnan
+from six import integer_types
+
+# Measurement keys stored in columns, the others are kept per row
+_COLUMNS = frozenset(['name', 'tags', 'sum', 'count', 'time', 'min', 'max'])
+_NO_TIME = -2 ** 63
+_NAN = float('nan')
+# Drop the sent rows from the head of the columns past this many
+_COMPACT_ROWS = 64 * 1024
+
+
+class ColumnStore(object):
+    """Compact storage for the tagged measurements of a Queue.
+
+    Names and tag sets are interned and referred to by their index; sums,
+    counts and times (and min/max once a measurement has them) are kept in
+    array columns, so that a queued measurement takes a few tens of bytes.
+    The JSON objects are only built by pop_chunks(), when they are sent.
+    Integer sums stay integers: the sums column holds 64-bit integers until
+    a float (or a larger integer) comes, and then doubles with a per-row
+    flag of the integer ones.
+    """
+
+    def __init__(self):
+        self._clear()
+
+    def _clear(self):
+        self._names = []
+        self._name_ids = {}
+        self._tag_sets = []
+        self._tag_set_ids = {}
+        self._name_col = array('I')
+        self._tags_col = array('I')
+        self._sums = array('q')
+        self._int_rows = None   # None while all the sums are in an integer column
+        self._counts = array('q')
+        self._times = array('q')
+        self._mins = None
+        self._maxs = None
+        self._extras = {}   # row -> the other properties
+        self._start = 0     # the rows before were sent
+
+    def __len__(self):
+        return len(self._sums) - self._start
+
+    def append(self, nm):
+        """Store a measurement dict, returning its row"""
+        row = len(self._sums)
+        name = nm['name']
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self._names)
+            self._names.append(name)
+        tags = nm.get('tags') or {}
+        tags_key = frozenset(tags.items())
+        tags_id = self._tag_set_ids.get(tags_key)
+        if tags_id is None:
+            tags_id = self._tag_set_ids[tags_key] = len(self._tag_sets)
+            self._tag_sets.append(dict(tags))
+        self._name_col.append(name_id)
+        self._tags_col.append(tags_id)
+        self._store_sum(row, nm['sum'], True)
+        self._counts.append(nm.get('count', 1))
+        t = nm.get('time')
+        self._times.append(_NO_TIME if t is None else int(t))
+        if 'min' in nm or self._mins is not None:
+            if self._mins is None:
+                self._mins = array('d', [_NAN]) * row
+                self._maxs = array('d', [_NAN]) * row
+            self._mins.append(nm.get('min', _NAN))
+            self._maxs.append(nm.get('max', _NAN))
+        extras = dict((k, v) for k, v in nm.items() if k not in _COLUMNS)
+        if extras:
+            self._extras[row] = extras
+        return row
+
+    def merge(self, row, nm, low, high):
+        """Add the sum and count of nm to a row; low and high are its min and
+        max (None if unknown)
+        """
+        self._store_sum(row, nm['sum'], False)
+        self._counts[row] += nm['count']
+        if self._mins is not None and not isnan(self._mins[row]):
+            if low is None or high is None:
+                self._mins[row] = self._maxs[row] = _NAN
+            else:
+                self._mins[row] = min(self._mins[row], low)
+                self._maxs[row] = max(self._maxs[row], high)
+
+    def _store_sum(self, row, value, new):
+        total = value if new else self._sums[row] + value
+        is_int = isinstance(value, integer_types)
+        if self._int_rows is None and not (is_int and -2 ** 63 <= total < 2 ** 63):
+            self._int_rows = array('b', [1]) * len(self._sums)
+            self._sums = array('d', self._sums)
+        if new:
+            self._sums.append(total)
+            if self._int_rows is not None:
+                self._int_rows.append(is_int)
+        else:
+            self._sums[row] = total
+            if self._int_rows is not None and not is_int:
+                self._int_rows[row] = 0
+
+    def pop_chunks(self, size, count=None, max_bytes=None, sizer=None):
+        """Remove the oldest rows, returning them as up to `count` chunks
+        (all of them if None) of `size` measurement dicts. With max_bytes,
+        a chunk also ends before the sizes of its measurements, as given by
+        sizer(measurement), add up to more than max_bytes.
+        """
+        chunks = []
+        while len(self) and (count is None or len(chunks) < count):
+            end = min(self._start + size, len(self._sums))
+            if max_bytes is None:
+                measurements = [self._measurement(row) for row in range(self._start, end)]
+            else:
+                measurements = []
+                total = 0
+                for row in range(self._start, end):
+                    nm = self._measurement(row)
+                    total += sizer(nm)
+                    if measurements and total > max_bytes:
+                        break
+                    measurements.append(nm)
+            end = self._start + len(measurements)
+            chunks.append({'measurements': measurements})
+            for row in range(self._start, end):
+                self._extras.pop(row, None)
+            self._start = end
+        if not len(self):
+            # Forget the interned names and tags too
+            self._clear()
+        elif self._start >= _COMPACT_ROWS and self._start * 2 >= len(self._sums):
+            self._compact()
+        return chunks
+
+    def _measurement(self, row):
+        is_int = self._int_rows is None or self._int_rows[row]
+        nm = {'name': self._names[self._name_col[row]], 'sum': self._sums[row], 'count': self._counts[row]}
+        if is_int:
+            nm['sum'] = int(nm['sum'])
+        tags = self._tag_sets[self._tags_col[row]]
+        if tags:
+            # The measurements of a tag set share its dict
+            nm['tags'] = tags
+        if self._times[row] != _NO_TIME:
+            nm['time'] = self._times[row]
+        if self._mins is not None and not isnan(self._mins[row]):
+            nm['min'] = self._mins[row]
+            nm['max'] = self._maxs[row]
+            if is_int and nm['min'].is_integer() and nm['max'].is_integer():
+                nm['min'] = int(nm['min'])
+                nm['max'] = int(nm['max'])
+        extras = self._extras.get(row)
+        if extras:
+            nm.update(extras)
+        return nm
+
+    def _compact(self):
+        start = self._start
+        for column in (self._name_col, self._tags_col, self._sums, self._int_rows, self._counts, self._times,
+                       self._mins, self._maxs):
+            if column is not None:
+                del column[:start]
+        self._extras = dict((row - start, extras) for row, extras in self._extras.items())
+        self._start = 0
@@ -1,8 +1,10 @@
-class ClientError(Exception):
-    """4xx client exceptions"""
+class APIError(Exception):
+    """Error responses (4xx and 5xx) from the API"""
     def __init__(self, code, error_payload=None):
         self.code = code
         self.error_payload = error_payload
+        # Seconds the server asked us to wait before retrying (Retry-After), if any
+        self.retry_after = None
         Exception.__init__(self, self.error_message())
 
     def error_message(self):
@@ -90,6 +92,16 @@ class ClientError(Exception):
                 return "%s: %s" % (k, messages)
 
 
+class ClientError(APIError):
+    """4xx client exceptions"""
+    pass
+
+
+class ServerError(APIError):
+    """5xx server exceptions"""
+    pass
+
+
 class BadRequest(ClientError):
     """400 Forbidden"""
     def __init__(self, msg=None):
@@ -113,11 +125,43 @@ class NotFound(ClientError):
     def __init__(self, msg=None):
         ClientError.__init__(self, 404, msg)
 
+
+class TooManyRequests(ClientError):
+    """429 Too Many Requests (rate limited)"""
+    def __init__(self, msg=None):
+        ClientError.__init__(self, 429, msg)
+
+
+class PoolTimeout(Exception):
+    """No pooled connection became available in time"""
+    pass
+
+
+class CircuitOpenError(Exception):
+    """The circuit breaker is open: the request was not sent"""
+    pass
+
+
+class SubmitError(Exception):
+    """Several chunks of a queue could not be sent. .errors holds a
+    (chunk, exception) pair for each of them.
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        Exception.__init__(self, "%d chunks could not be sent: %s" % (
+            len(errors), "; ".join(sorted(set(repr(e) for _, e in errors)))))
+
+
+class QueueFull(Exception):
+    """No room was made in a BackgroundQueue's buffer in time"""
+    pass
+
 CODES = {
     400: BadRequest,
     401: Unauthorized,
     403: Forbidden,
-    404: NotFound
+    404: NotFound,
+    429: TooManyRequests
 }
 
 
@@ -125,5 +169,7 @@ CODES = {
 def get(code, resp_data):
     if code in CODES:
         return CODES[code](resp_data)
+    elif code >= 500:
+        return ServerError(code, resp_data)
     else:
         return ClientError(code, resp_data)
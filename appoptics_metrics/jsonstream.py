@@ -0,0 +1,189 @@
+"""
+Incremental decoding of large JSON responses.
+
+    stream = ItemStream(chunks, 'metrics')
+    for metric in stream:      # each item as soon as it was received
+        ...
+    stream.meta['query']       # the other top-level keys
+
+Only the item being decoded is held in memory, not the whole body. Items
+are decoded with the stdlib json.JSONDecoder.raw_decode.
+"""
+import codecs
+import json
+import zlib
+
+# Drop consumed text once this much piled up at the head of the buffer
+_COMPACT_SIZE = 64 * 1024
+
+
+class ItemStream(object):
+    """Iterates over the items of the array found under `key` in a JSON
+    object received in chunks (bytes).
+
+    With `subkey`, the items of `key` are objects themselves (e.g. the
+    series of a measurements response) and ItemStream yields
+    (parent, item) for every item of their `subkey` array, where parent
+    holds the keys of that object read so far (those sent before `subkey`).
+
+    The other top-level keys are collected in .meta.
+    """
+
+    def __init__(self, chunks, key, subkey=None, encoding='utf-8', gzipped=False, close=None):
+        if gzipped:
+            chunks = _gunzip(chunks)
+        self.key = key
+        self.subkey = subkey
+        self.meta = {}
+        self._reader = _Reader(chunks, encoding)
+        self._close = close
+
+    def __iter__(self):
+        try:
+            reader = self._reader
+            for key in reader.iter_object():
+                if key != self.key:
+                    self.meta[key] = reader.value()
+                elif reader.peek() != '[':
+                    # e.g. null
+                    self.meta[key] = reader.value()
+                elif self.subkey is None:
+                    for _ in reader.iter_array():
+                        yield reader.value()
+                else:
+                    for _ in reader.iter_array():
+                        for pair in self._iter_subitems(reader):
+                            yield pair
+            # Read up to the end, so the connection can be reused
+            reader.drain()
+        finally:
+            self.close()
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+    def _iter_subitems(self, reader):
+        parent = {}
+        for key in reader.iter_object():
+            if key == self.subkey and reader.peek() == '[':
+                for _ in reader.iter_array():
+                    yield parent, reader.value()
+            else:
+                parent[key] = reader.value()
+
+
+class _Reader(object):
+    """A pull parser over text decoded from chunks of bytes"""
+
+    def __init__(self, chunks, encoding):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        self._json = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def peek(self):
+        """The next non-whitespace character ('' at the end)"""
+        while True:
+            buf = self._buf
+            n = len(buf)
+            pos = self._pos
+            while pos < n and buf[pos] in ' \t\n\r':
+                pos += 1
+            self._pos = pos
+            if pos < n:
+                return buf[pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        c = self.peek()
+        if c == '' or c not in chars:
+            raise ValueError("Expected %r at offset %d, got %r" % (chars, self._pos, c))
+        self._pos += 1
+        return c
+
+    def value(self):
+        """Decode the next JSON value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buf, self._pos)
+            except ValueError:
+                # Incomplete: get at least as much data again before retrying,
+                # so a large value is not re-parsed for every chunk
+                if not self._fill(len(self._buf) - self._pos):
+                    raise
+                continue
+            if not self._eof and isinstance(value, (int, float)) and \
+                    not self._buf[end:].strip('.eE+-'):
+                # A number could go on in the next chunk, e.g. after '10.' or '1e'
+                if self._fill():
+                    continue
+            self._pos = end
+            return value
+
+    def iter_object(self):
+        """Yield the keys of an object; the caller reads each value"""
+        self.expect('{')
+        if self.peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def iter_array(self):
+        """Yield once per element of an array; the caller reads each one"""
+        self.expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield
+            if self.expect(',]') == ']':
+                return
+
+    def drain(self):
+        """Consume the rest of the input"""
+        while self._fill():
+            self._buf = ''
+            self._pos = 0
+
+    def _fill(self, at_least=1):
+        """Append decoded text from the next chunks, False at the end of the input"""
+        if self._eof:
+            return False
+        if self._pos >= _COMPACT_SIZE:
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+        parts = []
+        size = 0
+        while size < at_least:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                parts.append(self._decoder.decode(b'', final=True))
+                self._eof = True
+                break
+            text = self._decoder.decode(chunk)
+            parts.append(text)
+            size += len(text)
+        self._buf += ''.join(parts)
+        return size > 0 or bool(parts and parts[-1])
+
+
+def _gunzip(chunks):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
@@ -0,0 +1,156 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+
+
+class Paginator(object):
+    """Iterates over all the items of a "list" request, one page at a time.
+
+    metrics = api.list_all_metrics(length=500)
+    for metric in metrics:
+        ...
+        save_checkpoint(metrics.offset)
+
+    Pages are fetched in a loop, so the cost per item and the memory used do
+    not grow with the number of pages. `length` sets the page size.
+
+    `offset` is a resume token: the offset of the first item not handed out
+    yet. Pass it back as offset=... to continue an interrupted scan. With
+    ordered=False it only moves past pages that were entirely handed out.
+
+    With parallelism=N, the pages after the first one are fetched N at a
+    time (the first response tells how many items there are); items are
+    still handed out in order unless ordered=False.
+
+    With stream=True, each page is decoded as it is received and its items
+    handed out right away, so a page is never held in memory as a whole.
+    """
+
+    def __init__(self, connection, entity, klass, parallelism=None, ordered=True, stream=False, **query_props):
+        if stream and parallelism and parallelism > 1:
+            raise ValueError("Pages cannot be both streamed and fetched in parallel")
+        self.connection = connection
+        self.entity = entity
+        self.klass = klass
+        self.parallelism = parallelism
+        self.ordered = ordered
+        self.stream = stream
+        self.offset = query_props.pop('offset', None)
+        self.query_props = query_props
+        self._send_offset = self.offset is not None
+        # Known once the first page arrived
+        self.total = None
+        self._done = {}   # page offset -> number of items, for ordered=False
+        self._items = self._iter_items()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._items)
+
+    next = __next__   # py2
+
+    # Private, sort of.
+    #
+    def _iter_items(self):
+        if self.stream:
+            for result in self._iter_streamed_items():
+                yield result
+            return
+        for page_offset, resp in self._iter_pages():
+            results = self.connection._parse(resp, self.entity, self.klass)
+            for i, result in enumerate(results):
+                if self.ordered:
+                    self.offset = page_offset + i + 1
+                yield result
+            if not self.ordered:
+                self._page_done(page_offset, len(results))
+
+    def _iter_streamed_items(self):
+        offset = self.offset or 0
+        while True:
+            items = self.connection._stream(self.entity, self.entity, query_props=self._page_query_props(offset))
+            for i, item in enumerate(items):
+                self.offset = offset + i + 1
+                yield self.klass.from_dict(self.connection, item)
+            length, total = self._page_info(items.meta, offset)
+            if offset + length >= total or length == 0:
+                return
+            offset += length
+
+    def _iter_pages(self):
+        """Yield (offset, response) for every page"""
+        offset = self.offset or 0
+        while True:
+            resp = self._fetch(offset)
+            length, total = self._page_info(resp, offset)
+            next_offset = offset + length
+            if self.parallelism and self.parallelism > 1 and next_offset < total and length > 0:
+                for page in self._prefetch(resp, offset, range(next_offset, total, length)):
+                    yield page
+                return
+            yield offset, resp
+            if next_offset >= total or length == 0:
+                return
+            offset = next_offset
+
+    def _prefetch(self, first_resp, first_offset, offsets):
+        """
+        Yield the first page, then the pages at `offsets`, with up to
+        `parallelism` requests in flight
+        """
+        offsets = iter(offsets)
+        executor = ThreadPoolExecutor(max_workers=self.parallelism)
+        pending = deque()
+
+        def submit(offset):
+            future = executor.submit(self._fetch, offset)
+            future.page_offset = offset
+            pending.append(future)
+
+        try:
+            for offset in islice(offsets, self.parallelism):
+                submit(offset)
+            yield first_offset, first_resp
+            while pending:
+                if self.ordered:
+                    future = pending.popleft()
+                else:
+                    future = next(as_completed(pending))
+                    pending.remove(future)
+                resp = future.result()
+                for offset in islice(offsets, 1):
+                    submit(offset)
+                yield future.page_offset, resp
+        finally:
+            # The caller may stop iterating early
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _fetch(self, offset):
+        return self.connection._mexe(self.entity, query_props=self._page_query_props(offset))
+
+    def _page_query_props(self, offset):
+        query_props = dict(self.query_props)
+        if offset or self._send_offset:
+            query_props['offset'] = offset
+        return query_props
+
+    def _page_info(self, resp, offset):
+        query = resp.get('query', {})
+        length = query.get('length', 0)
+        total = query.get('total', offset + length)
+        self.total = total
+        return length, total
+
+    def _page_done(self, page_offset, num_items):
+        if self.offset is None:
+            self.offset = 0
+        self._done[page_offset] = num_items
+        while self.offset in self._done:
+            num_items = self._done.pop(self.offset)
+            if num_items == 0:
+                break
+            self.offset += num_items
@@ -0,0 +1,162 @@
+import select
+import threading
+import time
+from appoptics_metrics import exceptions
+
+DEFAULT_MAXSIZE = 10
+DEFAULT_IDLE_TIMEOUT = 30
+DEFAULT_MAX_REQUESTS = 1000
+
+
+class PooledConnection(object):
+    """An HTTP connection checked out of a ConnectionPool, plus its bookkeeping"""
+
+    def __init__(self, key, conn):
+        self.key = key
+        self.conn = conn
+        self.requests = 0
+        self.last_used = time.time()
+
+    @property
+    def reused(self):
+        """True if this socket already served a request before the current one"""
+        return self.requests > 1
+
+
+class ConnectionPool(object):
+    """A thread-safe, bounded pool of keep-alive HTTP connections.
+
+    Connections are kept per key (e.g. (protocol, hostname)) and at most
+    `maxsize` of them exist for any key. When they are all checked out,
+    acquire() either waits up to `timeout` seconds for one to be released
+    (block=True) or fails right away (block=False); both raise PoolTimeout.
+
+    Idle connections are health-checked before being handed out: sockets idle
+    for longer than `idle_timeout`, that served `max_requests` requests, or
+    that the server closed are discarded and replaced.
+    """
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, block=True, timeout=None,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, max_requests=DEFAULT_MAX_REQUESTS):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.maxsize = maxsize
+        self.block = block
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = {}       # key -> [PooledConnection], most recently used last
+        self._num_open = {}   # key -> number of connections (idle + checked out)
+
+    def acquire(self, key, factory):
+        """
+        Check out a connection for `key`, creating one with `factory()` if
+        the pool has room.
+        :param key: hashable pool key, e.g. (protocol, hostname)
+        :param factory: callable returning a new (unconnected) HTTP connection
+        :return: PooledConnection
+        """
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        with self._cond:
+            while True:
+                pooled = self._pop_healthy(key)
+                if pooled is not None:
+                    break
+                if self._num_open.get(key, 0) < self.maxsize:
+                    self._num_open[key] = self._num_open.get(key, 0) + 1
+                    break
+                if not self.block:
+                    raise exceptions.PoolTimeout("No free connection to %s (maxsize=%d)" % (key, self.maxsize))
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise exceptions.PoolTimeout("Timed out waiting for a connection to %s" % (key,))
+                self._cond.wait(remaining)
+
+        if pooled is None:
+            try:
+                pooled = PooledConnection(key, factory())
+            except Exception:
+                self._discard(key)
+                raise
+        pooled.requests += 1
+        return pooled
+
+    def release(self, pooled, reusable=True):
+        """
+        Return a connection to the pool. Pass reusable=False when the socket
+        is in an unknown state (errors, unread body, server asked to close).
+        """
+        if not reusable:
+            pooled.conn.close()
+            self._discard(pooled.key)
+            return
+        pooled.last_used = time.time()
+        with self._cond:
+            self._idle.setdefault(pooled.key, []).append(pooled)
+            self._cond.notify()
+
+    def clear(self):
+        """Close every idle connection"""
+        with self._cond:
+            idle, self._idle = self._idle, {}
+            for key, pooled_list in idle.items():
+                self._num_open[key] -= len(pooled_list)
+            self._cond.notify_all()
+        for pooled_list in idle.values():
+            for pooled in pooled_list:
+                pooled.conn.close()
+
+    def num_idle(self, key):
+        with self._cond:
+            return len(self._idle.get(key, []))
+
+    def num_open(self, key):
+        with self._cond:
+            return self._num_open.get(key, 0)
+
+    # Private, sort of.
+    #
+    def _pop_healthy(self, key):
+        """Pop the most recently used healthy idle connection. Caller holds the lock."""
+        idle = self._idle.get(key)
+        while idle:
+            pooled = idle.pop()
+            if self._is_healthy(pooled):
+                return pooled
+            pooled.conn.close()
+            self._num_open[key] -= 1
+        return None
+
+    def _is_healthy(self, pooled):
+        if pooled.requests >= self.max_requests:
+            return False
+        if time.time() - pooled.last_used >= self.idle_timeout:
+            return False
+        return not _is_connection_dropped(pooled.conn)
+
+    def _discard(self, key):
+        with self._cond:
+            self._num_open[key] -= 1
+            self._cond.notify()
+
+
+def _is_connection_dropped(conn):
+    """
+    An idle keep-alive socket should have nothing to read; if it is readable
+    the server either closed it (EOF) or sent something unexpected.
+    """
+    sock = getattr(conn, 'sock', None)
+    if sock is None:
+        # Not connected yet (http_client connects lazily)
+        return False
+    try:
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            poller.register(sock, select.POLLIN)
+            return bool(poller.poll(0))
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable)
+    except (ValueError, select.error):
+        # Closed file descriptor
+        return True
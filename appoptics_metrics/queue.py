@@ -1,4 +1,32 @@
 import copy
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from appoptics_metrics import exceptions
+from appoptics_metrics.columnar import ColumnStore
+from appoptics_metrics.retry import is_connection_error
+
+ON_CIRCUIT_OPEN_RAISE = 'raise'
+ON_CIRCUIT_OPEN_BUFFER = 'buffer'
+
+# What BackgroundQueue.add() does when the buffer is full
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+
+# Merged tag sets a queue keeps before starting over
+MAX_INTERNED_TAG_SETS = 10000
+
+# Encoded size of a chunk without measurements: {"measurements":[]}
+CHUNK_OVERHEAD = 19
+
+DEFAULT_FLUSH_INTERVAL = 10
+DEFAULT_MAX_BUFFER = 100000
+
+log = logging.getLogger("appoptics-metrics")
 
 class Queue(object):
     """Sending small amounts of measurements in a single HTTP request
@@ -15,17 +43,84 @@ class Queue(object):
     Tagged measurements have a 'measurements' key, whose value is a list of dict measurements.
 
     When the user sends a .submit() we iterate over the list of chunks and
-    send one at a time.
+    send one at a time, or up to `concurrency` at a time on a thread pool
+    (the connection's pool_maxsize bounds the sockets they share).
+
+    on_circuit_open decides what submit() does when the connection's circuit
+    breaker is open: 'raise' the CircuitOpenError, 'buffer' the unsent
+    chunks until the next submit(), or a callable that receives the list of
+    unsent chunks (the queue is then emptied).
+
+    Each chunk is dropped from the queue as soon as it was posted, so only
+    the chunks that failed or were not tried stay queued. When several
+    chunks sent concurrently failed, submit() raises a SubmitError listing
+    all of them. submit() returns a SubmitReport of the chunks sent and
+    failed, also kept in .last_report when it raised.
+
+    With coalesce=True, a measurement of a series (name and tags) already
+    queued for the same time is merged into it: a single entry keeps the
+    sum, count, min and max. With coalesce_period, times are rounded down to
+    a multiple of that many seconds (measurements without a time get the
+    current one), so that a series sends one entry per period. The other
+    properties are those of the first measurement.
+
+    With compact=True, tagged measurements are kept in a ColumnStore (tens
+    of bytes each) instead of dicts, and turned into chunks as they are
+    submitted; self.tagged_chunks then only holds the chunks not sent yet.
+
+    A chunk holds up to MAX_MEASUREMENTS_PER_CHUNK measurements. With
+    max_body_size, a chunk is also closed before its JSON encoding (before
+    compression) would grow past that many bytes; each tagged measurement is
+    then encoded once more when it is added, to know its size. With
+    adaptive=True (or an AdaptiveChunkSize), the number of measurements per
+    chunk follows the latency and errors of the requests.
+
+    With a Spool, chunks are written to disk as they fill up and on
+    submit(), then sent from the spool in order and removed from it once
+    the API accepted them; what could not be sent is tried again by the next
+    submit(), even after a restart. With drain_rate, a spool thread posts
+    them instead (at most drain_rate chunks per second), and submit() only
+    writes to the spool. concurrency does not apply to spooled chunks.
     """
     MAX_MEASUREMENTS_PER_CHUNK = 300  # based docs; on POST /metrics
 
-    def __init__(self, connection, auto_submit_count=None, tags=None):
+    def __init__(self, connection, auto_submit_count=None, tags=None, on_circuit_open=ON_CIRCUIT_OPEN_RAISE,
+                 concurrency=1, coalesce=False, coalesce_period=None, compact=False, max_body_size=None,
+                 adaptive=False, spool=None, drain_rate=None):
+        if on_circuit_open not in (ON_CIRCUIT_OPEN_RAISE, ON_CIRCUIT_OPEN_BUFFER) and not callable(on_circuit_open):
+            raise ValueError("on_circuit_open must be 'raise', 'buffer' or a callable")
         tags = tags or {}
         self.connection = connection
         self.tags = dict(tags)
         self.chunks = []
         self.tagged_chunks = []
+        # Measurements in chunks and tagged_chunks, so that add() does not count them
+        self._queued = 0
         self.auto_submit_count = auto_submit_count
+        self.on_circuit_open = on_circuit_open
+        self.concurrency = concurrency
+        self.coalesce = coalesce or bool(coalesce_period)
+        self.coalesce_period = coalesce_period
+        # (name, tags, time) -> the queued measurement of that series
+        self._coalesced = {}
+        self._store = ColumnStore() if compact else None
+        self.max_body_size = max_body_size
+        if adaptive is True:
+            adaptive = AdaptiveChunkSize(maximum=self.MAX_MEASUREMENTS_PER_CHUNK)
+        self.adaptive = adaptive or None
+        # The last tagged chunk and its encoded size
+        self._chunk_bytes = (None, 0)
+        self.last_report = None
+        self.spool = spool
+        # Measurements spooled since the last submit()
+        self._spooled = 0
+        if spool is not None and drain_rate is not None:
+            spool.start_drain(connection, rate=drain_rate or None)
+        # Measurement tags -> the inherited tags merged with them, shared by
+        # the measurements; valid for copies of the connection and queue tags
+        # in _tags_state
+        self._interned_tags = {}
+        self._tags_state = None
 
     # Get a shallow copy of the top-level tag set
     def get_tags(self):
@@ -41,7 +136,7 @@ class Queue(object):
 
     def add(self, name, value, type='gauge', **query_props):
         """add measurements to the Q"""
-        if 'tags' in query_props or len(self.tags) > 0 or len(self.connection.get_tags()) > 0:
+        if 'tags' in query_props or len(self.tags) > 0 or len(self.connection.tags) > 0:
             self.add_tagged(name, value, **query_props)
         else:  # No tags found
             raise Exception('At least one tag is needed.')
@@ -63,8 +158,7 @@ class Queue(object):
         inherit_tags = query_props.pop('inherit_tags', False)
         tags = query_props.get('tags', {})
         if inherit_tags or tags == {}:
-            inheritted_tags = dict(self.connection.get_tags(), **self.get_tags())
-            query_props['tags'] = dict(inheritted_tags, **tags)
+            query_props['tags'] = self._inherited_tags(tags)
 
         for pn, v in query_props.items():
             nm[pn] = v
@@ -78,10 +172,13 @@ class Queue(object):
         # Find measure_time, if any
         mt = aggregator.get_measure_time()
 
+        legacy = []
         for name in cloned_measurements:
             nm = cloned_measurements[name]
             # Set metric name
             nm['name'] = name
+            legacy.append(nm)
+        for nm in legacy + aggregator.percentile_measurements(tagged=False):
             # Set measure_time
             if mt:
                 nm['time'] = mt
@@ -90,18 +187,21 @@ class Queue(object):
                 nm['source'] = aggregator.source
             self._add_measurement('gauge', nm)
 
+        tagged = []
         tagged_measurements = dict(aggregator.tagged_measurements)
-        for name in tagged_measurements:
-            nm = tagged_measurements[name]
+        for key in tagged_measurements:
+            nm = tagged_measurements[key]
 
-            nm['name'] = name
+            # Series added with tags know their name
+            nm.setdefault('name', key)
+            tagged.append(nm)
+        for nm in tagged + aggregator.percentile_measurements():
             if mt:
                 nm['time'] = mt
 
+            # The tags of a series are added to the aggregator's
             if aggregator.tags:
-                if 'tags' not in nm:
-                    nm['tags'] = {}
-                nm['tags'].update(aggregator.tags)
+                nm['tags'] = dict(aggregator.tags, **nm.get('tags', {}))
 
             self._add_tagged_measurement(nm)
 
@@ -110,14 +210,17 @@ class Queue(object):
 
         self._auto_submit_if_necessary()
 
-    def submit(self):
-        for c in self.chunks:
-            self.connection._mexe("measurements", method="POST", query_props=c)
-        self.chunks = []
-
-        for chunk in self.tagged_chunks:
-            self.connection._mexe("measurements", method="POST", query_props=chunk)
-        self.tagged_chunks = []
+    def submit(self, retry_policy=None):
+        """
+        Send the queued measurements
+        :param retry_policy: RetryPolicy overriding the connection's one for these requests
+        :return: SubmitReport
+        """
+        # What is not sent is not merged into anymore
+        self._coalesced = {}
+        self.last_report = report = SubmitReport()
+        self._post_queued(retry_policy)
+        return report
 
     def __enter__(self):
         return self
@@ -127,6 +230,152 @@ class Queue(object):
 
     # Private, sort of.
     #
+    def _post_queued(self, retry_policy):
+        if self.spool is not None:
+            self._post_spooled(retry_policy)
+            return
+        try:
+            while True:
+                if self._store:
+                    # Only build the chunks about to be sent
+                    self.tagged_chunks.extend(self._pop_stored_chunks(self.concurrency))
+                    self._count_queued()
+                if self.concurrency > 1 and len(self.chunks) + len(self.tagged_chunks) > 1:
+                    self._submit_concurrently(retry_policy)
+                else:
+                    self._submit_chunks(self.chunks, retry_policy)
+                    self._submit_chunks(self.tagged_chunks, retry_policy)
+                if not self._store:
+                    break
+        except exceptions.CircuitOpenError as e:
+            self._circuit_open(e)
+
+    def _post_spooled(self, retry_policy):
+        self._spool_queued()
+        self._spooled = 0
+        if self.spool.draining:
+            return
+        try:
+            self.spool.drain(lambda chunk: self._post_chunk(chunk, retry_policy))
+        except exceptions.CircuitOpenError:
+            # The chunks wait in the spool anyway
+            if self.on_circuit_open == ON_CIRCUIT_OPEN_RAISE:
+                raise
+
+    def _spool_queued(self):
+        """Move the queued chunks to the spool"""
+        chunks = self.chunks + self.tagged_chunks
+        if self._store:
+            chunks += self._pop_stored_chunks()
+        for chunk in chunks:
+            self.spool.append(hoisted(chunk))
+            self._spooled += len(chunk.get('measurements', ()))
+        self.chunks = []
+        self.tagged_chunks = []
+        self._queued = 0
+        # Merging into them would not change the spool
+        self._coalesced = {}
+
+    def _submit_chunks(self, chunks, retry_policy):
+        # Chunks are dropped once sent, so a failure leaves only the unsent ones
+        while chunks:
+            self._post_chunk(chunks[0], retry_policy)
+            self._queued -= len(chunks[0]['measurements'])
+            del chunks[0]
+
+    def _submit_concurrently(self, retry_policy):
+        chunks, tagged_chunks = self.chunks, self.tagged_chunks
+        executor = ThreadPoolExecutor(max_workers=min(self.concurrency, len(chunks) + len(tagged_chunks)))
+        try:
+            futures = [executor.submit(self._post_chunk, c, retry_policy) for c in chunks + tagged_chunks]
+        finally:
+            executor.shutdown(wait=True)
+        failed = [(c, f.exception()) for c, f in zip(chunks + tagged_chunks, futures) if f.exception()]
+        failed_ids = set(id(c) for c, _ in failed)
+        self.chunks = [c for c in chunks if id(c) in failed_ids]
+        self.tagged_chunks = [c for c in tagged_chunks if id(c) in failed_ids]
+        self._count_queued()
+        self._raise_submit_errors(failed)
+
+    def _post_chunk(self, chunk, retry_policy):
+        report = self.last_report
+        start = time.time()
+        try:
+            self.connection._mexe("measurements", method="POST", query_props=hoisted(chunk),
+                                  retry_policy=retry_policy)
+        except Exception as e:
+            if self.adaptive is not None:
+                self.adaptive.record(len(chunk['measurements']), time.time() - start, e)
+            if report is not None:
+                report.failed.append((chunk, e))
+            raise
+        if self.adaptive is not None:
+            self.adaptive.record(len(chunk['measurements']), time.time() - start)
+        if report is not None:
+            report.sent.append(chunk)
+
+    def _pop_stored_chunks(self, count=None):
+        if not self.max_body_size:
+            return self._store.pop_chunks(self._chunk_size(), count)
+        return self._store.pop_chunks(self._chunk_size(), count, max_bytes=self.max_body_size - CHUNK_OVERHEAD,
+                                      sizer=self._measurement_size)
+
+    def _chunk_size(self):
+        """The max number of measurements in a chunk"""
+        if self.adaptive is not None:
+            return self.adaptive.size
+        return self.MAX_MEASUREMENTS_PER_CHUNK
+
+    def _measurement_size(self, nm):
+        # Its share of the chunk's body, with the comma
+        return len(self.connection.codec.dumps(nm)) + 1
+
+    def _raise_submit_errors(self, failed):
+        """Raise the error of the (chunk, error) pairs that failed, or a SubmitError for several"""
+        if not failed:
+            return
+        errors = [e for _, e in failed]
+        if len(errors) == 1 or all(isinstance(e, exceptions.CircuitOpenError) for e in errors):
+            raise errors[0]
+        raise exceptions.SubmitError(failed)
+
+    def _circuit_open(self, error):
+        if self.on_circuit_open == ON_CIRCUIT_OPEN_RAISE:
+            raise error
+        if self.on_circuit_open != ON_CIRCUIT_OPEN_BUFFER:
+            unsent = self.chunks + self.tagged_chunks
+            if self._store:
+                unsent += self._pop_stored_chunks()
+            self.chunks = []
+            self.tagged_chunks = []
+            self._queued = 0
+            self.on_circuit_open(unsent)
+
+    def _inherited_tags(self, tags):
+        """The connection and queue tags updated with tags, interned: the
+        merge is done once per distinct tag set, and the measurements share it.
+        The cache is compared by contents with the connection and queue tags,
+        so changing those in place is seen too.
+        """
+        connection = self.connection
+        last = self._tags_state
+        if last is None or last[0] != connection.tags or last[1] != self.tags:
+            self._tags_state = (dict(connection.tags), dict(self.tags))
+            self._interned_tags = {}
+        try:
+            key = frozenset(tags.items())
+        except TypeError:
+            # Unhashable values
+            return dict(connection.tags, **dict(self.tags, **tags))
+        merged = self._interned_tags.get(key)
+        if merged is None:
+            if len(self._interned_tags) >= MAX_INTERNED_TAG_SETS:
+                self._interned_tags = {}
+            merged = dict(connection.tags, **self.tags)
+            merged.update(tags)
+            self._interned_tags[key] = merged
+        return merged
+
     def _auto_submit_if_necessary(self):
         if self.auto_submit_count and self._num_measurements_in_queue() >= self.auto_submit_count:
             self.submit()
@@ -138,12 +387,80 @@ class Queue(object):
         if type == 'gauge':
             type = 'measurement'
         self.chunks[-1][type + 's'].append(nm)
+        self._queued += 1
 
     def _add_tagged_measurement(self, nm):
-        if (not self.tagged_chunks or
-           self._num_measurements_in_current_chunk(tagged=True) == self.MAX_MEASUREMENTS_PER_CHUNK):
-            self.tagged_chunks.append({'measurements': []})
-        self.tagged_chunks[-1]['measurements'].append(nm)
+        if self.coalesce:
+            self._coalesce(nm, self._append_tagged_measurement)
+        else:
+            self._append_tagged_measurement(nm)
+
+    def _append_tagged_measurement(self, nm):
+        """Queue nm, returning what _coalesce merges into later"""
+        if self._store is not None:
+            return self._store.append(nm)
+        chunk = self.tagged_chunks[-1] if self.tagged_chunks else None
+        size = self._measurement_size(nm) if self.max_body_size else 0
+        if chunk is None or len(chunk['measurements']) >= self._chunk_size() or \
+                (size and chunk['measurements'] and self._chunk_body_size(chunk) + size > self.max_body_size):
+            if self.spool is not None and chunk is not None:
+                # Full chunks wait on disk
+                self._spool_queued()
+            chunk = {'measurements': []}
+            self.tagged_chunks.append(chunk)
+            self._chunk_bytes = (chunk, CHUNK_OVERHEAD)
+        chunk['measurements'].append(nm)
+        self._queued += 1
+        if size:
+            self._chunk_bytes = (chunk, self._chunk_body_size(chunk) + size)
+        return nm
+
+    def _chunk_body_size(self, chunk):
+        last, size = self._chunk_bytes
+        if last is not chunk:
+            # e.g. kept after a failed submit
+            size = len(self.connection.codec.dumps(chunk))
+            self._chunk_bytes = (chunk, size)
+        return size
+
+    def _coalesce(self, nm, append):
+        """Merge nm into the queued measurement of its series and time, if
+        any. Otherwise append(nm) queues it and returns what to merge into.
+        """
+        if self.coalesce_period:
+            t = nm.get('time') or time.time()
+            nm['time'] = int(t // self.coalesce_period * self.coalesce_period)
+        key = self._coalesce_key(nm)
+        queued = self._coalesced.get(key)
+        if queued is None:
+            if nm['count'] == 1:
+                nm.setdefault('min', nm['sum'])
+                nm.setdefault('max', nm['sum'])
+            queued = append(nm)
+            if queued is not None:
+                self._coalesced[key] = queued
+            return
+        if nm['count'] == 1:
+            low = high = nm['sum']
+        else:
+            low, high = nm.get('min'), nm.get('max')
+        if not isinstance(queued, dict):
+            # A row of the ColumnStore
+            self._store.merge(queued, nm, low, high)
+            return
+        queued['sum'] += nm['sum']
+        queued['count'] += nm['count']
+        if 'min' in queued:
+            if low is None or high is None:
+                # Unknown, they are optional
+                del queued['min'], queued['max']
+            else:
+                queued['min'] = min(queued['min'], low)
+                queued['max'] = max(queued['max'], high)
+
+    @staticmethod
+    def _coalesce_key(nm):
+        return nm['name'], frozenset(nm.get('tags', {}).items()), nm.get('time')
 
     def _current_chunk(self, tagged=False):
         if tagged:
@@ -164,11 +481,437 @@ class Queue(object):
             else:
                 return 0
 
+    def _count_queued(self):
+        # After the chunks were replaced, e.g. by the ones that failed
+        self._queued = sum(len(c['measurements']) for c in self.chunks + self.tagged_chunks)
+
+    def _num_measurements_in_queue(self):
+        num = self._queued
+        if self._store:
+            num += len(self._store)
+        return num + self._spooled
+
+
+class SubmitReport(object):
+    """What a submit() did: the chunks it .sent, and the (chunk, error)
+    pairs that .failed (those are still queued, unless on_circuit_open was
+    a callable or the spool dropped them as refused). Chunks not tried because an earlier one failed are in
+    neither.
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.failed = []
+
+    @property
+    def ok(self):
+        return not self.failed
+
+    @property
+    def measurements_sent(self):
+        return sum(len(c['measurements']) for c in self.sent)
+
+    @property
+    def measurements_failed(self):
+        return sum(len(c['measurements']) for c, _ in self.failed)
+
+    def __repr__(self):
+        return "<SubmitReport sent=%d failed=%d>" % (len(self.sent), len(self.failed))
+
+
+class AdaptiveChunkSize(object):
+    """Adjusts the number of measurements per chunk to the way the API copes.
+
+    The size grows by `step` after each full chunk sent within
+    `target_latency` seconds, and shrinks in proportion when a request takes
+    longer, or by half when it fails from overload (5xx, 413, 429, timeouts
+    and connection errors). It stays within [minimum, maximum]. One instance
+    may be shared by several queues.
+    """
+
+    def __init__(self, minimum=10, maximum=Queue.MAX_MEASUREMENTS_PER_CHUNK, initial=None, target_latency=1.0,
+                 step=None):
+        if not 0 < minimum <= maximum:
+            raise ValueError("0 < minimum <= maximum is required")
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.step = step or max(1, maximum // 10)
+        self.size = min(max(initial or maximum, minimum), maximum)
+        self._lock = threading.Lock()
+
+    def record(self, count, latency, error=None):
+        """Account for a request posting `count` measurements"""
+        with self._lock:
+            if error is not None:
+                if _is_overload(error):
+                    self.size = max(self.minimum, self.size // 2)
+            elif latency > self.target_latency:
+                factor = max(0.5, self.target_latency / latency)
+                self.size = max(self.minimum, int(self.size * factor))
+            elif count >= self.size:
+                self.size = min(self.maximum, self.size + self.step)
+
+
+def _is_overload(error):
+    if isinstance(error, (exceptions.ServerError, exceptions.TooManyRequests)):
+        return True
+    if isinstance(error, exceptions.APIError):
+        # Payload Too Large
+        return error.code == 413
+    return is_connection_error(error)
+
+
+class BackgroundQueue(Queue):
+    """A Queue whose measurements are posted by a sender thread, so add()
+    never waits for the network.
+
+    q = api.new_queue(background=True, tags={'host': 'web-1'})
+    q.add('temperature', 22.1)
+    ...
+    q.close(timeout=5)
+
+    The buffer is flushed every `flush_interval` seconds, as soon as it holds
+    `flush_count` measurements (default: one chunk) and on submit(). It holds
+    up to `max_buffer` measurements; when it is full, add() waits for room
+    (overflow='block', up to `block_timeout` seconds, then raises QueueFull),
+    or the oldest ('drop_oldest') or the new ('drop_newest') measurement is
+    dropped and counted in .dropped.
+
+    Chunks that could not be sent are handed to on_error(error, chunks),
+    which logs them by default, and are in the .failed of the SubmitReport
+    returned by submit(). on_circuit_open='buffer' keeps them for the next
+    flush instead while the circuit breaker is open; they count towards
+    max_buffer, under the same overflow policy.
+    """
+
+    def __init__(self, connection, tags=None, flush_interval=DEFAULT_FLUSH_INTERVAL, flush_count=None,
+                 max_buffer=DEFAULT_MAX_BUFFER, overflow=OVERFLOW_BLOCK, block_timeout=None,
+                 on_circuit_open=ON_CIRCUIT_OPEN_RAISE, on_error=None, retry_policy=None, concurrency=1,
+                 coalesce=False, coalesce_period=None, max_body_size=None, adaptive=False):
+        if overflow not in (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST):
+            raise ValueError("overflow must be 'block', 'drop_oldest' or 'drop_newest'")
+        Queue.__init__(self, connection, tags=tags, on_circuit_open=on_circuit_open, concurrency=concurrency,
+                       coalesce=coalesce, coalesce_period=coalesce_period, max_body_size=max_body_size,
+                       adaptive=adaptive)
+        self.flush_interval = flush_interval
+        self.flush_count = flush_count or self.MAX_MEASUREMENTS_PER_CHUNK
+        self.max_buffer = max_buffer
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.on_error = on_error or _log_send_error
+        self.retry_policy = retry_policy
+        self.dropped = 0
+        self._buffer = deque()
+        # The SubmitReports of the submit() calls waiting, filled by each flush
+        self._reports = []
+        # Measurements kept by the sender while the circuit is open
+        self._kept = 0
+        self._cond = threading.Condition()
+        self._added = 0        # measurements accepted so far
+        self._sent = 0         # how many of them were sent (or given up on)
+        self._flushes = 0      # sends done so far
+        self._flush_requested = False
+        self._closing = False
+        self._deadline = None
+        self._gave_up = False
+        self._thread = threading.Thread(target=self._run, name="appoptics-metrics-sender")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, retry_policy=None, timeout=None):
+        """
+        Flush now and wait until the measurements added so far were sent
+        :param retry_policy: ignored, the queue's retry_policy is used
+        :param timeout: max seconds to wait (None: no limit)
+        :return: a SubmitReport of the flushes done in the meantime, None if
+                 the timeout expired first
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        report = SubmitReport()
+        with self._cond:
+            target = self._added
+            # Kept measurements are only retried by the next flush
+            flushes = self._flushes + 1 if self._kept else 0
+            self._flush_requested = True
+            self._reports.append(report)
+            self._cond.notify_all()
+            try:
+                while (self._sent < target or self._flushes < flushes) and self._thread.is_alive():
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        return None
+                    self._cond.wait(remaining)
+            finally:
+                self._reports.remove(report)
+            return report if self._sent >= target and self._flushes >= flushes else None
+
+    def close(self, timeout=None):
+        """
+        Send what is buffered and stop the sender thread. Chunks still unsent
+        after `timeout` seconds are handed to on_error (a request in flight is
+        not interrupted though). add() raises ValueError from then on.
+        :return: True if the buffer was drained in time
+        """
+        with self._cond:
+            if not self._closing:
+                self._closing = True
+                self._deadline = None if timeout is None else time.time() + timeout
+                self._cond.notify_all()
+        self._thread.join(timeout)
+        return not self._thread.is_alive() and not self._gave_up
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _auto_submit_if_necessary(self):
+        pass
+
+    def _add_measurement(self, type, nm):
+        # The sender thread builds the chunks, all in the tagged format
+        self._put(nm)
+
+    def _add_tagged_measurement(self, nm):
+        self._put(nm)
+
+    def _put(self, nm):
+        with self._cond:
+            if self._closing:
+                raise ValueError("The queue is closed")
+            if self.coalesce:
+                self._coalesce(nm, self._buffer_append)
+            else:
+                self._buffer_append(nm)
+            self._added += 1
+
+    def _buffer_append(self, nm):
+        """Buffer nm, returning None if it was dropped"""
+        # The oldest kept measurements are dropped by the sender instead
+        kept = self._kept if self.overflow != OVERFLOW_DROP_OLDEST else 0
+        if len(self._buffer) + kept >= self.max_buffer:
+            if self.overflow == OVERFLOW_DROP_NEWEST:
+                self.dropped += 1
+                return None
+            if self.overflow == OVERFLOW_DROP_OLDEST:
+                oldest = self._buffer.popleft()
+                self.dropped += 1
+                if self.coalesce and self._coalesced.get(self._coalesce_key(oldest)) is oldest:
+                    # Later measurements of its series must not merge into it
+                    del self._coalesced[self._coalesce_key(oldest)]
+            else:
+                self._wait_for_room()
+        self._buffer.append(nm)
+        if len(self._buffer) == self.flush_count:
+            self._cond.notify_all()
+        return nm
+
+    def _wait_for_room(self):
+        deadline = None if self.block_timeout is None else time.time() + self.block_timeout
+        while len(self._buffer) + self._kept >= self.max_buffer:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                raise exceptions.QueueFull("The queue's buffer stayed full for %ss" % self.block_timeout)
+            self._cond.wait(remaining)
+            if self._closing:
+                raise ValueError("The queue is closed")
+
+    def _run(self):
+        next_flush = time.time() + self.flush_interval
+        while True:
+            with self._cond:
+                while not (self._closing or self._flush_requested or len(self._buffer) >= self.flush_count):
+                    remaining = next_flush - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = list(self._buffer)
+                self._buffer.clear()
+                self._coalesced = {}
+                taken = self._added
+                self._flush_requested = False
+                closing = self._closing
+                # Wake up the writers waiting for room
+                self._cond.notify_all()
+            next_flush = time.time() + self.flush_interval
+            try:
+                self._send(batch)
+            except Exception:
+                log.exception("unexpected error in the metrics sender thread")
+            # Chunks kept while the circuit is open make room for the new
+            # measurements, or hold up the writers with overflow='block'
+            trimmed = self._trim_kept() if self.overflow != OVERFLOW_BLOCK else 0
+            with self._cond:
+                self._sent = taken
+                self._flushes += 1
+                self._kept = self._queued
+                self.dropped += trimmed
+                for report in self._reports:
+                    report.sent.extend(self.last_report.sent)
+                    report.failed.extend(self.last_report.failed)
+                self._cond.notify_all()
+                if not closing or self._buffer:
+                    continue
+            if self.tagged_chunks:
+                # Kept while the circuit was open
+                self._gave_up = True
+                self._give_up(exceptions.CircuitOpenError("The circuit was still open when the queue was closed"))
+            return
+
+    def _send(self, batch):
+        self.last_report = SubmitReport()
+        for nm in batch:
+            self._append_tagged_measurement(nm)
+        try:
+            self._post_queued(self.retry_policy)
+        except Exception as e:
+            if self._past_deadline():
+                self._gave_up = True
+            self._give_up(e)
+
+    def _trim_kept(self):
+        """Drop the oldest or newest kept measurements beyond max_buffer, returning how many"""
+        excess = self._queued - self.max_buffer
+        dropped = 0
+        while excess > 0 and self.tagged_chunks:
+            oldest = self.overflow == OVERFLOW_DROP_OLDEST
+            measurements = self.tagged_chunks[0 if oldest else -1]['measurements']
+            n = min(excess, len(measurements))
+            if oldest:
+                del measurements[:n]
+            else:
+                del measurements[len(measurements) - n:]
+            if not measurements:
+                self.tagged_chunks.pop(0 if oldest else -1)
+            excess -= n
+            dropped += n
+        if dropped:
+            self._queued -= dropped
+            # Its encoded size changed
+            self._chunk_bytes = (None, 0)
+        return dropped
+
+    def _give_up(self, error):
+        unsent = self.chunks + self.tagged_chunks
+        self.chunks = []
+        self.tagged_chunks = []
+        self._queued = 0
+        # Including the chunks not tried after the first failure
+        tried = set(id(c) for c, _ in self.last_report.failed)
+        self.last_report.failed.extend((c, error) for c in unsent if id(c) not in tried)
+        self.on_error(error, unsent)
+
+    def _post_chunk(self, chunk, retry_policy):
+        if self._past_deadline():
+            raise Exception("close() timed out before these measurements were sent")
+        Queue._post_chunk(self, chunk, retry_policy)
+
+    def _past_deadline(self):
+        deadline = self._deadline
+        return deadline is not None and time.time() >= deadline
+
+
+class ThreadSafeQueue(Queue):
+    """A Queue that many threads can add() to at the same time.
+
+    Each thread appends to a buffer of its own (a deque, so no lock is
+    taken); submit() moves the measurements of all the buffers into chunks
+    and posts them, one submit() at a time. Measurements keep their order
+    within a thread, not across threads. With auto_submit_count, the thread
+    adding that measurement submits, unless another one is already at it.
+    """
+
+    def __init__(self, connection, auto_submit_count=None, tags=None, **kwargs):
+        Queue.__init__(self, connection, auto_submit_count=auto_submit_count, tags=tags, **kwargs)
+        self._local = threading.local()
+        self._buffers = []     # (thread, deque)
+        self._buffers_lock = threading.Lock()
+        self._flush_lock = threading.RLock()
+        self._adds = itertools.count(1)
+        self._last_add = 0     # measurements added so far, about
+        self._taken = 0        # how many were moved from the buffers
+
+    def submit(self, retry_policy=None):
+        with self._flush_lock:
+            self._take_buffers()
+            return Queue.submit(self, retry_policy)
+
+    def add_aggregator(self, aggregator):
+        with self._flush_lock:
+            Queue.add_aggregator(self, aggregator)
+
+    def _add_tagged_measurement(self, nm):
+        try:
+            buf = self._local.buffer
+        except AttributeError:
+            buf = self._local.buffer = deque()
+            with self._buffers_lock:
+                self._buffers.append((threading.current_thread(), buf))
+        buf.append(nm)
+        self._last_add = next(self._adds)
+
+    def _add_measurement(self, type, nm):
+        with self._flush_lock:
+            Queue._add_measurement(self, type, nm)
+
+    def _auto_submit_if_necessary(self):
+        if not self.auto_submit_count or self._last_add - self._taken < self.auto_submit_count:
+            return
+        if self._flush_lock.acquire(False):
+            try:
+                self.submit()
+            finally:
+                self._flush_lock.release()
+
+    def _take_buffers(self):
+        """Move the buffered measurements into chunks (flush lock held)"""
+        with self._buffers_lock:
+            buffers = list(self._buffers)
+        for thread, buf in buffers:
+            # Only what is there now: the thread may be appending
+            for _ in range(len(buf)):
+                Queue._add_tagged_measurement(self, buf.popleft())
+                self._taken += 1
+        with self._buffers_lock:
+            # Forget the threads that ended (checked first: they can't append after)
+            self._buffers = [(t, b) for t, b in self._buffers if t.is_alive() or b]
+
     def _num_measurements_in_queue(self):
-        num = 0
-        if self.chunks:
-            num += self._num_measurements_in_current_chunk() + self.MAX_MEASUREMENTS_PER_CHUNK * (len(self.chunks) - 1)
-        if self.tagged_chunks:
-            num += (self._num_measurements_in_current_chunk(tagged=True) +
-                    self.MAX_MEASUREMENTS_PER_CHUNK * (len(self.tagged_chunks) - 1))
-        return num
+        with self._buffers_lock:
+            buffered = sum(len(b) for _, b in self._buffers)
+        return Queue._num_measurements_in_queue(self) + buffered
+
+
+def hoisted(chunk):
+    """The payload of a chunk, with the tags and the time that all its
+    measurements share moved to the top-level `tags` and `time`, which the
+    API applies to the measurements without their own
+    """
+    measurements = chunk.get('measurements')
+    if not measurements or 'tags' in chunk or 'time' in chunk:
+        return chunk
+    first = measurements[0]
+    tags = first.get('tags')
+    hoist_tags = bool(tags) and all(m.get('tags') is tags or m.get('tags') == tags for m in measurements)
+    t = first.get('time')
+    hoist_time = t is not None and all(m.get('time') == t for m in measurements)
+    if not (hoist_tags or hoist_time):
+        return chunk
+    payload = dict(chunk)
+    payload['measurements'] = stripped = []
+    for m in measurements:
+        m = dict(m)
+        if hoist_tags:
+            del m['tags']
+        if hoist_time:
+            del m['time']
+        stripped.append(m)
+    if hoist_tags:
+        payload['tags'] = tags
+    if hoist_time:
+        payload['time'] = t
+    return payload
+
+
+def _log_send_error(error, chunks):
+    log.error("dropped %d measurements that could not be sent: %s",
+              sum(len(c['measurements']) for c in chunks), error)
@@ -0,0 +1,285 @@
+"""
+A local relay aggregating the measurements of many processes (e.g. the
+forked workers of gunicorn or uwsgi) and forwarding them through a single
+queue and connection pool.
+
+    python -m appoptics_metrics.relay --token $TOKEN --listen 127.0.0.1:8126 --tag host=web-1
+
+Workers send lines over UDP or a unix datagram socket with a RelayClient:
+
+    client = RelayClient('127.0.0.1:8126')
+    client.add('requests.latency', 12.5, tags={'endpoint': '/items'})
+
+One line per measurement, several lines per datagram:
+
+    <name>:<value>[|#<tag>=<value>,...][|@<unix time>]
+
+The relay keeps the sum, count, min and max of each series (name and tags)
+per period in a WindowedAggregator, and queues the periods that ended once
+they are over. Lines for a period already sent are dropped (counted in
+.aggregator.late).
+"""
+import argparse
+import logging
+import os
+import select
+import signal
+import socket
+import stat
+import sys
+import time
+from appoptics_metrics import connect
+from appoptics_metrics.aggregator import WindowedAggregator
+
+DEFAULT_ADDRESS = '127.0.0.1:8126'
+DEFAULT_PERIOD = 10
+# Seconds to wait for the late datagrams of a period before sending it
+FLUSH_DELAY = 1.0
+MAX_DATAGRAM = 65507
+RECEIVE_BUFFER = 4 * 1024 * 1024
+
+log = logging.getLogger("appoptics-metrics")
+
+
+def format_line(name, value, tags=None, time=None):
+    """The line sending a measurement to a relay"""
+    tags = dict((str(k), str(v)) for k, v in (tags or {}).items())
+    for text in [name] + list(tags.keys()) + list(tags.values()):
+        if any(c in text for c in ':|#,=@\n'):
+            raise ValueError("%r can't contain any of : | # , = @ or newlines" % text)
+    line = "%s:%s" % (name, repr(value) if isinstance(value, float) else int(value))
+    if tags:
+        line += "|#" + ",".join("%s=%s" % kv for kv in sorted(tags.items()))
+    if time is not None:
+        line += "|@%d" % time
+    return line
+
+
+def parse_line(line):
+    """(name, value, tags, time) from a line of format_line()"""
+    fields = line.strip().split('|')
+    name, _, value = fields[0].rpartition(':')
+    if not name:
+        raise ValueError("no name in %r" % line)
+    try:
+        value = int(value)
+    except ValueError:
+        value = float(value)
+    tags = {}
+    t = None
+    for field in fields[1:]:
+        if field.startswith('#'):
+            for pair in field[1:].split(','):
+                k, sep, v = pair.partition('=')
+                if not sep or not k:
+                    raise ValueError("bad tag %r in %r" % (pair, line))
+                tags[k] = v
+        elif field.startswith('@'):
+            t = int(field[1:])
+        else:
+            raise ValueError("unknown field %r in %r" % (field, line))
+    return name, value, tags, t
+
+
+def _socket_address(address):
+    """(family, address) of 'host:port', (host, port) or a unix socket path"""
+    if isinstance(address, tuple):
+        host, port = address
+    elif '/' in address:
+        return socket.AF_UNIX, address
+    else:
+        host, _, port = address.rpartition(':')
+        host = host.strip('[]')
+    info = socket.getaddrinfo(host, int(port), 0, socket.SOCK_DGRAM)[0]
+    return info[0], info[4]
+
+
+class RelayClient(object):
+    """Sends measurements to a relay, fire and forget: add() does not wait
+    and ignores network errors (counted in .dropped)
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, tags=None):
+        family, self.address = _socket_address(address)
+        self.tags = dict(tags or {})
+        self.dropped = 0
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def add(self, name, value, tags=None, time=None):
+        """Send a measurement; tags are added to the client's"""
+        line = format_line(name, value, dict(self.tags, **tags) if tags else self.tags, time)
+        try:
+            self.sock.sendto(line.encode('utf-8'), self.address)
+        except socket.error:
+            # No relay, or its socket buffer is full
+            self.dropped += 1
+
+    def close(self):
+        self.sock.close()
+
+
+class Relay(object):
+    """Aggregates the lines received on `address` per `period` seconds and
+    forwards them through a BackgroundQueue of `connection`, created with
+    `tags` and queue_kwargs
+    """
+
+    def __init__(self, connection, address=DEFAULT_ADDRESS, period=DEFAULT_PERIOD, tags=None, **queue_kwargs):
+        self.period = period
+        queue_kwargs.setdefault('flush_interval', period)
+        self.queue = connection.new_queue(background=True, tags=tags, **queue_kwargs)
+        self.received = 0
+        self.malformed = 0
+        # The lines of a period are taken until it is flushed
+        self.aggregator = WindowedAggregator(connection, period=period, lateness=FLUSH_DELAY)
+        self._running = False
+        self._closed = False
+        family, self.address = _socket_address(address)
+        self._path = self.address if family == socket.AF_UNIX else None
+        if self._path and os.path.exists(self.address) and \
+                stat.S_ISSOCK(os.stat(self.address).st_mode):
+            # Left by a relay that died
+            os.remove(self.address)
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+        except socket.error:
+            pass
+        self.sock.bind(self.address)
+        if not self._path:
+            # The port, if 0 was asked
+            self.address = self.sock.getsockname()
+        self.sock.setblocking(False)
+
+    def add(self, name, value, tags=None, time=None):
+        self.aggregator.add_tagged(name, value, tags, time)
+
+    def handle(self, data):
+        """Aggregate the lines of a datagram"""
+        for line in data.decode('utf-8', 'replace').splitlines():
+            if not line.strip():
+                continue
+            try:
+                name, value, tags, t = parse_line(line)
+            except ValueError as e:
+                self.malformed += 1
+                log.debug("relay: %s", e)
+                continue
+            self.received += 1
+            self.add(name, value, tags, t)
+
+    def flush(self, force=False):
+        """Queue the periods that ended (all of them with force), and have the queue send them"""
+        windows = self.aggregator.pop_closed(force)
+        if not windows:
+            return
+        try:
+            while windows:
+                series = windows[0].tagged_measurements
+                for key in list(series):
+                    m = series[key]
+                    # The relay's tags are added to those of the line
+                    self.queue.add(m.get('name', key), m['sum'], count=m['count'], min=m['min'], max=m['max'],
+                                   time=windows[0].measure_time, tags=m.get('tags', {}), inherit_tags=True)
+                    # Only once queued
+                    del series[key]
+                windows.pop(0)
+        finally:
+            # What could not be queued is tried again on the next flush
+            for window in windows:
+                self.aggregator.windows[window.measure_time] = window
+        self.queue.submit(timeout=0)
+
+    def serve_forever(self):
+        """Receive, aggregate and forward until stop(), then send everything and close"""
+        self._running = True
+        next_flush = self._next_flush()
+        try:
+            while self._running:
+                timeout = min(max(next_flush - _now(), 0), 0.5)
+                readable = select.select([self.sock], [], [], timeout)[0]
+                if readable:
+                    self._receive()
+                if _now() >= next_flush:
+                    self.flush()
+                    next_flush = self._next_flush()
+        finally:
+            self.close()
+
+    def stop(self):
+        """Have serve_forever() return"""
+        self._running = False
+
+    def close(self, timeout=10):
+        """Send everything aggregated and close the socket
+        :return: False if the queue could not be emptied within timeout
+        """
+        if self._closed:
+            return True
+        self._closed = True
+        self.sock.close()
+        if self._path and os.path.exists(self._path):
+            os.remove(self._path)
+        self.flush(force=True)
+        return self.queue.close(timeout)
+
+    # Private
+    #
+    def _next_flush(self):
+        return (int(_now()) // self.period + 1) * self.period + FLUSH_DELAY
+
+    def _receive(self):
+        # Up to a bounded number of datagrams, to flush on time
+        for _ in range(10000):
+            try:
+                data = self.sock.recv(MAX_DATAGRAM)
+            except socket.error:
+                return
+            self.handle(data)
+
+
+def _now():
+    return time.time()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m appoptics_metrics.relay",
+                                     description="Aggregate measurements sent by local processes and forward them "
+                                                 "to AppOptics.")
+    parser.add_argument('--token', default=os.environ.get('APPOPTICS_TOKEN'),
+                        help="API token (default: $APPOPTICS_TOKEN)")
+    parser.add_argument('--listen', default=DEFAULT_ADDRESS,
+                        help="host:port to listen on over UDP, or the path of a unix socket (default: %(default)s)")
+    parser.add_argument('--period', type=int, default=DEFAULT_PERIOD,
+                        help="seconds aggregated in a measurement (default: %(default)s)")
+    parser.add_argument('--tag', action='append', default=[], metavar='NAME=VALUE',
+                        help="tag added to every measurement, can be repeated")
+    parser.add_argument('--hostname', help="API host name")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+    if not args.token:
+        parser.error("--token or $APPOPTICS_TOKEN is needed")
+    tags = {}
+    for tag in args.tag:
+        k, sep, v = tag.partition('=')
+        if not sep:
+            parser.error("bad tag %r, use NAME=VALUE" % tag)
+        tags[k] = v
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    kwargs = {'hostname': args.hostname} if args.hostname else {}
+    relay = Relay(connect(args.token, **kwargs), args.listen, period=args.period, tags=tags)
+    log.info("relay listening on %s", args.listen)
+
+    def stop(signum, frame):
+        relay.stop()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    relay.serve_forever()
+    log.info("relay stopped, %d lines received, %d malformed, %d out of their period", relay.received,
+             relay.malformed, relay.aggregator.late + relay.aggregator.early)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
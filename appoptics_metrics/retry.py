@@ -0,0 +1,150 @@
+import random
+import socket
+import ssl
+import time
+import email.utils
+from six.moves import http_client
+from appoptics_metrics import exceptions
+
+try:
+    # Raised by transports for a broken or refused connection
+    CONNECTION_ERROR = ConnectionError
+except NameError:
+    # Python 2
+    CONNECTION_ERROR = socket.error
+
+# Errors raised when a socket breaks (reset, broken pipe, dropped by the
+# server, ...). Other OSErrors (certificates, DNS, permissions) are not
+# transient. BadStatusLine covers RemoteDisconnected.
+CONNECTION_ERRORS = (CONNECTION_ERROR, socket.timeout, http_client.ResponseNotReady,
+                     http_client.CannotSendRequest, http_client.BadStatusLine, http_client.IncompleteRead)
+
+
+def is_connection_error(error):
+    # ssl.SSLError is a socket.error on Python 2
+    return isinstance(error, CONNECTION_ERRORS) and not isinstance(error, ssl.SSLError)
+
+JITTER_NONE = None
+JITTER_FULL = 'full'
+JITTER_DECORRELATED = 'decorrelated'
+
+
+class RetryPolicy(object):
+    """Decides whether a failed request is retried and how long to wait first.
+
+    :param max_attempts: Total number of attempts, including the first one
+    :param backoff_base: Delay (seconds) before the first retry, doubled on each retry
+    :param max_backoff: Upper bound for a single delay
+    :param jitter: None (plain exponential backoff), 'full' (uniform between
+                   0 and the exponential delay) or 'decorrelated' (uniform
+                   between backoff_base and 3 times the previous delay)
+    :param deadline: Total time budget (seconds) for all attempts and delays
+                     of a call; no retry is started that would end past it
+    :param retry_statuses: HTTP statuses worth retrying. None means 429 and
+                           every 5xx
+    :param respect_retry_after: Wait at least as long as the Retry-After
+                                header of 429/503 responses asks
+    :param max_retry_after: Longest Retry-After (seconds) waited for, max_backoff
+                            by default; the call fails when the server asks for more
+    :param retry_on_timeout: Retry when the socket timed out. The request may
+                             have been processed, so a POST can be duplicated
+    :param retry_on_connection_error: Retry when the connection was reset or refused
+    """
+
+    def __init__(self, max_attempts=5, backoff_base=1.0, max_backoff=30.0, jitter=JITTER_FULL, deadline=None,
+                 retry_statuses=None, respect_retry_after=True, max_retry_after=None, retry_on_timeout=True,
+                 retry_on_connection_error=True):
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1")
+        if jitter not in (JITTER_NONE, JITTER_FULL, JITTER_DECORRELATED):
+            raise ValueError("Unsupported jitter: {}".format(jitter))
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.deadline = deadline
+        self.retry_statuses = retry_statuses
+        self.respect_retry_after = respect_retry_after
+        self.max_retry_after = max_backoff if max_retry_after is None else max_retry_after
+        self.retry_on_timeout = retry_on_timeout
+        self.retry_on_connection_error = retry_on_connection_error
+
+    def start(self):
+        """Start tracking the attempts of one call"""
+        return RetryState(self)
+
+    def is_retryable(self, error):
+        if isinstance(error, exceptions.APIError):
+            if self.retry_statuses is None:
+                return error.code == 429 or error.code >= 500
+            return error.code in self.retry_statuses
+        if isinstance(error, socket.timeout):
+            return self.retry_on_timeout
+        if is_connection_error(error):
+            return self.retry_on_connection_error
+        return False
+
+    def backoff(self, retry_number, previous=None):
+        """Delay before retry number `retry_number` (1 for the first retry)"""
+        if self.jitter == JITTER_DECORRELATED:
+            previous = previous or self.backoff_base
+            delay = random.uniform(self.backoff_base, previous * 3)
+        else:
+            delay = self.backoff_base * 2 ** (retry_number - 1)
+            if self.jitter == JITTER_FULL:
+                delay = random.uniform(0, min(delay, self.max_backoff))
+        return min(delay, self.max_backoff)
+
+
+# Fail on the first error, e.g. for callers that have their own retry logic
+NO_RETRY = RetryPolicy(max_attempts=1)
+
+
+class RetryState(object):
+    """The attempts made so far for one call under a RetryPolicy"""
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.attempts = 1
+        self.started = time.time()
+        self.last_delay = None
+
+    def next_delay(self, error):
+        """
+        Return how long to sleep before the next attempt, or None if the call
+        should fail with `error`.
+        """
+        policy = self.policy
+        if not policy.is_retryable(error) or self.attempts >= policy.max_attempts:
+            return None
+
+        delay = policy.backoff(self.attempts, self.last_delay)
+        retry_after = getattr(error, 'retry_after', None)
+        if policy.respect_retry_after and retry_after is not None:
+            if retry_after > policy.max_retry_after:
+                # Not worth blocking the caller that long
+                return None
+            delay = max(delay, retry_after)
+
+        if policy.deadline is not None and time.time() - self.started + delay >= policy.deadline:
+            return None
+
+        self.attempts += 1
+        self.last_delay = delay
+        return delay
+
+
+def parse_retry_after(value, now=None):
+    """
+    Parse a Retry-After header (delay in seconds or HTTP date) into seconds.
+    Returns None if missing or malformed.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0, email.utils.mktime_tz(parsed) - (now if now is not None else time.time()))
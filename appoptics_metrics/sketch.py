@@ -0,0 +1,153 @@
+"""
+DDSketch, a quantile sketch with a relative error guarantee
+(https://arxiv.org/abs/1908.10693).
+
+    sketch = DDSketch(relative_accuracy=0.01)
+    for latency in latencies:
+        sketch.add(latency)
+    sketch.quantile(0.99)
+
+Values are counted in logarithmic bins, so that any quantile is known
+within relative_accuracy of its value, with a fixed amount of memory (at
+most max_bins bins per sign; past that the bins of the smallest magnitudes
+are collapsed). Sketches with the same relative_accuracy merge exactly,
+e.g. those of several threads, or of several processes through to_dict()
+and from_dict().
+"""
+import math
+import sys
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+DEFAULT_MAX_BINS = 2048
+
+
+class DDSketch(object):
+    """The distribution of values added, see the module"""
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY, max_bins=DEFAULT_MAX_BINS):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._multiplier = 1 / math.log(self._gamma)
+        # Smaller magnitudes are counted as zeros
+        self._min_indexable = sys.float_info.min * self._gamma
+        self.positive = {}   # bin index -> count
+        self.negative = {}   # bin index of -value -> count
+        self.zero = 0
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def __len__(self):
+        return self.count
+
+    def add(self, value, count=1):
+        """Record value, count times"""
+        if value > self._min_indexable:
+            bins = self.positive
+            index = int(math.ceil(math.log(value) * self._multiplier))
+        elif value < -self._min_indexable:
+            bins = self.negative
+            index = int(math.ceil(math.log(-value) * self._multiplier))
+        else:
+            bins = None
+            self.zero += count
+        if bins is not None:
+            bins[index] = bins.get(index, 0) + count
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
+        self.count += count
+        self.sum += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """The value at quantile q (0 to 1), None if the sketch is empty"""
+        return self.quantiles([q])[0]
+
+    def quantiles(self, qs):
+        """The values at each quantile of qs, in one pass over the bins"""
+        if any(not 0 <= q <= 1 for q in qs):
+            raise ValueError("quantiles are between 0 and 1")
+        if not self.count:
+            return [None] * len(qs)
+        # Bins in increasing value order: (sign, index, count)
+        ordered = [(-1, i, self.negative[i]) for i in sorted(self.negative, reverse=True)]
+        if self.zero:
+            ordered.append((0, 0, self.zero))
+        ordered.extend((1, i, self.positive[i]) for i in sorted(self.positive))
+        results = []
+        for q in qs:
+            if q == 0 or q == 1:
+                # Known exactly
+                results.append(self.min if q == 0 else self.max)
+                continue
+            rank = q * (self.count - 1)
+            seen = 0
+            for sign, index, count in ordered:
+                seen += count
+                if seen > rank:
+                    break
+            value = sign * self._value(index) if sign else 0.0
+            # The bins are wider than the range of the values
+            results.append(min(max(value, self.min), self.max))
+        return results
+
+    def merge(self, other):
+        """Add the values of another sketch with the same relative_accuracy"""
+        if other._gamma != self._gamma:
+            raise ValueError("Can't merge sketches of different relative accuracies")
+        for mine, theirs in ((self.positive, other.positive), (self.negative, other.negative)):
+            for index, count in theirs.items():
+                mine[index] = mine.get(index, 0) + count
+            if len(mine) > self.max_bins:
+                self._collapse(mine)
+        self.zero += other.zero
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def copy(self):
+        return DDSketch.from_dict(self.to_dict())
+
+    def to_dict(self):
+        """A JSON-serializable state, see from_dict()"""
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'max_bins': self.max_bins,
+            'positive': dict((str(i), c) for i, c in self.positive.items()),
+            'negative': dict((str(i), c) for i, c in self.negative.items()),
+            'zero': self.zero,
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state['relative_accuracy'], state['max_bins'])
+        sketch.positive = dict((int(i), c) for i, c in state['positive'].items())
+        sketch.negative = dict((int(i), c) for i, c in state['negative'].items())
+        for key in ('zero', 'count', 'sum', 'min', 'max'):
+            setattr(sketch, key, state[key])
+        return sketch
+
+    def _value(self, index):
+        # Within relative_accuracy of every value of the bin
+        return 2 * self._gamma ** index / (self._gamma + 1)
+
+    def _collapse(self, bins):
+        """Fold the bins of the smallest magnitudes into one, to keep max_bins"""
+        indexes = sorted(bins)
+        excess = len(indexes) - self.max_bins
+        folded = sum(bins.pop(i) for i in indexes[:excess])
+        bins[indexes[excess]] += folded
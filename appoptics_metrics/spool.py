@@ -0,0 +1,406 @@
+"""
+A write-ahead spool keeping the chunks of a Queue on disk until they are
+sent, through API outages and process restarts.
+
+    spool = Spool('/var/spool/myapp-metrics', max_bytes=512 * 1024 * 1024)
+    q = api.new_queue(spool=spool, drain_rate=20)
+
+Chunks are appended to segment files of up to `segment_size` bytes, as
+records made of their length, a CRC32 and their JSON encoding. They are read
+back oldest first (sealed segments through mmap) and removed once sent: the
+position of the oldest unsent record is kept in a `cursor` file, so a
+restart resumes from there (a chunk sent right before a crash may be sent
+again). A record torn by a crash fails its CRC and is cut off on startup.
+
+When the spool would grow past `max_bytes`, its oldest segments are deleted
+(their chunks are counted in .evicted).
+
+fsync: FSYNC_ALWAYS after each write, FSYNC_SEGMENT when a segment is full
+(and on close), FSYNC_NEVER, or a number of seconds between fsyncs.
+"""
+import logging
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+from appoptics_metrics import exceptions
+from appoptics_metrics.codec import default_codec
+
+FSYNC_ALWAYS = 'always'
+FSYNC_SEGMENT = 'segment'
+FSYNC_NEVER = 'never'
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+# Seconds to wait after a failed post, doubled up to the max
+DRAIN_BACKOFF = 1.0
+DRAIN_MAX_BACKOFF = 60.0
+
+_HEADER = struct.Struct('<II')   # payload length, crc32
+_SUFFIX = '.seg'
+_CURSOR = 'cursor'
+
+log = logging.getLogger("appoptics-metrics")
+
+
+class Spool(object):
+    """Chunks kept in segmented append-only files, see the module"""
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, segment_size=DEFAULT_SEGMENT_SIZE,
+                 fsync=FSYNC_SEGMENT, codec=None):
+        if fsync not in (FSYNC_ALWAYS, FSYNC_SEGMENT, FSYNC_NEVER) and not isinstance(fsync, (int, float)):
+            raise ValueError("fsync must be 'always', 'segment', 'never' or a number of seconds")
+        if segment_size > max_bytes:
+            raise ValueError("segment_size can't be larger than max_bytes")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.codec = codec or default_codec()
+        self.evicted = 0
+        self._lock = threading.RLock()
+        self._segments = []     # ids, oldest first; the last one is written to
+        self._sizes = {}        # id -> bytes
+        self._counts = {}       # id -> unsent records
+        self._head = None       # (id, offset) of the oldest unsent record
+        self._head_record = None
+        self._map = None        # (id, mmap) of the sealed segment being read
+        self._file = None
+        self._last_fsync = time.time()
+        self._drainer = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._recover()
+
+    def __len__(self):
+        with self._lock:
+            return sum(self._counts.values())
+
+    @property
+    def size(self):
+        """Bytes used on disk"""
+        with self._lock:
+            return sum(self._sizes.values())
+
+    @property
+    def draining(self):
+        """Whether start_drain() was called"""
+        return self._drainer is not None
+
+    def append(self, chunk):
+        """Write a chunk at the end of the spool"""
+        payload = self.codec.dumps(chunk)
+        record = _HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+        with self._lock:
+            active = self._segments[-1]
+            if self._sizes[active] and self._sizes[active] + len(record) > self.segment_size:
+                active = self._rotate()
+            self._file.write(record)
+            self._file.flush()
+            self._sizes[active] += len(record)
+            self._counts[active] += 1
+            if self.fsync == FSYNC_ALWAYS or \
+                    (not isinstance(self.fsync, str) and time.time() - self._last_fsync >= self.fsync):
+                self._sync(self._file)
+            self._evict()
+        if self._drainer is not None:
+            self._drainer.wake()
+
+    def head(self):
+        """The oldest unsent chunk (None if there is none), left in the spool"""
+        with self._lock:
+            record = self._read_head()
+            return None if record is None else record[1]
+
+    def pop(self, chunk=None):
+        """Remove the oldest chunk, once it was sent; given the chunk head()
+        returned, only if it was not evicted meanwhile
+        """
+        with self._lock:
+            record = self._read_head()
+            if record is None or (chunk is not None and record[1] is not chunk):
+                return
+            segment, offset = self._head
+            self._head = (segment, offset + record[0])
+            self._head_record = None
+            self._counts[segment] -= 1
+            self._write_cursor()
+
+    def start_drain(self, connection, rate=None, retry_policy=None):
+        """
+        Post the spooled chunks from a background thread, at most `rate`
+        per second (None: no limit). Failed posts are retried after a
+        growing pause; chunks the API refuses (4xx but 429) are dropped.
+        """
+        with self._lock:
+            if self._drainer is None:
+                self._drainer = _Drainer(self, connection, rate, retry_policy)
+        return self._drainer
+
+    def drain(self, post):
+        """Send the spooled chunks until the spool is empty, with post(chunk)
+        raising if it could not. The first error is raised, and the chunk
+        then stays spooled unless the API refused it.
+        """
+        while True:
+            chunk = self.head()
+            if chunk is None:
+                return
+            try:
+                post(chunk)
+            except exceptions.APIError as e:
+                if _refused(e):
+                    log.error("dropped a spooled chunk refused by the API: %s", e)
+                    self.pop(chunk)
+                raise
+            self.pop(chunk)
+
+    def close(self, timeout=None):
+        """Stop the drain thread, if any, then close the files
+        :return: False if the drain thread did not stop within timeout
+        """
+        stopped = True
+        if self._drainer is not None:
+            stopped = self._drainer.stop(timeout)
+            self._drainer = None
+        with self._lock:
+            self._close_map()
+            if self._file is not None:
+                if self.fsync != FSYNC_NEVER:
+                    self._sync(self._file)
+                self._file.close()
+                self._file = None
+        return stopped
+
+    # Private
+    #
+    def _path(self, segment):
+        return os.path.join(self.directory, "%020d%s" % (segment, _SUFFIX))
+
+    def _recover(self):
+        segments = sorted(int(name[:-len(_SUFFIX)]) for name in os.listdir(self.directory)
+                          if name.endswith(_SUFFIX) and name[:-len(_SUFFIX)].isdigit())
+        cursor = self._read_cursor()
+        for segment in segments:
+            if cursor is not None and segment < cursor[0]:
+                # Sent before a crash, but not deleted yet
+                os.remove(self._path(segment))
+                continue
+            start = cursor[1] if cursor is not None and segment == cursor[0] else 0
+            count, end = _scan(self._path(segment), start)
+            size = os.path.getsize(self._path(segment))
+            if end < size:
+                log.warning("spool segment %s: cutting off %d bytes of incomplete records", segment, size - end)
+                with open(self._path(segment), 'r+b') as f:
+                    f.truncate(end)
+            self._segments.append(segment)
+            self._sizes[segment] = end
+            self._counts[segment] = count
+            if self._head is None:
+                self._head = (segment, start)
+        if not self._segments:
+            first = cursor[0] + 1 if cursor is not None else 0
+            self._segments.append(first)
+            self._sizes[first] = 0
+            self._counts[first] = 0
+            self._head = (first, 0)
+        self._file = open(self._path(self._segments[-1]), 'ab')
+        if self._counts and sum(self._counts.values()):
+            log.info("spool %s: %d chunks to send", self.directory, len(self))
+
+    def _read_cursor(self):
+        try:
+            with open(os.path.join(self.directory, _CURSOR)) as f:
+                segment, offset = f.read().split()
+            return int(segment), int(offset)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_cursor(self):
+        path = os.path.join(self.directory, _CURSOR)
+        with open(path + '.tmp', 'w') as f:
+            f.write("%d %d" % self._head)
+            if self.fsync == FSYNC_ALWAYS:
+                self._sync(f)
+        _replace(path + '.tmp', path)
+
+    def _rotate(self):
+        if self.fsync != FSYNC_NEVER:
+            self._sync(self._file)
+        self._file.close()
+        segment = self._segments[-1] + 1
+        self._segments.append(segment)
+        self._sizes[segment] = 0
+        self._counts[segment] = 0
+        self._file = open(self._path(segment), 'ab')
+        return segment
+
+    def _evict(self):
+        while sum(self._sizes.values()) > self.max_bytes and len(self._segments) > 1:
+            oldest = self._segments[0]
+            self.evicted += self._counts[oldest]
+            log.warning("spool %s is full: dropped %d chunks", self.directory, self._counts[oldest])
+            self._drop_segment(oldest)
+
+    def _drop_segment(self, segment):
+        if self._map is not None and self._map[0] == segment:
+            self._close_map()
+        self._segments.remove(segment)
+        del self._sizes[segment]
+        del self._counts[segment]
+        os.remove(self._path(segment))
+        if self._head[0] == segment:
+            self._head = (self._segments[0], 0)
+            self._head_record = None
+            self._write_cursor()
+
+    def _read_head(self):
+        """(length, chunk) of the oldest unsent record, or None"""
+        if self._head_record is not None:
+            return self._head_record
+        while True:
+            segment, offset = self._head
+            if self._counts[segment]:
+                break
+            if segment == self._segments[-1]:
+                return None
+            # All sent
+            self._drop_segment(segment)
+        if segment == self._segments[-1]:
+            # Being written: read it from the file
+            with open(self._path(segment), 'rb') as f:
+                f.seek(offset)
+                length, crc = _HEADER.unpack(f.read(_HEADER.size))
+                payload = f.read(length)
+        else:
+            if self._map is None or self._map[0] != segment:
+                self._close_map()
+                with open(self._path(segment), 'rb') as f:
+                    self._map = (segment, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            data = self._map[1]
+            length, crc = _HEADER.unpack_from(data, offset)
+            payload = data[offset + _HEADER.size:offset + _HEADER.size + length]
+        self._head_record = (_HEADER.size + length, self.codec.loads(payload))
+        return self._head_record
+
+    def _close_map(self):
+        if self._map is not None:
+            self._map[1].close()
+            self._map = None
+
+    def _sync(self, f):
+        f.flush()
+        os.fsync(f.fileno())
+        self._last_fsync = time.time()
+
+
+class _Drainer(object):
+    """The thread of Spool.start_drain()"""
+
+    def __init__(self, spool, connection, rate, retry_policy):
+        self.spool = spool
+        self.connection = connection
+        self.rate = rate
+        self.retry_policy = retry_policy
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="appoptics-metrics-spool")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wake(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def _wait(self, seconds):
+        """Sleep unless stopped; False once stopped"""
+        with self._cond:
+            if not self._stopping:
+                self._cond.wait(seconds)
+            return not self._stopping
+
+    def _run(self):
+        backoff = DRAIN_BACKOFF
+        while True:
+            try:
+                chunk = self.spool.head()
+            except Exception:
+                log.exception("could not read the spool")
+                chunk = None
+            if chunk is None:
+                if not self._wait(None if self.rate is None else 1.0):
+                    return
+                continue
+            start = time.time()
+            try:
+                self.connection._mexe("measurements", method="POST", query_props=chunk,
+                                      retry_policy=self.retry_policy)
+            except (exceptions.APIError, exceptions.CircuitOpenError, socket.error) as e:
+                if isinstance(e, exceptions.APIError) and _refused(e):
+                    log.error("dropped a spooled chunk refused by the API: %s", e)
+                    self.spool.pop(chunk)
+                    continue
+                log.info("could not send a spooled chunk, retrying in %.0fs: %s", backoff, e)
+                if not self._wait(backoff):
+                    return
+                backoff = min(backoff * 2, DRAIN_MAX_BACKOFF)
+                continue
+            except Exception:
+                log.exception("could not send a spooled chunk")
+                if not self._wait(backoff):
+                    return
+                continue
+            self.spool.pop(chunk)
+            backoff = DRAIN_BACKOFF
+            if self.rate:
+                pause = 1.0 / self.rate - (time.time() - start)
+                if pause > 0 and not self._wait(pause):
+                    return
+            with self._cond:
+                if self._stopping:
+                    return
+
+
+def _refused(error):
+    """A 4xx the same chunk would get again"""
+    return isinstance(error, exceptions.ClientError) and error.code not in (408, 429)
+
+
+def _scan(path, start):
+    """(number, end) of the valid records of a segment file from start"""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= start:
+            return 0, min(start, size)
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        count = 0
+        pos = start
+        while pos + _HEADER.size <= size:
+            length, crc = _HEADER.unpack_from(data, pos)
+            end = pos + _HEADER.size + length
+            if end > size or zlib.crc32(data[pos + _HEADER.size:end]) & 0xffffffff != crc:
+                break
+            count += 1
+            pos = end
+        return count, pos
+    finally:
+        data.close()
+
+
+def _replace(src, dst):
+    try:
+        os.replace(src, dst)
+    except AttributeError:
+        # py2, rename replaces on POSIX
+        os.rename(src, dst)
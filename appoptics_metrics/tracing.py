@@ -0,0 +1,83 @@
+import json
+import logging
+import time
+import zlib
+
+
+class Trace(object):
+    """What is known about one HTTP request: filled in before it is sent
+    (request_start) and once its response arrived or it failed (request_end).
+    """
+    __slots__ = ('method', 'uri', 'request_body', 'start', 'status', 'response_body', 'elapsed', 'error')
+
+    def __init__(self, method, uri, request_body):
+        self.method = method
+        self.uri = uri
+        self.request_body = request_body
+        self.start = time.time()
+        self.status = None
+        self.response_body = None
+        self.elapsed = None
+        self.error = None
+
+    @property
+    def bytes_sent(self):
+        return len(self.request_body) if self.request_body else 0
+
+    @property
+    def bytes_received(self):
+        return len(self.response_body) if self.response_body else 0
+
+    def finish(self, status=None, error=None):
+        self.status = status
+        self.error = error
+        self.elapsed = time.time() - self.start
+
+
+class Tracer(object):
+    """Base class for request tracers, override the hooks you need.
+
+    api.add_tracer(MyTracer())
+
+    Nothing is measured or formatted unless at least one tracer is added.
+    Each attempt (including retries) is traced separately.
+    """
+
+    def request_start(self, trace):
+        """Called right before a request is sent"""
+        pass
+
+    def request_end(self, trace):
+        """Called when the response was read or the request failed (trace.error)"""
+        pass
+
+
+class LoggingTracer(Tracer):
+    """Logs every request and response, pretty-printing JSON request bodies.
+    Meant for debugging: it parses and re-serializes every payload.
+    """
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or logging.getLogger("appoptics-metrics")
+        self.level = level
+
+    def request_start(self, trace):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        self.logger.log(self.level, "method=%s uri=%s", trace.method, trace.uri)
+        body = trace.request_body
+        if body is None:
+            self.logger.log(self.level, "body(->): %s", body)
+        else:
+            if body[:2] == b'\x1f\x8b':
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            self.logger.log(self.level, "body(->): %s",
+                            json.dumps(json.loads(body.decode('utf-8')), indent=4, sort_keys=True))
+
+    def request_end(self, trace):
+        if trace.error is not None:
+            self.logger.log(self.level, "error(<-): %r after %.3fs", trace.error, trace.elapsed)
+        else:
+            self.logger.log(self.level, "status code(<-): %s in %.3fs (%d bytes sent, %d received)",
+                            trace.status, trace.elapsed, trace.bytes_sent, trace.bytes_received)
+            self.logger.log(self.level, "body(<-): %s", trace.response_body)
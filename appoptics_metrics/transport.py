@@ -0,0 +1,254 @@
+"""
+Transports send the HTTP requests of an AppOpticsConnection.
+
+    api = appoptics_metrics.connect('token', transport=Urllib3Transport())
+
+A transport only moves bytes: the connection builds the request (headers,
+JSON, gzip) and interprets the Response (errors, retries, circuit breaker).
+Timeouts must surface as socket.timeout and broken or refused connections as
+retry.CONNECTION_ERROR (ConnectionError) so that RetryPolicy and CircuitBreaker
+can classify them; certificate errors as ssl.SSLError, which are not retried.
+"""
+import logging
+import socket
+import ssl
+from six.moves import http_client
+from six.moves.urllib.parse import urlsplit
+from appoptics_metrics.pool import ConnectionPool
+from appoptics_metrics.retry import CONNECTION_ERROR, CONNECTION_ERRORS
+
+try:
+    import urllib3
+except ImportError:
+    urllib3 = None
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+log = logging.getLogger("appoptics-metrics")
+
+# Bytes read at a time from streamed responses
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# Alias the stdlib connections so the tests can mock them out.
+HTTPSConnection = http_client.HTTPSConnection
+HTTPConnection = http_client.HTTPConnection
+
+
+class Response(object):
+    """A fully read HTTP response, quacking like http_client.HTTPResponse"""
+
+    def __init__(self, status, headers, body, reason=''):
+        self.status = status
+        self.reason = reason
+        self._headers = dict((k.lower(), v) for k, v in headers)
+        self._body = body
+
+    def getheader(self, name, default=None):
+        return self._headers.get(name.lower(), default)
+
+    def getheaders(self):
+        return list(self._headers.items())
+
+    def read(self):
+        return self._body
+
+    def iter_chunks(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Yield the body in chunks of bytes"""
+        if self._body:
+            yield self._body
+
+    def close(self):
+        pass
+
+
+class StreamedResponse(Response):
+    """A response whose body is read from the socket as it is consumed.
+    It must be closed, which gives its connection back to the pool.
+    """
+
+    def __init__(self, status, headers, raw, reason='', release=None):
+        Response.__init__(self, status, headers, None, reason)
+        self._raw = raw
+        self._release = release
+        self._consumed = False
+
+    def read(self):
+        try:
+            body = self._raw.read()
+            self._consumed = True
+            return body
+        finally:
+            self.close()
+
+    def iter_chunks(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        try:
+            while True:
+                chunk = self._raw.read(chunk_size)
+                if not chunk:
+                    self._consumed = True
+                    return
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        if self._release is not None:
+            release, self._release = self._release, None
+            # An unread body leaves the socket unusable
+            release(self._consumed)
+
+
+class Transport(object):
+    """Base class for transports"""
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        """
+        Send a request and return its Response once the body was read
+        :param method: HTTP method
+        :param url: absolute URL, e.g. https://api.appoptics.com/v1/metrics
+        :param body: bytes or None
+        :param headers: dict of headers
+        :param timeout: socket timeout in seconds
+        :return: Response
+        """
+        raise NotImplementedError()
+
+    def stream(self, method, url, body=None, headers=None, timeout=None):
+        """
+        Like request(), but the body may be read as it arrives with
+        iter_chunks(). The caller closes the response. This default
+        implementation reads the whole body first.
+        """
+        return self.request(method, url, body=body, headers=headers, timeout=timeout)
+
+    def close(self):
+        """Release the sockets kept open by the transport"""
+        pass
+
+
+class HTTPClientTransport(Transport):
+    """The default transport: keep-alive six.moves.http_client connections
+    kept in a ConnectionPool, per (scheme, host). If the server dropped an
+    idle socket the request is transparently sent again on a new one.
+    """
+
+    def __init__(self, pool=None, connection_factory=None):
+        """
+        :param pool: ConnectionPool (default: a new one with default settings)
+        :param connection_factory: callable(scheme, host, timeout) returning
+                                   an unconnected http_client connection
+        """
+        self.pool = pool or ConnectionPool()
+        self.connection_factory = connection_factory or _new_http_client_connection
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        return self._send(method, url, body, headers, timeout, stream=False)
+
+    def stream(self, method, url, body=None, headers=None, timeout=None):
+        return self._send(method, url, body, headers, timeout, stream=True)
+
+    def _send(self, method, url, body, headers, timeout, stream):
+        scheme, host, path, query, _ = urlsplit(url)
+        uri = path + "?" + query if query else path
+        while True:
+            pooled = self.pool.acquire((scheme, host), lambda: self.connection_factory(scheme, host, timeout))
+            conn = pooled.conn
+            if pooled.reused:
+                # Honor a timeout changed since the socket was opened
+                conn.timeout = timeout
+                if getattr(conn, 'sock', None) is not None:
+                    conn.sock.settimeout(timeout)
+            try:
+                conn.request(method, uri, body=body, headers=headers or {})
+                resp = conn.getresponse()
+                data = None if stream else resp.read()
+            except Exception as e:
+                # The socket is in an unknown state
+                self.pool.release(pooled, reusable=False)
+                if isinstance(e, CONNECTION_ERRORS) and not isinstance(e, socket.timeout) and pooled.reused:
+                    log.info("keep-alive connection was closed by the server, reconnecting")
+                    continue
+                raise
+            if stream:
+                def release(consumed, pooled=pooled, resp=resp):
+                    self.pool.release(pooled, reusable=consumed and not getattr(resp, 'will_close', False))
+                return StreamedResponse(resp.status, resp.getheaders(), resp, resp.reason, release)
+            self.pool.release(pooled, reusable=not getattr(resp, 'will_close', False))
+            return Response(resp.status, resp.getheaders(), data, resp.reason)
+
+    def close(self):
+        self.pool.clear()
+
+
+class Urllib3Transport(Transport):
+    """Sends requests with urllib3 (pip install urllib3).
+    Extra keyword arguments are passed to urllib3.PoolManager.
+    """
+
+    def __init__(self, pool_manager=None, **pool_kwargs):
+        if urllib3 is None:
+            raise ImportError("Urllib3Transport needs the urllib3 package")
+        self.pool_manager = pool_manager or urllib3.PoolManager(**pool_kwargs)
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        try:
+            # Retries, redirects and decompression are the connection's job
+            resp = self.pool_manager.request(method, url, body=body, headers=_str_headers(headers),
+                                             timeout=timeout, retries=False, redirect=False,
+                                             preload_content=True, decode_content=False)
+        except urllib3.exceptions.TimeoutError as e:
+            raise socket.timeout(str(e))
+        except urllib3.exceptions.SSLError as e:
+            raise ssl.SSLError(str(e))
+        except urllib3.exceptions.HTTPError as e:
+            raise CONNECTION_ERROR(str(e))
+        return Response(resp.status, resp.headers.items(), resp.data, resp.reason or '')
+
+    def close(self):
+        self.pool_manager.clear()
+
+
+class HttpxTransport(Transport):
+    """Sends requests with httpx (pip install httpx[http2]). With http2=True
+    the requests of all threads are multiplexed over one connection per host.
+    Extra keyword arguments are passed to httpx.Client.
+    """
+
+    def __init__(self, client=None, http2=True, **client_kwargs):
+        if httpx is None:
+            raise ImportError("HttpxTransport needs the httpx package")
+        self.client = client or httpx.Client(http2=http2, **client_kwargs)
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        try:
+            resp = self.client.request(method, url, content=body, headers=_str_headers(headers), timeout=timeout)
+        except httpx.TimeoutException as e:
+            raise socket.timeout(str(e))
+        except httpx.TransportError as e:
+            raise CONNECTION_ERROR(str(e))
+        return _httpx_response(resp)
+
+    def close(self):
+        self.client.close()
+
+
+def _new_http_client_connection(scheme, host, timeout):
+    connection_class = HTTPSConnection if scheme == "https" else HTTPConnection
+    return connection_class(host, timeout=timeout)
+
+
+def _str_headers(headers):
+    """Third-party clients want str header values (ours can be bytes)"""
+    result = {}
+    for k, v in (headers or {}).items():
+        result[k] = v.decode('latin-1') if isinstance(v, bytes) else v
+    return result
+
+
+def _httpx_response(resp):
+    # httpx always decompresses the body, so drop the header saying it is compressed
+    headers = [(k, v) for k, v in resp.headers.items() if k.lower() != 'content-encoding']
+    return Response(resp.status_code, headers, resp.content, resp.reason_phrase)
@@ -32,5 +32,11 @@ setup(
         'Programming Language :: Python :: 3',
     ],
     dependency_links=[],
-    install_requires=['six'],
+    install_requires=['six', 'futures; python_version < "3"'],
+    extras_require={
+        'urllib3': ['urllib3'],
+        'httpx': ['httpx[http2]'],
+        'orjson': ['orjson; python_version >= "3.6"'],
+        'ujson': ['ujson'],
+    },
 )
@@ -0,0 +1,55 @@
+"""
+Compare the JSON codecs on the payloads built by Queue.submit.
+
+    python tests/bench_codec.py [chunks]
+
+For every installed codec, times the encoding of full 300-measurement chunks
+and a whole Queue.submit() over a transport that does no I/O.
+"""
+import sys
+import timeit
+import appoptics_metrics
+from appoptics_metrics.codec import JSONCodec, OrjsonCodec, UjsonCodec
+from appoptics_metrics.transport import Response, Transport
+
+
+class NullTransport(Transport):
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        return Response(202, [], b'')
+
+
+def fill(queue, chunks):
+    for i in range(chunks * queue.MAX_MEASUREMENTS_PER_CHUNK):
+        queue.add('app.requests.latency', i * 0.37, time=1500000000 + i,
+                  tags={'host': 'web-%d' % (i % 20), 'region': 'us-east-1', 'endpoint': '/api/v1/items'})
+
+
+def main(chunks=20):
+    codecs = [JSONCodec()]
+    for klass in (OrjsonCodec, UjsonCodec):
+        try:
+            codecs.append(klass())
+        except ImportError as e:
+            print("skipped: %s" % e)
+
+    print("%d chunks of %d measurements" % (chunks, appoptics_metrics.Queue.MAX_MEASUREMENTS_PER_CHUNK))
+    baseline = None
+    for codec in codecs:
+        conn = appoptics_metrics.connect('token', transport=NullTransport(), codec=codec)
+        queue = conn.new_queue()
+        fill(queue, chunks)
+        payloads = list(queue.tagged_chunks)
+        encode = min(timeit.repeat(lambda: [codec.dumps(p) for p in payloads], number=5, repeat=5)) / 5
+
+        def submit():
+            queue.tagged_chunks = list(payloads)
+            queue.submit()
+        total = min(timeit.repeat(submit, number=5, repeat=5)) / 5
+
+        baseline = baseline or encode
+        print("%-8s encode %7.2f ms (x%.1f)   submit %7.2f ms" % (codec.name, encode * 1000, baseline / encode,
+                                                                   total * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
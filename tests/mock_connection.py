@@ -4,7 +4,18 @@ import time
 import re
 import six
 import copy
-from six.moves.urllib.parse import urlparse, parse_qs
+import zlib
+from six.moves.urllib.parse import urlparse, urlsplit, parse_qs
+from appoptics_metrics.transport import Transport, Response
+
+
+def wait_for(condition, timeout=2):
+    """Poll condition() until it is true, for tests of background threads"""
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.005)
 
 
 class MockServer(object):
@@ -26,6 +37,12 @@ class MockServer(object):
 
         # metric_name, tag_name, tag_value -> (time1, value1), (time2, value2), ...
         self.tagged_measurements = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
+        # (status, headers) of the error responses to send next
+        self.failures = []
+
+    def fail_next(self, n=1, status=500, headers=None):
+        """Answer the next n requests with an error instead of processing them"""
+        self.failures.extend([(status, headers or {})] * n)
 
     def list_of_metrics(self):
         answer = self.__an_empty_list_metrics()
@@ -448,10 +465,15 @@ class MockResponse(object):
     Inspect the request and interact with the mocked server to generate
     an answer.
     '''
-    def __init__(self, request, fake_failure=False):
+    def __init__(self, request):
         self.request = request
-        self.status = 500 if fake_failure else 200
+        self.status = 200
+        self.reason = ''
+        self._body = None
         self._headers = {'content-type': "application/json;charset=utf-8"}
+        if server.failures:
+            self.status, headers = server.failures.pop(0)
+            self._headers.update((k.lower(), v) for k, v in headers.items())
 
     class headers(object):
         @staticmethod
@@ -461,8 +483,20 @@ class MockResponse(object):
     def getheader(self, name, default=None):
         return self._headers.get(name.lower(), default)
 
-    def read(self):
-        return self._json_body_based_on_request()
+    def getheaders(self):
+        return list(self._headers.items())
+
+    def read(self, amt=None):
+        if self._body is None:
+            if self.status >= 400:
+                self._body = json.dumps({'errors': {'request': ['mocked failure']}}).encode('utf-8')
+            else:
+                self._body = self._json_body_based_on_request()
+        if amt is None:
+            body, self._body = self._body, b''
+        else:
+            body, self._body = self._body[:amt], self._body[amt:]
+        return body
 
     def _json_body_based_on_request(self):
         r = self.request
@@ -667,23 +701,38 @@ class MockConnect(object):
       .status
       .read() -> raw json body of the answer
     """
-    def __init__(self, hostname, fake_n_errors=0, timeout=10):
+    def __init__(self, hostname, timeout=10):
         self.hostname = hostname
-        self.fake_n_errors = fake_n_errors
 
     def request(self, method, uri, body, headers):
         self.method = method
         self.uri = uri
         self.headers = headers
+        if body and headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
         self.body = json.loads(body) if body else body
 
     def getresponse(self):
-        if self.fake_n_errors > 0:
-            fake_error = True
-            self.fake_n_errors -= 1
-        else:
-            fake_error = False
-        return MockResponse(self, fake_error)
+        return MockResponse(self)
 
     def close(self):
         pass
+
+
+class MockTransport(Transport):
+    """
+    Transport answering from the mocked server, without any socket.
+    Every request is kept in .requests as (method, url, body, headers),
+    with the body as sent (e.g. gzip'ed).
+    """
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        headers = headers or {}
+        self.requests.append((method, url, body, dict(headers)))
+        parts = urlsplit(url)
+        conn = MockConnect(parts.netloc)
+        conn.request(method, parts.path + "?" + parts.query if parts.query else parts.path, body, headers)
+        resp = conn.getresponse()
+        return Response(resp.status, resp.getheaders(), resp.read())
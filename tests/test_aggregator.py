@@ -1,17 +1,17 @@
 import logging
 import unittest
 import appoptics_metrics
-from appoptics_metrics.aggregator import Aggregator
-from mock_connection import MockConnect, server
+from appoptics_metrics import aggregator, exceptions
+from appoptics_metrics.aggregator import Aggregator, WindowedAggregator
+from mock_connection import MockTransport, server
 # from random import randint
 
 # logging.basicConfig(level=logging.DEBUG)
-appoptics_metrics.HTTPSConnection = MockConnect
 
 
 class TestAggregator(unittest.TestCase):
     def setUp(self):
-        self.conn = appoptics_metrics.connect('key_test')
+        self.conn = appoptics_metrics.connect('key_test', transport=MockTransport())
         server.clean()
         self.agg = Aggregator(self.conn)
 
@@ -224,6 +224,191 @@ class TestAggregator(unittest.TestCase):
         self.agg.period = 60
         assert self.agg.to_payload()['time'] == 1418838360
 
+    def test_add_tagged_per_series(self):
+        agg = Aggregator(self.conn, tags={'host': 'web-1'})
+        for status, v in (('200', 3), ('200', 5), ('500', 1)):
+            agg.add_tagged('latency', v, tags={'endpoint': '/items', 'status': status})
+        agg.add_tagged('latency', 7, tags={'status': '200', 'endpoint': '/items'})
+        assert len(agg.tagged_measurements) == 2
+        series = agg.tagged_measurements[('latency', frozenset([('endpoint', '/items'), ('status', '200')]))]
+        assert (series['sum'], series['count'], series['min'], series['max']) == (15, 3, 3, 7)
+
+    def test_md_payload_tags_of_each_series(self):
+        agg = Aggregator(self.conn, tags={'host': 'web-1'})
+        agg.add_tagged('latency', 3, tags={'endpoint': '/items', 'status': '200'})
+        agg.add_tagged('latency', 1, tags={'endpoint': '/items', 'status': '500'})
+        agg.add_tagged('cpu', 2)
+        payload = agg.to_md_payload()
+        # Only a tag set common to all series would be hoisted
+        assert 'tags' not in payload
+        assert sorted((m['name'], sorted(m['tags'].items())) for m in payload['measurements']) == [
+            ('cpu', [('host', 'web-1')]),
+            ('latency', [('endpoint', '/items'), ('host', 'web-1'), ('status', '200')]),
+            ('latency', [('endpoint', '/items'), ('host', 'web-1'), ('status', '500')])]
+        # The aggregated series are left as they were
+        assert agg.tagged_measurements['cpu'] == {'count': 1, 'sum': 2, 'min': 2, 'max': 2}
+
+    def test_md_payload_hoists_common_tags(self):
+        agg = Aggregator(self.conn, tags={'host': 'web-1'})
+        agg.add_tagged('latency', 3, tags={'status': '200'})
+        agg.add_tagged('cpu', 2, tags={'status': '200'})
+        payload = agg.to_md_payload()
+        assert payload['tags'] == {'host': 'web-1', 'status': '200'}
+        assert all('tags' not in m for m in payload['measurements'])
+
+    def test_md_payload_series_tags_override(self):
+        agg = Aggregator(self.conn, tags={'host': 'web-1'})
+        agg.add_tagged('latency', 3, tags={'host': 'web-2', 'status': '200'})
+        agg.add_tagged('latency', 3, tags={'host': 'web-2', 'status': '500'})
+        payload = agg.to_md_payload()
+        assert sorted((m['tags']['host'], m['tags']['status']) for m in payload['measurements']) == [
+            ('web-2', '200'), ('web-2', '500')]
+
+    def test_submit_many_series_in_one_request(self):
+        agg = Aggregator(self.conn, tags={'host': 'web-1'})
+        posted = []
+        self.conn._mexe = lambda path, method, query_props, retry_policy: posted.append(query_props)
+        for i in range(3000):
+            agg.add_tagged('requests', 1, tags={'endpoint': '/e%d' % (i % 1000)})
+        agg.submit()
+        assert len(posted) == 1
+        assert len(posted[0]['measurements']) == 1000
+        assert all(m['count'] == 3 for m in posted[0]['measurements'])
+        assert agg.tagged_measurements == {}
+
+    def test_queue_add_aggregator_with_series(self):
+        agg = Aggregator(self.conn, tags={'host': 'web-1'})
+        agg.add_tagged('latency', 3, tags={'status': '200'})
+        agg.add_tagged('latency', 4)
+        q = self.conn.new_queue()
+        q.add_aggregator(agg)
+        ms = sorted(q.tagged_chunks[0]['measurements'], key=lambda m: len(m['tags']))
+        assert [(m['name'], m['tags']) for m in ms] == [
+            ('latency', {'host': 'web-1'}), ('latency', {'host': 'web-1', 'status': '200'})]
+
+    def test_percentiles(self):
+        agg = Aggregator(self.conn, tags={'host': 'web-1'}, percentiles=[50, 99])
+        for v in range(1, 101):
+            agg.add_tagged('latency', v, tags={'endpoint': '/items'})
+        agg.add_tagged('cpu', 5)
+        payload = agg.to_md_payload()
+        by_name = dict((m['name'], m) for m in payload['measurements'])
+        assert sorted(by_name) == ['cpu', 'cpu.p50', 'cpu.p99', 'latency', 'latency.p50', 'latency.p99']
+        assert by_name['latency']['count'] == 100
+        assert abs(by_name['latency.p50']['sum'] - 50) <= 0.5
+        assert abs(by_name['latency.p99']['sum'] - 99) <= 1
+        assert by_name['latency.p99']['tags'] == {'host': 'web-1', 'endpoint': '/items'}
+        assert by_name['cpu.p50'] == {'name': 'cpu.p50', 'sum': 5, 'count': 1, 'tags': {'host': 'web-1'}}
+
+    def test_legacy_percentiles(self):
+        agg = Aggregator(self.conn, percentiles=[90])
+        for v in range(10):
+            agg.add('latency', v)
+        assert [m['name'] for m in agg.to_payload()['measurements']] == ['latency', 'latency.p90']
+
+    def test_percentiles_in_queue(self):
+        agg = Aggregator(self.conn, tags={'host': 'web-1'}, percentiles=[95])
+        agg.add_tagged('latency', 10, tags={'endpoint': '/items'})
+        agg.add_tagged('latency', 20, tags={'endpoint': '/items'})
+        q = self.conn.new_queue()
+        q.add_aggregator(agg)
+        ms = q.tagged_chunks[0]['measurements']
+        assert [(m['name'], m['tags']) for m in ms] == [
+            ('latency', {'host': 'web-1', 'endpoint': '/items'}),
+            ('latency.p95', {'host': 'web-1', 'endpoint': '/items'})]
+        assert agg.tagged_sketches == {}
+
+    def test_merge(self):
+        aggs = [Aggregator(self.conn, percentiles=[50]) for _ in range(2)]
+        for i in range(100):
+            aggs[i % 2].add_tagged('latency', i, tags={'endpoint': '/items'})
+        aggs[1].add_tagged('cpu', 3)
+        aggs[0].merge(aggs[1])
+        ms = dict((m['name'], m) for m in aggs[0].to_md_payload()['measurements'])
+        assert (ms['latency']['count'], ms['latency']['min'], ms['latency']['max']) == (100, 0, 99)
+        assert abs(ms['latency.p50']['sum'] - 49) <= 0.5
+        assert ms['cpu']['count'] == 1
+        # The other one is left as it was
+        assert aggs[1].tagged_sketches[('latency', frozenset([('endpoint', '/items')]))].count == 50
+
+    def test_merge_into_an_aggregator_without_percentiles(self):
+        agg = Aggregator(self.conn)
+        other = Aggregator(self.conn, percentiles=[50])
+        other.add('latency', 3)
+        other.add_tagged('latency', 3, tags={'endpoint': '/items'})
+        agg.merge(other)
+        assert agg.sketches == {} and agg.tagged_sketches == {}
+        assert [m['name'] for m in agg.to_payload()['measurements']] == ['latency']
+        assert [m['name'] for m in agg.to_md_payload()['measurements']] == ['latency']
+
+
+class TestWindowedAggregator(unittest.TestCase):
+    def setUp(self):
+        self.conn = appoptics_metrics.connect('key_test', transport=MockTransport())
+        self.posted = []
+        self.conn._mexe = lambda path, method, query_props, retry_policy: self.posted.append(query_props)
+        self.now = 1500000059.5
+        old, aggregator._now = aggregator._now, lambda: self.now
+        self.addCleanup(setattr, aggregator, '_now', old)
+        self.agg = WindowedAggregator(self.conn, period=60, lateness=5, tags={'host': 'web-1'})
+
+    def test_values_stay_in_their_period(self):
+        self.agg.add_tagged('requests', 1)
+        # Added after the boundary, but measured before
+        self.now += 1
+        self.agg.add_tagged('requests', 2, time=1500000059)
+        self.agg.add_tagged('requests', 3)
+        self.agg.submit()
+        # Both periods are still open
+        assert self.posted == []
+        self.now += 5
+        self.agg.submit()
+        assert self.posted == [{'measurements': [{'name': 'requests', 'sum': 3, 'count': 2, 'min': 1, 'max': 2}],
+                                'tags': {'host': 'web-1'}, 'time': 1500000000}]
+        assert list(self.agg.windows) == [1500000060]
+
+    def test_late_values(self):
+        self.now += 10
+        self.agg.add('requests', 1, time=1500000000)
+        self.agg.add('requests', 1, time=1500000059)
+        assert self.agg.late == 2 and self.agg.windows == {}
+
+    def test_values_from_the_future(self):
+        self.agg.add('requests', 1, time=self.now + 60)
+        self.agg.add('requests', 1, time=self.now + 61)
+        self.agg.add('requests', 1, time=self.now + 3600)
+        assert self.agg.early == 2
+        assert list(self.agg.windows) == [1500000060]
+        assert self.agg.windows[1500000060].measurements['requests']['count'] == 1
+
+    def test_force(self):
+        self.agg.add('requests', 1, time=1500000000)
+        self.agg.add('requests', 1, time=1500000060)
+        self.agg.submit(force=True)
+        assert [p['time'] for p in self.posted] == [1500000000, 1500000060]
+        assert self.agg.windows == {}
+
+    def test_pop_closed_for_a_queue(self):
+        q = self.conn.new_queue()
+        self.agg.add_tagged('requests', 1, tags={'endpoint': '/a'})
+        self.now += 60
+        for window in self.agg.pop_closed():
+            q.add_aggregator(window)
+        m = q.tagged_chunks[0]['measurements'][0]
+        assert m['time'] == 1500000000
+        assert m['tags'] == {'host': 'web-1', 'endpoint': '/a'}
+
+    def test_failed_windows_are_kept(self):
+        def fail(path, method, query_props, retry_policy):
+            raise exceptions.CircuitOpenError("open")
+        self.conn._mexe = fail
+        self.agg.add('requests', 1)
+        self.agg.add('requests', 1, time=1500000060)
+        self.now += 120
+        with self.assertRaises(exceptions.CircuitOpenError):
+            self.agg.submit()
+        assert len(self.agg.windows) == 2
+
 
 if __name__ == '__main__':
     unittest.main()
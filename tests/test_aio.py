@@ -0,0 +1,301 @@
+import asyncio
+import gc
+import logging
+import unittest
+from appoptics_metrics import aio, exceptions
+from appoptics_metrics.retry import RetryPolicy, NO_RETRY
+from appoptics_metrics.circuit import CircuitBreaker
+from appoptics_metrics.aio import AsyncAppOpticsConnection, AsyncHTTPConnection
+from mock_connection import MockConnect, MockTransport, server
+
+# logging.basicConfig(level=logging.DEBUG)
+
+
+class MockAsyncConnect(object):
+    """Mocks AsyncHTTPConnection on top of the MockConnect/MockServer pair"""
+    created = 0
+
+    def __init__(self, host, port=None, use_ssl=True, timeout=10):
+        MockAsyncConnect.created += 1
+        self._conn = MockConnect(host)
+
+    async def request(self, method, uri, body=None, headers=None):
+        # Let other tasks run, as a real socket would
+        await asyncio.sleep(0)
+        self._conn.request(method, uri, body, headers)
+        resp = self._conn.getresponse()
+        resp.will_close = False
+        return resp
+
+    def close(self):
+        pass
+
+
+aio.AsyncHTTPConnection = MockAsyncConnect
+
+
+class TestAsyncConnection(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        server.clean()
+        MockAsyncConnect.created = 0
+        self.conn = AsyncAppOpticsConnection('key_test', tags={'sky': 'blue'})
+
+    async def test_submit_and_get_tagged(self):
+        await self.conn.submit('temperature', 22)
+        resp = await self.conn.get_tagged('temperature', duration=60, tags_search="sky=blue")
+        assert len(resp['series']) == 1
+        assert resp['series'][0]['measurements'][0]['value'] == 22
+
+    async def test_list_all_metrics_is_async_generator(self):
+        await self.conn.submit('a', 1)
+        await self.conn.submit('b', 2)
+        names = [m.name async for m in self.conn.list_all_metrics()]
+        assert names == ['a', 'b']
+
+    async def test_stream_tagged(self):
+        await self.conn.submit('temperature', 22)
+        await self.conn.submit('temperature', 23)
+        points = [(series['tags'], m['value'])
+                  async for series, m in self.conn.stream_tagged('temperature', duration=60, tags_search="sky=blue")]
+        assert points == [({'sky': 'blue'}, 22), ({'sky': 'blue'}, 23)]
+
+    async def test_pages_are_not_streamed(self):
+        with self.assertRaises(ValueError):
+            self.conn.list_all_metrics(stream=True)
+
+    async def test_spaces_and_charts(self):
+        space = await self.conn.create_space('my space')
+        chart = await self.conn.create_chart('cpu', space, streams=[{'metric': 'cpu', 'tags': []}])
+        assert chart.space_id == space.id
+        spaces = [s async for s in self.conn.list_spaces()]
+        assert [s.name for s in spaces] == ['my space']
+        found = await self.conn.find_space('my space')
+        assert found.id == space.id
+
+    async def test_alerts(self):
+        await self.conn.create_alert('my_alert')
+        alerts = [a async for a in self.conn.list_alerts()]
+        assert [a.name for a in alerts] == ['my_alert']
+        alert = await self.conn.get_alert('my_alert')
+        assert alert.name == 'my_alert'
+
+    async def test_concurrent_requests_share_pool(self):
+        self.conn.pool.maxsize = 2
+        await asyncio.gather(*[self.conn.list_metrics() for _ in range(20)])
+        assert MockAsyncConnect.created <= 2
+
+    async def test_server_errors_are_retried(self):
+        self.conn.retry_policy = RetryPolicy(backoff_base=0.001)
+        server.fail_next(2, status=503)
+        assert await self.conn.list_metrics() == []
+        server.fail_next(1, status=503)
+        with self.assertRaises(exceptions.ServerError):
+            await self.conn.with_retry_policy(NO_RETRY).list_metrics()
+
+    async def test_client_error(self):
+        with self.assertRaises(Exception):
+            await self.conn.get_tagged('temperature')
+
+    async def test_list_all_metrics_in_parallel(self):
+        in_flight = [0, 0]
+
+        async def mexe(entity, query_props=None):
+            offset = query_props.get('offset', 0)
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+            # The second page is the slowest one
+            await asyncio.sleep(0.05 if offset == 10 else 0.001)
+            in_flight[0] -= 1
+            page = [{'name': 'metric_%02d' % i, 'type': 'gauge', 'period': 60, 'attributes': {}}
+                    for i in range(offset, min(offset + 10, 45))]
+            return {'query': {'offset': offset, 'length': len(page), 'total': 45}, 'metrics': page}
+
+        self.conn._mexe = mexe
+        metrics = self.conn.list_all_metrics(length=10, parallelism=3)
+        names = [m.name async for m in metrics]
+        assert names == ['metric_%02d' % i for i in range(45)]
+        assert in_flight[1] == 3
+        assert metrics.offset == metrics.total == 45
+
+        resumed = self.conn.list_all_metrics(length=10, offset=40)
+        assert [m.name async for m in resumed] == ['metric_%02d' % i for i in range(40, 45)]
+
+        names = [m.name async for m in self.conn.list_all_metrics(length=10, parallelism=3, ordered=False)]
+        assert sorted(names) == ['metric_%02d' % i for i in range(45)]
+        assert names[10:20] != ['metric_%02d' % i for i in range(10, 20)]
+
+    async def test_custom_transport(self):
+        class AsyncMockTransport(MockTransport):
+            async def request(self, *args, **kwargs):
+                return MockTransport.request(self, *args, **kwargs)
+
+            async def close(self):
+                pass
+
+        transport = AsyncMockTransport()
+        conn = AsyncAppOpticsConnection('key_test', transport=transport)
+        assert await conn.list_metrics() == []
+        assert transport.requests[0][1] == 'https://api.appoptics.com/v1/metrics'
+        await conn.close()
+
+
+class TestAsyncQueue(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        server.clean()
+        self.conn = AsyncAppOpticsConnection('key_test')
+
+    async def test_submit_many_chunks_concurrently(self):
+        q = self.conn.new_queue(tags={'sky': 'blue'}, concurrency=4)
+        for i in range(q.MAX_MEASUREMENTS_PER_CHUNK * 3 + 1):
+            q.add('temperature', i)
+        assert len(q.tagged_chunks) == 4
+        await q.submit()
+        assert q.tagged_chunks == []
+        metric = await self.conn.get('temperature')
+        assert len(metric.measurements['unassigned']) == q.MAX_MEASUREMENTS_PER_CHUNK * 3 + 1
+
+    async def test_submit_errors_are_aggregated(self):
+        conn = AsyncAppOpticsConnection('key_test', retry_policy=NO_RETRY)
+        q = conn.new_queue(tags={'sky': 'blue'}, concurrency=4)
+        for i in range(q.MAX_MEASUREMENTS_PER_CHUNK * 2 + 1):
+            q.add('temperature', i)
+        server.fail_next(2, status=503)
+        with self.assertRaises(exceptions.SubmitError) as cm:
+            await q.submit()
+        assert len(cm.exception.errors) == 2
+        assert len(q.tagged_chunks) == 2
+        assert len(q.last_report.sent) == 1
+        assert len(q.last_report.failed) == 2
+
+    async def test_submit_report(self):
+        q = self.conn.new_queue(tags={'sky': 'blue'}, auto_submit_count=2)
+        for i in range(3):
+            q.add('temperature', i)
+        report = await q.submit()
+        assert report.ok
+        assert report.measurements_sent == 3
+
+    async def test_failed_auto_submit_does_not_stop_submit(self):
+        conn = AsyncAppOpticsConnection('key_test', retry_policy=NO_RETRY)
+        q = conn.new_queue(tags={'sky': 'blue'}, auto_submit_count=2)
+        server.fail_next(1, status=503)
+        q.add('temperature', 1)
+        q.add('temperature', 2)
+        q.add('temperature', 3)
+        with self.assertRaises(exceptions.ServerError):
+            await q.submit()
+        # Posted anyway
+        metric = await conn.get('temperature')
+        assert len(metric.measurements['unassigned']) == 1
+        assert q.last_report.measurements_sent == 1 and q.last_report.measurements_failed == 2
+        # The failed auto-flush is sent by the next submit
+        await q.submit()
+        metric = await conn.get('temperature')
+        assert len(metric.measurements['unassigned']) == 3
+
+    async def test_failed_auto_submit_is_retrieved(self):
+        unhandled = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: unhandled.append(context))
+        conn = AsyncAppOpticsConnection('key_test', retry_policy=NO_RETRY)
+        q = conn.new_queue(tags={'sky': 'blue'}, auto_submit_count=2)
+        server.fail_next(1, status=503)
+        with self.assertLogs('appoptics-metrics', logging.WARNING):
+            q.add('temperature', 1)
+            q.add('temperature', 2)
+            while q._pending:
+                await asyncio.sleep(0.001)
+        gc.collect()
+        assert unhandled == []
+        assert q._num_measurements_in_queue() == 2
+
+    def test_auto_submit_needs_a_running_loop(self):
+        q = self.conn.new_queue(tags={'sky': 'blue'}, auto_submit_count=2)
+        q.add('temperature', 1)
+        with self.assertRaises(RuntimeError):
+            q.add('temperature', 2)
+        assert q._num_measurements_in_queue() == 2
+        assert q._pending == {}
+
+    async def test_context_manager(self):
+        async with self.conn.new_queue(tags={'sky': 'blue'}) as q:
+            q.add('temperature', 1)
+        metrics = await self.conn.list_metrics()
+        assert len(metrics) == 1
+
+    async def test_auto_submit(self):
+        q = self.conn.new_queue(tags={'sky': 'blue'}, auto_submit_count=2)
+        q.add('temperature', 1)
+        q.add('temperature', 2)
+        assert q._num_measurements_in_queue() == 0
+        await q.submit()
+        metric = await self.conn.get('temperature')
+        assert len(metric.measurements['unassigned']) == 2
+
+    async def test_buffers_while_circuit_open(self):
+        breaker = CircuitBreaker(window_size=1, min_calls=1)
+        conn = AsyncAppOpticsConnection('key_test', retry_policy=NO_RETRY, circuit_breaker=breaker)
+        server.fail_next(1, status=503)
+        with self.assertRaises(exceptions.ServerError):
+            await conn.list_metrics()
+
+        q = conn.new_queue(tags={'sky': 'blue'}, on_circuit_open='buffer')
+        q.add('temperature', 1)
+        await q.submit()
+        assert q._num_measurements_in_queue() == 1
+
+        breaker.reset()
+        await q.submit()
+        assert q._num_measurements_in_queue() == 0
+        assert breaker.failure_rate() == 0.0
+
+
+class TestAsyncHTTPConnection(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.requests = []
+
+        async def handle(reader, writer):
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                headers = {}
+                while True:
+                    h = await reader.readline()
+                    if h == b"\r\n":
+                        break
+                    k, _, v = h.decode().partition(":")
+                    headers[k.lower()] = v.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                self.requests.append((line, body))
+                if len(self.requests) == 1:
+                    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                                 b"Content-Length: 11\r\n\r\n{\"a\": true}")
+                else:
+                    writer.write(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                                 b"4\r\n{\"b\"\r\n7\r\n: false\r\n1\r\n}\r\n0\r\n\r\n")
+                await writer.drain()
+            writer.close()
+
+        self.server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def test_keep_alive_content_length_and_chunked(self):
+        conn = AsyncHTTPConnection('127.0.0.1', port=self.port, use_ssl=False)
+        resp = await conn.request('POST', '/v1/measurements', body='{}', headers={'Authorization': b'Basic x'})
+        assert resp.status == 200
+        assert resp.read() == b'{"a": true}'
+        resp = await conn.request('GET', '/v1/metrics')
+        assert resp.read() == b'{"b": false}'
+        assert not conn.is_dropped
+        conn.close()
+        # Both requests went over the same socket
+        assert [r[0] for r in self.requests] == [b"POST /v1/measurements HTTP/1.1\r\n", b"GET /v1/metrics HTTP/1.1\r\n"]
+        assert self.requests[0][1] == b'{}'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,12 @@
 import logging
 import unittest
 import appoptics_metrics
-from mock_connection import MockConnect, server
-
-# Mock the server
-appoptics_metrics.HTTPSConnection = MockConnect
+from mock_connection import MockTransport, server
 
 
 class TestAppOpticsAlerts(unittest.TestCase):
     def setUp(self):
-        self.conn = appoptics_metrics.connect('key_test')
+        self.conn = appoptics_metrics.connect('key_test', transport=MockTransport())
         self.name = 'my_alert'
         server.clean()
 
@@ -146,7 +143,7 @@ class TestAppOpticsAlerts(unittest.TestCase):
 
 class TestService(unittest.TestCase):
     def setUp(self):
-        self.conn = appoptics_metrics.connect('key_test')
+        self.conn = appoptics_metrics.connect('key_test', transport=MockTransport())
         self.sample_payload = {
             'title': 'Email Ops',
             'type': 'mail',
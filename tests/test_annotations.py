@@ -1,16 +1,14 @@
 import logging
 import unittest
 import appoptics_metrics
-from mock_connection import MockConnect, server
+from mock_connection import MockTransport, server
 
 # logging.basicConfig(level=logging.DEBUG)
-# Mock the server
-appoptics_metrics.HTTPSConnection = MockConnect
 
 
 class TestAppOpticsAnnotations(unittest.TestCase):
     def setUp(self):
-        self.conn = appoptics_metrics.connect('key_test')
+        self.conn = appoptics_metrics.connect('key_test', transport=MockTransport())
         server.clean()
 
     def test_get_annotation_stream(self):
@@ -0,0 +1,233 @@
+import errno
+import logging
+import socket
+import ssl
+import unittest
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+import appoptics_metrics
+from appoptics_metrics import exceptions
+from appoptics_metrics.aggregator import Aggregator
+from appoptics_metrics.circuit import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+from appoptics_metrics.retry import NO_RETRY
+import mock_connection
+
+# logging.basicConfig(level=logging.DEBUG)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_rate_threshold=0.5, window_size=4, min_calls=4, open_timeout=10)
+
+    def fail(self, n):
+        for _ in range(n):
+            self.breaker.record(exceptions.ServerError(503))
+
+    def test_stays_closed_below_min_calls(self):
+        self.fail(3)
+        assert self.breaker.state == CLOSED
+        assert self.breaker.failure_rate() == 1.0
+
+    def test_opens_at_threshold(self):
+        self.breaker.record()
+        self.breaker.record()
+        self.fail(2)
+        assert self.breaker.state == OPEN
+        assert not self.breaker.allow_request()
+        with self.assertRaises(exceptions.CircuitOpenError):
+            self.breaker.check()
+
+    def test_old_outcomes_leave_the_window(self):
+        self.fail(1)
+        for _ in range(4):
+            self.breaker.record()
+        self.fail(1)
+        assert self.breaker.state == CLOSED
+        assert self.breaker.failure_rate() == 0.25
+
+    def test_client_errors_are_not_failures(self):
+        for _ in range(4):
+            self.breaker.record(exceptions.BadRequest())
+        assert self.breaker.state == CLOSED
+        assert CircuitBreaker.is_failure(socket.timeout())
+        assert CircuitBreaker.is_failure(socket.error(errno.ECONNRESET, 'Connection reset by peer'))
+        assert not CircuitBreaker.is_failure(ssl.SSLError('certificate verify failed'))
+        assert not CircuitBreaker.is_failure(ValueError())
+
+    def test_half_open_probe_closes(self):
+        with patch('time.time', return_value=100):
+            self.fail(4)
+        with patch('time.time', return_value=105):
+            assert self.breaker.state == OPEN
+        with patch('time.time', return_value=110):
+            assert self.breaker.state == HALF_OPEN
+            # Only one probe at a time
+            assert self.breaker.allow_request()
+            assert not self.breaker.allow_request()
+            self.breaker.record_success()
+            assert self.breaker.state == CLOSED
+            assert self.breaker.allow_request()
+
+    def test_half_open_probe_failure_reopens(self):
+        with patch('time.time', return_value=100):
+            self.fail(4)
+        with patch('time.time', return_value=110):
+            assert self.breaker.allow_request()
+            self.fail(1)
+            assert self.breaker.state == OPEN
+        with patch('time.time', return_value=115):
+            assert not self.breaker.allow_request()
+        with patch('time.time', return_value=120):
+            assert self.breaker.allow_request()
+
+    def test_released_probe(self):
+        with patch('time.time', return_value=100):
+            self.fail(4)
+        with patch('time.time', return_value=110):
+            assert self.breaker.allow_request()
+            self.breaker.release_probe()
+            assert self.breaker.allow_request()
+
+    def test_reset(self):
+        self.fail(4)
+        self.breaker.reset()
+        assert self.breaker.state == CLOSED
+        assert self.breaker.failure_rate() == 0.0
+
+
+class TestConnectionCircuit(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(window_size=2, min_calls=2, open_timeout=10)
+        self.conn = appoptics_metrics.connect('key_test', transport=mock_connection.MockTransport(), retry_policy=NO_RETRY, circuit_breaker=self.breaker)
+        mock_connection.server.clean()
+
+    def open_circuit(self):
+        mock_connection.server.fail_next(2, status=503)
+        for _ in range(2):
+            with self.assertRaises(exceptions.ServerError):
+                self.conn.list_metrics()
+        assert self.breaker.state == OPEN
+
+    def test_fails_fast_when_open(self):
+        self.open_circuit()
+        mock_connection.server.fail_next(1, status=503)
+        with self.assertRaises(exceptions.CircuitOpenError):
+            self.conn.list_metrics()
+        # Nothing was sent
+        assert len(mock_connection.server.failures) == 1
+
+    def test_successes_keep_it_closed(self):
+        for _ in range(3):
+            assert self.conn.list_metrics() == []
+        assert self.breaker.state == CLOSED
+
+    def test_probe_closes_circuit(self):
+        self.open_circuit()
+        with patch('time.time', return_value=self.breaker._opened_at + 10):
+            assert self.conn.list_metrics() == []
+        assert self.breaker.state == CLOSED
+
+    def test_queue_raises_by_default(self):
+        self.open_circuit()
+        q = self.conn.new_queue(tags={'hostname': 'web-1'})
+        q.add('cpu', 10)
+        with self.assertRaises(exceptions.CircuitOpenError):
+            q.submit()
+        assert q._num_measurements_in_queue() == 1
+
+    def test_queue_buffers(self):
+        self.open_circuit()
+        q = self.conn.new_queue(tags={'hostname': 'web-1'}, on_circuit_open='buffer')
+        q.add('cpu', 10)
+        q.submit()
+        q.add('cpu', 20)
+        assert q._num_measurements_in_queue() == 2
+
+        self.breaker.reset()
+        q.submit()
+        assert q._num_measurements_in_queue() == 0
+        resp = self.conn.get_tagged('cpu', duration=60, tags_search="hostname=web-1")
+        assert len(resp['series'][0]['measurements']) == 2
+
+    def test_queue_fallback_callable(self):
+        self.open_circuit()
+        unsent = []
+        q = self.conn.new_queue(tags={'hostname': 'web-1'}, on_circuit_open=unsent.extend)
+        q.add('cpu', 10)
+        q.submit()
+        assert q._num_measurements_in_queue() == 0
+        assert len(unsent) == 1
+        assert unsent[0]['measurements'][0]['name'] == 'cpu'
+
+    def test_queue_rejects_unknown_fallback(self):
+        with self.assertRaises(ValueError):
+            self.conn.new_queue(on_circuit_open='drop')
+
+    def background_queue(self, **kwargs):
+        q = self.conn.new_queue(background=True, tags={'hostname': 'web-1'}, on_circuit_open='buffer',
+                                flush_interval=60, max_buffer=3, **kwargs)
+        self.addCleanup(q.close, 0.1)
+        for i in range(2):
+            q.add('cpu', i)
+        q.submit()
+        return q
+
+    def sent_values(self, q):
+        self.breaker.reset()
+        q.submit()
+        resp = self.conn.get_tagged('cpu', duration=60, tags_search="hostname=web-1")
+        return [m['value'] for m in resp['series'][0]['measurements']]
+
+    def test_background_queue_keeps_max_buffer_oldest(self):
+        self.open_circuit()
+        q = self.background_queue(overflow='drop_oldest')
+        for i in range(2, 4):
+            q.add('cpu', i)
+        q.submit()
+        assert q._kept == 3 and q.dropped == 1
+        assert self.sent_values(q) == [1, 2, 3]
+
+    def test_background_queue_keeps_max_buffer_newest(self):
+        self.open_circuit()
+        q = self.background_queue(overflow='drop_newest')
+        for i in range(2, 4):
+            q.add('cpu', i)
+        assert q.dropped == 1
+        assert self.sent_values(q) == [0, 1, 2]
+
+    def test_background_queue_keeps_max_buffer_block(self):
+        self.open_circuit()
+        q = self.background_queue(block_timeout=0.05)
+        q.add('cpu', 2)
+        with self.assertRaises(exceptions.QueueFull):
+            q.add('cpu', 3)
+        assert self.sent_values(q) == [0, 1, 2]
+
+    def test_aggregator_buffers(self):
+        self.open_circuit()
+        a = Aggregator(self.conn, tags={'hostname': 'web-1'}, on_circuit_open='buffer')
+        a.add_tagged('cpu', 10)
+        a.submit()
+        a.add_tagged('cpu', 20)
+        assert a.tagged_measurements['cpu']['count'] == 2
+
+        self.breaker.reset()
+        with patch.object(self.conn, '_mexe') as mexe:
+            a.submit()
+        assert mexe.call_args[1]['query_props']['measurements'][0]['sum'] == 30
+        assert a.tagged_measurements == {}
+
+    def test_aggregator_fallback_callable(self):
+        self.open_circuit()
+        unsent = []
+        a = Aggregator(self.conn, tags={'hostname': 'web-1'}, on_circuit_open=unsent.extend)
+        a.add_tagged('cpu', 10)
+        a.submit()
+        assert a.tagged_measurements == {}
+        assert unsent[0]['measurements'][0]['sum'] == 10
+
+
+if __name__ == '__main__':
+    unittest.main()
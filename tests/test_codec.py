@@ -0,0 +1,89 @@
+import json
+import logging
+import unittest
+import appoptics_metrics
+from appoptics_metrics import codec
+from appoptics_metrics.codec import JSONCodec, OrjsonCodec, UjsonCodec, default_codec
+from appoptics_metrics.transport import Response
+from mock_connection import MockTransport, server
+
+# logging.basicConfig(level=logging.DEBUG)
+
+
+def installed_codecs():
+    codecs = [JSONCodec()]
+    for klass in (OrjsonCodec, UjsonCodec):
+        try:
+            codecs.append(klass())
+        except ImportError:
+            pass
+    return codecs
+
+
+class TestCodecs(unittest.TestCase):
+    payload = {'tags': {'host': u'h\xf4te'}, 'measurements': [
+        {'name': 'cpu', 'value': 1.5, 'time': 1500000000, 'tags': {'url': '/a/b'}},
+        {'name': 'mem', 'sum': 10, 'count': 2, 'period': None, 'flag': True}]}
+
+    def test_round_trip(self):
+        for c in installed_codecs():
+            body = c.dumps(self.payload)
+            assert isinstance(body, bytes), c.name
+            assert json.loads(body.decode('utf-8')) == self.payload, c.name
+            assert c.loads(body) == self.payload, c.name
+            assert c.loads(body.decode('utf-8')) == self.payload, c.name
+
+    def test_non_str_keys(self):
+        for c in installed_codecs():
+            assert json.loads(c.dumps({1: 'a'}).decode('utf-8')) == {'1': 'a'}, c.name
+
+    def test_default_codec(self):
+        expected = 'orjson' if codec.orjson else 'ujson' if codec.ujson else 'json'
+        assert default_codec().name == expected
+
+    def test_missing_library(self):
+        orjson, codec.orjson = codec.orjson, None
+        try:
+            with self.assertRaises(ImportError):
+                OrjsonCodec()
+            assert default_codec().name != 'orjson'
+        finally:
+            codec.orjson = orjson
+
+
+class RecordingCodec(JSONCodec):
+    def __init__(self):
+        self.encoded = []
+        self.decoded = []
+
+    def dumps(self, obj):
+        self.encoded.append(obj)
+        return JSONCodec.dumps(self, obj)
+
+    def loads(self, data):
+        self.decoded.append(data)
+        return JSONCodec.loads(self, data)
+
+
+class TestConnectionCodec(unittest.TestCase):
+    def setUp(self):
+        server.clean()
+
+    def test_requests_and_responses_go_through_the_codec(self):
+        recorder = RecordingCodec()
+        conn = appoptics_metrics.connect('key_test', transport=MockTransport(), tags={'host': 'web-1'},
+                                         codec=recorder)
+        conn.submit('temperature', 22)
+        conn.list_metrics()
+        assert recorder.encoded[0]['measurements'][0]['name'] == 'temperature'
+        assert [json.loads(d.decode('utf-8'))['metrics'][0]['name'] for d in recorder.decoded] == ['temperature']
+
+    def test_other_charsets_are_decoded_first(self):
+        recorder = RecordingCodec()
+        resp = Response(200, [('content-type', 'application/json; charset=latin-1')], u'{"a": "é"}'.encode('latin-1'))
+        assert appoptics_metrics._decode_body(resp, codec=recorder) == {'a': u'é'}
+        assert recorder.decoded == [u'{"a": "é"}']
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import logging
+import unittest
+import appoptics_metrics
+from appoptics_metrics import columnar
+from appoptics_metrics.columnar import ColumnStore
+from mock_connection import MockTransport, server
+
+# logging.basicConfig(level=logging.DEBUG)
+
+
+class TestColumnStore(unittest.TestCase):
+    def test_round_trip(self):
+        store = ColumnStore()
+        measurements = [
+            {'name': 'cpu', 'tags': {'host': 'a'}, 'sum': 1.5, 'count': 1},
+            {'name': 'cpu', 'tags': {'host': 'b'}, 'sum': 2.0, 'count': 1, 'time': 1500000000},
+            {'name': 'mem', 'tags': {'host': 'a'}, 'sum': 10.0, 'count': 2, 'min': 4.0, 'max': 6.0},
+            {'name': 'mem', 'tags': {'host': 'a'}, 'sum': 3.0, 'count': 1, 'period': 60}]
+        for nm in measurements:
+            store.append(dict(nm))
+        assert len(store) == 4
+        assert store.pop_chunks(3) == [{'measurements': measurements[:3]}, {'measurements': measurements[3:]}]
+        assert len(store) == 0
+
+    def test_names_and_tags_are_interned(self):
+        store = ColumnStore()
+        for i in range(100):
+            store.append({'name': 'cpu', 'tags': {'host': 'a', 'az': str(i % 2)}, 'sum': i, 'count': 1})
+        assert len(store._names) == 1
+        assert len(store._tag_sets) == 2
+
+    def test_pop_some_chunks(self):
+        store = ColumnStore()
+        for i in range(10):
+            store.append({'name': 'cpu', 'tags': {}, 'sum': i, 'count': 1})
+        chunks = store.pop_chunks(3, 2)
+        assert [[m['sum'] for m in c['measurements']] for c in chunks] == [[0, 1, 2], [3, 4, 5]]
+        assert len(store) == 4
+        # Appending after a partial pop
+        store.append({'name': 'cpu', 'tags': {}, 'sum': 10, 'count': 1})
+        assert [m['sum'] for c in store.pop_chunks(3) for m in c['measurements']] == [6, 7, 8, 9, 10]
+        # Everything sent: the interned values are dropped
+        assert store._names == []
+
+    def test_compaction(self):
+        store = ColumnStore()
+        old, columnar._COMPACT_ROWS = columnar._COMPACT_ROWS, 4
+        try:
+            for i in range(10):
+                store.append({'name': 'cpu', 'tags': {}, 'sum': i, 'count': 1, 'period': i})
+            store.pop_chunks(6, 1)
+        finally:
+            columnar._COMPACT_ROWS = old
+        assert len(store._sums) == 4
+        assert [(m['sum'], m['period']) for c in store.pop_chunks(10) for m in c['measurements']] == \
+            [(6, 6), (7, 7), (8, 8), (9, 9)]
+
+    def test_merge(self):
+        store = ColumnStore()
+        row = store.append({'name': 'cpu', 'tags': {}, 'sum': 5.0, 'count': 1, 'min': 5.0, 'max': 5.0})
+        store.merge(row, {'sum': 1.0, 'count': 1}, 1.0, 1.0)
+        store.merge(row, {'sum': 9.0, 'count': 1}, 9.0, 9.0)
+        assert store.pop_chunks(10)[0]['measurements'] == [
+            {'name': 'cpu', 'sum': 15.0, 'count': 3, 'min': 1.0, 'max': 9.0}]
+
+    def test_sums_keep_their_type(self):
+        store = ColumnStore()
+        store.append({'name': 'requests', 'sum': 2 ** 60, 'count': 1})
+        row = store.append({'name': 'requests', 'tags': {'host': 'a'}, 'sum': 3, 'count': 1, 'min': 3, 'max': 3})
+        store.merge(row, {'sum': 4, 'count': 1}, 4, 4)
+        assert store._int_rows is None
+        store.append({'name': 'latency', 'sum': 0.5, 'count': 1})
+        row = store.append({'name': 'requests', 'sum': 1, 'count': 1})
+        store.merge(row, {'sum': 0.25, 'count': 1}, 0.25, 0.25)
+        measurements = store.pop_chunks(10)[0]['measurements']
+        assert measurements == [
+            {'name': 'requests', 'sum': 2 ** 60, 'count': 1},
+            {'name': 'requests', 'tags': {'host': 'a'}, 'sum': 7, 'count': 2, 'min': 3, 'max': 4},
+            {'name': 'latency', 'sum': 0.5, 'count': 1},
+            {'name': 'requests', 'sum': 1.25, 'count': 2}]
+        assert [type(m['sum']) for m in measurements] == [int, int, float, float]
+        assert type(measurements[1]['min']) is int
+
+
+class TestCompactQueue(unittest.TestCase):
+    def setUp(self):
+        server.clean()
+        self.transport = MockTransport()
+        self.conn = appoptics_metrics.connect('key_test', transport=self.transport, tags={'host': 'web-1'})
+
+    def test_submit(self):
+        q = self.conn.new_queue(compact=True)
+        for i in range(q.MAX_MEASUREMENTS_PER_CHUNK * 2 + 5):
+            q.add('temperature', i)
+        assert q.tagged_chunks == []
+        assert q._num_measurements_in_queue() == q.MAX_MEASUREMENTS_PER_CHUNK * 2 + 5
+        q.submit()
+        assert len(self.transport.requests) == 3
+        measurements = self.conn.get('temperature').measurements['unassigned']
+        assert [m['value'] for m in measurements] == list(range(q.MAX_MEASUREMENTS_PER_CHUNK * 2 + 5))
+        assert q._num_measurements_in_queue() == 0
+
+    def test_failed_chunks_stay_queued(self):
+        q = self.conn.new_queue(compact=True)
+        q.MAX_MEASUREMENTS_PER_CHUNK = 2
+        for i in range(5):
+            q.add('temperature', i)
+        server.fail_next(1, status=400)
+        with self.assertRaises(appoptics_metrics.exceptions.BadRequest):
+            q.submit()
+        # Only the failed chunk was built
+        assert len(q.tagged_chunks) == 1
+        assert q._num_measurements_in_queue() == 5
+        q.submit()
+        assert len(self.conn.get('temperature').measurements['unassigned']) == 5
+
+    def test_circuit_open_callback_gets_everything(self):
+        unsent = []
+        q = self.conn.new_queue(compact=True, on_circuit_open=unsent.extend)
+        q.MAX_MEASUREMENTS_PER_CHUNK = 2
+        for i in range(5):
+            q.add('temperature', i)
+        q._circuit_open(appoptics_metrics.exceptions.CircuitOpenError())
+        assert sum(len(c['measurements']) for c in unsent) == 5
+        assert q._num_measurements_in_queue() == 0
+
+    def test_coalesce(self):
+        q = self.conn.new_queue(compact=True, coalesce=True)
+        for v in (3, 1, 5):
+            q.add('requests', v)
+        q.add('requests', 2, tags={'host': 'web-2'})
+        measurements = q._store.pop_chunks(10)[0]['measurements']
+        assert measurements[0] == {'name': 'requests', 'tags': {'host': 'web-1'}, 'sum': 9, 'count': 3,
+                                   'min': 1, 'max': 5}
+        assert measurements[1]['count'] == 1
+
+    def test_memory_per_measurement(self):
+        try:
+            import tracemalloc
+        except ImportError:
+            self.skipTest("tracemalloc needs Python 3.4+")
+        count = 20000
+        sizes = {}
+        for compact in (False, True):
+            q = self.conn.new_queue(compact=compact)
+            tracemalloc.start()
+            try:
+                for i in range(count):
+                    q.add('app.latency.%d' % (i % 50), i * 0.5, tags={'endpoint': '/e%d' % (i % 20)})
+                size = tracemalloc.get_traced_memory()[0]
+            finally:
+                tracemalloc.stop()
+            sizes[compact] = float(size) / count
+        assert sizes[True] < 64
+        assert sizes[True] * 5 < sizes[False]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import gzip
+import io
+import logging
+import unittest
+try:
+    from unittest.mock import create_autospec
+except ImportError:
+    from mock import create_autospec
+import appoptics_metrics
+from mock_connection import MockTransport, server
+from six.moves.http_client import HTTPResponse
+
+# logging.basicConfig(level=logging.DEBUG)
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        server.clean()
+        self.transport = MockTransport()
+
+    def test_large_post_is_gzipped(self):
+        conn = appoptics_metrics.connect('key_test', transport=self.transport, gzip=True, tags={'host': 'web-1', 'region': 'us-east-1'})
+        q = conn.new_queue()
+        for i in range(q.MAX_MEASUREMENTS_PER_CHUNK):
+            q.add('temperature', 1)
+        q.submit()
+
+        method, uri, body, headers = self.transport.requests[0]
+        assert headers['Content-Encoding'] == 'gzip'
+        raw = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+        assert len(body) * 10 < len(raw)
+        # The mock server got all of them
+        assert len(conn.get('temperature').measurements['unassigned']) == q.MAX_MEASUREMENTS_PER_CHUNK
+
+    def test_small_post_is_not_gzipped(self):
+        conn = appoptics_metrics.connect('key_test', transport=self.transport, gzip=True, tags={'host': 'web-1'})
+        conn.submit('temperature', 1)
+        method, uri, body, headers = self.transport.requests[0]
+        assert 'Content-Encoding' not in headers
+        assert headers['Accept-Encoding'] == 'gzip'
+
+    def test_min_size_and_level(self):
+        conn = appoptics_metrics.connect('key_test', transport=self.transport, gzip=True, gzip_min_size=0, gzip_level=9, tags={'a': 'b'})
+        conn.submit('temperature', 1)
+        assert self.transport.requests[0][3]['Content-Encoding'] == 'gzip'
+
+    def test_disabled_by_default(self):
+        conn = appoptics_metrics.connect('key_test', transport=self.transport, gzip_min_size=0, tags={'a': 'b'})
+        conn.submit('temperature', 1)
+        headers = self.transport.requests[0][3]
+        assert 'Content-Encoding' not in headers
+        assert 'Accept-Encoding' not in headers
+
+    def test_gzipped_response_is_decoded(self):
+        mock_response = create_autospec(HTTPResponse, spec_set=True, instance=True)
+        mock_response.mock_add_spec(['status'], spec_set=True)
+        mock_response.status = 200
+        mock_response.getheader.side_effect = lambda name, default=None: {
+            'content-type': 'application/json;charset=utf-8',
+            'content-encoding': 'gzip'}.get(name.lower(), default)
+        mock_response.read.return_value = appoptics_metrics._gzip_compress(b'{"metrics": []}')
+        assert appoptics_metrics._decode_body(mock_response) == {'metrics': []}
+
+
+if __name__ == '__main__':
+    unittest.main()
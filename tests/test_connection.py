@@ -4,12 +4,40 @@ try:
     from unittest.mock import patch
 except ImportError:
     from mock import patch
+import errno
+import socket
 import appoptics_metrics
 from mock_connection import MockConnect, server
 
 # logging.basicConfig(level=logging.DEBUG)
 # Mock the server
-appoptics_metrics.HTTPSConnection = MockConnect
+appoptics_metrics.transport.HTTPSConnection = MockConnect
+
+
+class CountingConnect(MockConnect):
+    """MockConnect that remembers every instance created"""
+    instances = []
+
+    def __init__(self, *args, **kwargs):
+        MockConnect.__init__(self, *args, **kwargs)
+        self.closed = False
+        self.requests = 0
+        CountingConnect.instances.append(self)
+
+    def request(self, method, uri, body, headers):
+        self.requests += 1
+        MockConnect.request(self, method, uri, body, headers)
+
+    def close(self):
+        self.closed = True
+
+
+class DroppedConnect(CountingConnect):
+    """Simulates a keep-alive socket the server closed after the first request"""
+    def request(self, method, uri, body, headers):
+        if self.requests >= 1:
+            raise socket.error(errno.EPIPE, 'Broken pipe')
+        CountingConnect.request(self, method, uri, body, headers)
 
 
 class TestConnection(unittest.TestCase):
@@ -46,5 +74,49 @@ class TestConnection(unittest.TestCase):
         self.conn.custom_ua = 'foo'
         assert self.conn._compute_ua() == 'foo'
 
+
+class TestKeepAlive(unittest.TestCase):
+    def setUp(self):
+        self.conn = appoptics_metrics.connect('key_test')
+        server.clean()
+        CountingConnect.instances = []
+        patcher = patch('appoptics_metrics.transport.HTTPSConnection', CountingConnect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_socket_is_reused(self):
+        for _ in range(3):
+            self.conn.list_metrics()
+        assert len(CountingConnect.instances) == 1
+        assert CountingConnect.instances[0].requests == 3
+        assert not CountingConnect.instances[0].closed
+
+    def test_max_requests_per_socket(self):
+        self.conn.pool.max_requests = 2
+        for _ in range(3):
+            self.conn.list_metrics()
+        assert len(CountingConnect.instances) == 2
+        assert CountingConnect.instances[0].closed
+
+    def test_idle_timeout(self):
+        self.conn.pool.idle_timeout = 0
+        self.conn.list_metrics()
+        self.conn.list_metrics()
+        assert len(CountingConnect.instances) == 2
+
+    def test_reconnect_on_dropped_socket(self):
+        with patch('appoptics_metrics.transport.HTTPSConnection', DroppedConnect):
+            self.conn.list_metrics()
+            assert len(self.conn.list_metrics()) == 0
+        assert len(CountingConnect.instances) == 2
+        assert CountingConnect.instances[0].closed
+
+    def test_close(self):
+        self.conn.list_metrics()
+        self.conn.close()
+        assert CountingConnect.instances[0].closed
+        self.conn.list_metrics()
+        assert len(CountingConnect.instances) == 2
+
 if __name__ == '__main__':
     unittest.main()
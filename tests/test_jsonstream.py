@@ -0,0 +1,137 @@
+import json
+import logging
+import unittest
+import appoptics_metrics
+from appoptics_metrics import jsonstream
+from appoptics_metrics.jsonstream import ItemStream
+from appoptics_metrics.transport import HTTPClientTransport
+from mock_connection import MockConnect, MockTransport, server
+
+# logging.basicConfig(level=logging.DEBUG)
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestItemStream(unittest.TestCase):
+    def test_items_and_meta(self):
+        body = json.dumps({'query': {'total': 3}, 'metrics': [{'name': 'a'}, {'name': u'été'}, 1.5],
+                           'links': []}).encode('utf-8')
+        # Down to one byte at a time, splitting multi-byte characters
+        for size in (1, 2, 7, len(body)):
+            stream = ItemStream(chunked(body, size), 'metrics')
+            assert list(stream) == [{'name': 'a'}, {'name': u'été'}, 1.5]
+            assert stream.meta == {'query': {'total': 3}, 'links': []}
+
+    def test_numbers_across_chunks(self):
+        stream = ItemStream([b'{"v": [12', b'34, 5', b'6]}'], 'v')
+        assert list(stream) == [1234, 56]
+
+    def test_split_at_every_offset(self):
+        body = b'{"v": [10.5, -2e+3, 1E-2, 7, 0.25], "series": [{"weight": 10.5, "measurements": [{"value": 3.75}]}]}'
+        expected = json.loads(body.decode('utf-8'))
+        for i in range(len(body) + 1):
+            assert list(ItemStream([body[:i], body[i:]], 'v')) == expected['v'], i
+            stream = ItemStream([body[:i], body[i:]], 'series', subkey='measurements')
+            assert list(stream) == [({'weight': 10.5}, {'value': 3.75})], i
+
+    def test_subkey(self):
+        body = json.dumps({'name': 'cpu', 'series': [
+            {'tags': {'host': 'a'}, 'measurements': [{'value': 1}, {'value': 2}]},
+            {'tags': {'host': 'b'}, 'measurements': []},
+            {'tags': {'host': 'c'}, 'measurements': [{'value': 3}]}]}).encode('utf-8')
+        pairs = list(ItemStream(chunked(body, 5), 'series', subkey='measurements'))
+        assert [(s['tags']['host'], m['value']) for s, m in pairs] == [('a', 1), ('a', 2), ('c', 3)]
+
+    def test_empty_and_missing(self):
+        assert list(ItemStream([b'{"metrics": []}'], 'metrics')) == []
+        stream = ItemStream([b'{"query": null}'], 'metrics')
+        assert list(stream) == []
+        assert stream.meta == {'query': None}
+        assert list(ItemStream([b' {} '], 'metrics')) == []
+
+    def test_gzipped(self):
+        body = appoptics_metrics._gzip_compress(json.dumps({'metrics': list(range(1000))}).encode('utf-8'))
+        assert list(ItemStream(chunked(body, 10), 'metrics', gzipped=True)) == list(range(1000))
+
+    def test_malformed(self):
+        with self.assertRaises(ValueError):
+            list(ItemStream([b'{"metrics": [1, 2'], 'metrics'))
+        with self.assertRaises(ValueError):
+            list(ItemStream([b'[1, 2]'], 'metrics'))
+
+    def test_closed_when_abandoned(self):
+        closed = []
+        stream = ItemStream([b'{"metrics": [1, 2, 3]}'], 'metrics', close=lambda: closed.append(1))
+        for item in stream:
+            break
+        del item
+        stream_iter = iter(ItemStream([b'{"metrics": [1]}'], 'metrics', close=lambda: closed.append(2)))
+        list(stream_iter)
+        assert 2 in closed
+
+    def test_memory_is_bounded(self):
+        item = {'name': 'x' * 100, 'tags': {'host': 'web-1'}}
+        count = 20000
+
+        def chunks():
+            yield b'{"metrics": ['
+            for i in range(count):
+                yield (json.dumps(item) + (',' if i < count - 1 else '')).encode('utf-8')
+            yield b']}'
+
+        stream = ItemStream(chunks(), 'metrics')
+        largest = 0
+        for n, _ in enumerate(stream, 1):
+            largest = max(largest, len(stream._reader._buf))
+        assert n == count
+        assert largest < 2 * jsonstream._COMPACT_SIZE
+
+
+class TestStreamedRequests(unittest.TestCase):
+    def setUp(self):
+        server.clean()
+
+    def test_stream_tagged(self):
+        conn = appoptics_metrics.connect('key_test', transport=MockTransport(), tags={'host': 'web-1'})
+        conn.submit('cpu', 1)
+        conn.submit('cpu', 2)
+        stream = conn.stream_tagged('cpu', duration=60, tags_search="host=web-1")
+        assert [(s['tags'], m['value']) for s, m in stream] == [({'host': 'web-1'}, 1), ({'host': 'web-1'}, 2)]
+        assert stream.meta['name'] == 'cpu'
+
+    def test_stream_tagged_needs_a_time_range(self):
+        conn = appoptics_metrics.connect('key_test', transport=MockTransport())
+        with self.assertRaises(Exception):
+            conn.stream_tagged('cpu')
+
+    def test_streamed_pages_release_the_socket(self):
+        transport = HTTPClientTransport(connection_factory=lambda scheme, host, timeout: MockConnect(host))
+        conn = appoptics_metrics.connect('key_test', transport=transport, tags={'host': 'web-1'})
+        for i in range(3):
+            conn.submit('metric_%d' % i, i)
+        metrics = conn.list_all_metrics(stream=True)
+        assert [m.name for m in metrics] == ['metric_0', 'metric_1', 'metric_2']
+        assert metrics.offset == 3
+        assert transport.pool.num_idle(('https', conn.hostname)) == 1
+
+    def test_abandoned_stream_discards_the_socket(self):
+        transport = HTTPClientTransport(connection_factory=lambda scheme, host, timeout: MockConnect(host))
+        conn = appoptics_metrics.connect('key_test', transport=transport, tags={'host': 'web-1'})
+        for i in range(3):
+            conn.submit('metric_%d' % i, i)
+        assert transport.pool.num_open(('https', conn.hostname)) == 1
+        stream = conn._stream('metrics', 'metrics')
+        next(iter(stream))
+        stream.close()
+        assert transport.pool.num_open(('https', conn.hostname)) == 0
+
+    def test_stream_and_parallelism_are_exclusive(self):
+        conn = appoptics_metrics.connect('key_test', transport=MockTransport())
+        with self.assertRaises(ValueError):
+            conn.list_all_metrics(stream=True, parallelism=4)
+
+
+if __name__ == '__main__':
+    unittest.main()
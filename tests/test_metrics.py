@@ -4,13 +4,12 @@ try:
     from unittest.mock import patch
 except ImportError:
     from mock import patch
+import threading
 import appoptics_metrics
 import time
-from mock_connection import MockConnect, server
+from mock_connection import MockTransport, server
 
 # logging.basicConfig(level=logging.DEBUG)
-# Mock the server
-appoptics_metrics.HTTPSConnection = MockConnect
 
 fake_metric = {
     "name": "3333",
@@ -27,7 +26,7 @@ fake_metric = {
 
 class TestAppOptics(unittest.TestCase):
     def setUp(self):
-        self.conn = appoptics_metrics.connect('key_test', tags={"region": "us-east-1"})
+        self.conn = appoptics_metrics.connect('key_test', transport=MockTransport(), tags={"region": "us-east-1"})
         server.clean()
 
     def test_list_metrics_when_there_are_no_metrics(self):
@@ -61,6 +60,50 @@ class TestAppOptics(unittest.TestCase):
             assert len(metrics) == 12
             assert list_prop.call_count == 3
 
+    def _paged_list(self, total, delays=None):
+        """A fake _mexe serving `total` numbered metrics, tracking requests in flight"""
+        state = {'in_flight': 0, 'max_in_flight': 0, 'offsets': []}
+        lock = threading.Lock()
+
+        def mock_list(entity, query_props=None):
+            length, offset = query_props['length'], query_props.get('offset', 0)
+            with lock:
+                state['offsets'].append(offset)
+                state['in_flight'] += 1
+                state['max_in_flight'] = max(state['max_in_flight'], state['in_flight'])
+            time.sleep((delays or {}).get(offset, 0.01))
+            with lock:
+                state['in_flight'] -= 1
+            page = [dict(fake_metric, name=str(i)) for i in range(offset, min(offset + length, total))]
+            return {"query": {"offset": offset, "length": len(page), "found": total, "total": total},
+                    "metrics": page}
+        return mock_list, state
+
+    def test_list_all_metrics_in_parallel(self):
+        mock_list, state = self._paged_list(100)
+        with patch.object(self.conn, '_mexe', side_effect=mock_list):
+            metrics = list(self.conn.list_all_metrics(length=10, parallelism=4))
+        assert [m.name for m in metrics] == [str(i) for i in range(100)]
+        assert sorted(state['offsets']) == list(range(0, 100, 10))
+        assert 1 < state['max_in_flight'] <= 4
+
+    def test_list_all_metrics_unordered(self):
+        # The second page is the slowest one
+        mock_list, state = self._paged_list(30, delays={10: 0.2})
+        with patch.object(self.conn, '_mexe', side_effect=mock_list):
+            names = [m.name for m in self.conn.list_all_metrics(length=10, parallelism=2, ordered=False)]
+        assert sorted(names, key=int) == [str(i) for i in range(30)]
+        assert names[10:20] == [str(i) for i in range(20, 30)]
+
+    def test_list_all_metrics_in_parallel_stops_early(self):
+        mock_list, state = self._paged_list(1000)
+        with patch.object(self.conn, '_mexe', side_effect=mock_list):
+            for i, metric in enumerate(self.conn.list_all_metrics(length=10, parallelism=3)):
+                if i == 25:
+                    break
+        # Only a bounded window of pages was requested ahead
+        assert len(state['offsets']) <= 7
+
     def test_list_metrics_adding_gauge(self):
         """ Notice that the api forces you to send a value even when you are
             just trying to create the metric without measurements."""
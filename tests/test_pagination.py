@@ -0,0 +1,93 @@
+import logging
+import unittest
+import appoptics_metrics
+from appoptics_metrics.metrics import Metric
+from appoptics_metrics.pagination import Paginator
+from mock_connection import MockTransport, server
+
+# logging.basicConfig(level=logging.DEBUG)
+
+
+class FakeListing(object):
+    """Stands in for _mexe, serving `total` numbered metrics"""
+
+    def __init__(self, total):
+        self.total = total
+        self.requests = []
+
+    def __call__(self, entity, query_props=None):
+        self.requests.append(dict(query_props))
+        offset = query_props.get('offset', 0)
+        length = query_props.get('length', 100)
+        page = [{'name': str(i), 'type': 'gauge', 'period': 60, 'attributes': {}}
+                for i in range(offset, min(offset + length, self.total))]
+        return {'query': {'offset': offset, 'length': len(page), 'found': self.total, 'total': self.total},
+                'metrics': page}
+
+
+class TestPaginator(unittest.TestCase):
+    def setUp(self):
+        server.clean()
+        self.conn = appoptics_metrics.connect('key_test', transport=MockTransport())
+
+    def listing(self, total):
+        self.conn._mexe = FakeListing(total)
+        return self.conn._mexe
+
+    def test_many_pages_do_not_recurse(self):
+        self.listing(5000)
+        names = [m.name for m in self.conn.list_all_metrics(length=1)]
+        assert len(names) == 5000
+        assert names[-1] == '4999'
+
+    def test_page_size(self):
+        listing = self.listing(25)
+        metrics = self.conn.list_all_metrics(length=10)
+        assert isinstance(metrics, Paginator)
+        assert len(list(metrics)) == 25
+        assert [r.get('offset') for r in listing.requests] == [None, 10, 20]
+        assert all(r['length'] == 10 for r in listing.requests)
+        assert metrics.total == 25
+
+    def test_resume_token(self):
+        self.listing(25)
+        metrics = self.conn.list_all_metrics(length=10)
+        for i, metric in enumerate(metrics):
+            if i == 12:
+                break
+        assert metrics.offset == 13
+
+        resumed = self.conn.list_all_metrics(length=10, offset=metrics.offset)
+        assert [m.name for m in resumed] == [str(i) for i in range(13, 25)]
+        assert resumed.offset == 25
+
+    def test_resume_token_unordered(self):
+        self.listing(25)
+        metrics = self.conn.list_all_metrics(length=10, parallelism=2, ordered=False)
+        names = sorted(m.name for m in metrics)
+        assert len(names) == 25
+        assert metrics.offset == 25
+
+    def test_resume_token_in_parallel(self):
+        self.listing(50)
+        metrics = self.conn.list_all_metrics(length=10, parallelism=3)
+        for i, metric in enumerate(metrics):
+            if i == 31:
+                break
+        assert metrics.offset == 32
+
+    def test_empty_listing(self):
+        self.listing(0)
+        metrics = self.conn.list_all_metrics()
+        assert list(metrics) == []
+        assert metrics.offset is None
+
+    def test_paginator_without_query_info(self):
+        server.clean()
+        conn = appoptics_metrics.connect('key_test', transport=MockTransport(), tags={'sky': 'blue'})
+        conn.submit('temperature', 1)
+        assert [m.name for m in Paginator(conn, 'metrics', Metric)] == ['temperature']
+
+
+if __name__ == '__main__':
+    unittest.main()
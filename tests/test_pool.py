@@ -0,0 +1,136 @@
+import logging
+import socket
+import threading
+import unittest
+import appoptics_metrics
+from appoptics_metrics.pool import ConnectionPool
+from appoptics_metrics.exceptions import PoolTimeout
+from mock_connection import MockConnect, server
+
+# logging.basicConfig(level=logging.DEBUG)
+# Mock the server
+appoptics_metrics.transport.HTTPSConnection = MockConnect
+
+KEY = ('https', 'api.appoptics.com')
+
+
+class FakeConnection(object):
+    def __init__(self, sock=None):
+        self.sock = sock
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestConnectionPool(unittest.TestCase):
+    def test_reuses_released_connection(self):
+        pool = ConnectionPool(maxsize=2)
+        pooled = pool.acquire(KEY, FakeConnection)
+        pool.release(pooled)
+        again = pool.acquire(KEY, FakeConnection)
+        assert again.conn is pooled.conn
+        assert again.reused
+        assert pool.num_open(KEY) == 1
+
+    def test_keyed_by_host(self):
+        pool = ConnectionPool(maxsize=1, block=False)
+        a = pool.acquire(KEY, FakeConnection)
+        b = pool.acquire(('http', 'localhost'), FakeConnection)
+        assert a.conn is not b.conn
+
+    def test_fail_fast_when_exhausted(self):
+        pool = ConnectionPool(maxsize=1, block=False)
+        pool.acquire(KEY, FakeConnection)
+        with self.assertRaises(PoolTimeout):
+            pool.acquire(KEY, FakeConnection)
+
+    def test_blocking_acquire_times_out(self):
+        pool = ConnectionPool(maxsize=1, timeout=0.05)
+        pool.acquire(KEY, FakeConnection)
+        with self.assertRaises(PoolTimeout):
+            pool.acquire(KEY, FakeConnection)
+
+    def test_blocking_acquire_waits_for_release(self):
+        pool = ConnectionPool(maxsize=1, timeout=5)
+        pooled = pool.acquire(KEY, FakeConnection)
+        timer = threading.Timer(0.05, pool.release, [pooled])
+        timer.start()
+        again = pool.acquire(KEY, FakeConnection)
+        timer.join()
+        assert again.conn is pooled.conn
+
+    def test_not_reusable_frees_a_slot(self):
+        pool = ConnectionPool(maxsize=1, block=False)
+        pooled = pool.acquire(KEY, FakeConnection)
+        pool.release(pooled, reusable=False)
+        assert pooled.conn.closed
+        assert pool.num_open(KEY) == 0
+        assert pool.acquire(KEY, FakeConnection).conn is not pooled.conn
+
+    def test_discards_dropped_socket(self):
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        pool = ConnectionPool()
+        pooled = pool.acquire(KEY, lambda: FakeConnection(ours))
+        pool.release(pooled)
+        # The server side goes away while the socket is idle
+        theirs.close()
+        again = pool.acquire(KEY, FakeConnection)
+        assert again.conn is not pooled.conn
+        assert pooled.conn.closed
+        assert pool.num_open(KEY) == 1
+
+    def test_keeps_healthy_socket(self):
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(theirs.close)
+        pool = ConnectionPool()
+        pooled = pool.acquire(KEY, lambda: FakeConnection(ours))
+        pool.release(pooled)
+        assert pool.acquire(KEY, FakeConnection).conn is pooled.conn
+
+    def test_clear(self):
+        pool = ConnectionPool()
+        pooled = pool.acquire(KEY, FakeConnection)
+        pool.release(pooled)
+        pool.clear()
+        assert pooled.conn.closed
+        assert pool.num_open(KEY) == 0
+        assert pool.num_idle(KEY) == 0
+
+
+class TestSharedConnection(unittest.TestCase):
+    def setUp(self):
+        server.clean()
+
+    def test_threads_share_bounded_pool(self):
+        conn = appoptics_metrics.connect('key_test', pool_maxsize=2)
+        errors = []
+
+        def list_metrics():
+            try:
+                for _ in range(20):
+                    conn.list_metrics()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=list_metrics) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert errors == []
+        assert conn.pool.num_open(('https', conn.hostname)) <= 2
+
+    def test_connections_can_share_a_pool(self):
+        pool = ConnectionPool(maxsize=1)
+        a = appoptics_metrics.connect('key_test', pool=pool)
+        b = appoptics_metrics.connect('other_key', pool=pool)
+        a.list_metrics()
+        b.list_metrics()
+        assert pool.num_open(('https', a.hostname)) == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,17 +5,15 @@ try:
 except ImportError:
     from mock import create_autospec, PropertyMock
 import appoptics_metrics
-from mock_connection import MockConnect, server
+from mock_connection import MockTransport, server
 from six.moves.http_client import HTTPResponse
 
 # logging.basicConfig(level=logging.DEBUG)
-# Mock the server
-appoptics_metrics.HTTPSConnection = MockConnect
 
 
 class TestAppOptics(unittest.TestCase):
     def setUp(self):
-        self.conn = appoptics_metrics.connect('key_test')
+        self.conn = appoptics_metrics.connect('key_test', transport=MockTransport())
         server.clean()
 
     def test_get_authentication_failure(self):
@@ -30,7 +28,7 @@ class TestAppOptics(unittest.TestCase):
         mock_response.read.return_value = '{"errors":{"request":["Authorization Required"]}}'.encode('utf-8')
 
         with self.assertRaises(appoptics_metrics.exceptions.Unauthorized):
-            self.conn._process_response(mock_response, 1)
+            self.conn._process_response(mock_response)
 
     def test_post_authentication_failure(self):
         """
@@ -44,4 +42,4 @@ class TestAppOptics(unittest.TestCase):
         mock_response.read.return_value = 'Credentials are required to access this resource.'.encode('utf-8')
 
         with self.assertRaises(appoptics_metrics.exceptions.Unauthorized):
-            self.conn._process_response(mock_response, 1)
+            self.conn._process_response(mock_response)
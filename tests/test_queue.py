@@ -1,18 +1,23 @@
 import logging
+import sys
+import threading
 import unittest
 import appoptics_metrics
+from appoptics_metrics import exceptions
 from appoptics_metrics.aggregator import Aggregator
-from mock_connection import MockConnect, server
+from appoptics_metrics.queue import AdaptiveChunkSize, BackgroundQueue
+from appoptics_metrics.retry import NO_RETRY
+from appoptics_metrics.transport import Response
+from mock_connection import MockTransport, server, wait_for
 from random import randint
 import time
 
 # logging.basicConfig(level=logging.DEBUG)
-appoptics_metrics.HTTPSConnection = MockConnect
 
 
 class TestAppOpticsQueue(unittest.TestCase):
     def setUp(self):
-        self.conn = appoptics_metrics.connect('key_test')
+        self.conn = appoptics_metrics.connect('key_test', transport=MockTransport())
         server.clean()
         self.q = self.conn.new_queue()
 
@@ -26,7 +31,7 @@ class TestAppOpticsQueue(unittest.TestCase):
         assert len(q.get_tags()) == 0
 
     def test_inherited_tags(self):
-        conn = appoptics_metrics.connect('key_test', tags={'sky': 'blue'})
+        conn = appoptics_metrics.connect('key_test', transport=MockTransport(), tags={'sky': 'blue'})
         assert conn.get_tags() == {'sky': 'blue'}
 
         q = conn.new_queue()
@@ -45,7 +50,7 @@ class TestAppOpticsQueue(unittest.TestCase):
 
     def test_inherit_connection_level_tags(self):
         """test if top level tags are ignored when passing measurement level tags"""
-        conn = appoptics_metrics.connect('key_test', tags={'sky': 'blue'})
+        conn = appoptics_metrics.connect('key_test', transport=MockTransport(), tags={'sky': 'blue'})
 
         q = conn.new_queue()
         q.add_tagged('user_cpu', 10, tags={"hi": "five"}, inherit_tags=True)
@@ -57,7 +62,7 @@ class TestAppOpticsQueue(unittest.TestCase):
 
     def test_ignore_connection_queue_level_tags(self):
         """test if queue level tags are ignored when passing measurement level tags"""
-        conn = appoptics_metrics.connect('key_test', tags={'sky': 'blue'})
+        conn = appoptics_metrics.connect('key_test', transport=MockTransport(), tags={'sky': 'blue'})
 
         q = conn.new_queue(tags={"service": "api"})
         q.add_tagged('user_cpu', 10, tags={"hi": "five"})
@@ -73,7 +78,7 @@ class TestAppOpticsQueue(unittest.TestCase):
 
     def test_inherit_connection_level_tags_through_add(self):
         """test if connection level tags are recognized when using the add function"""
-        conn = appoptics_metrics.connect('key_test', tags={'sky': 'blue', 'company': 'AppOptics'})
+        conn = appoptics_metrics.connect('key_test', transport=MockTransport(), tags={'sky': 'blue', 'company': 'AppOptics'})
 
         q = conn.new_queue()
         q.add('user_cpu', 100)
@@ -84,7 +89,7 @@ class TestAppOpticsQueue(unittest.TestCase):
 
     def test_inherit_queue_connection_level_tags(self):
         """test if queue level tags are ignored when passing measurement level tags"""
-        conn = appoptics_metrics.connect('key_test', tags={'sky': 'blue', 'company': 'AppOptics'})
+        conn = appoptics_metrics.connect('key_test', transport=MockTransport(), tags={'sky': 'blue', 'company': 'AppOptics'})
 
         q = conn.new_queue(tags={"service": "api", "hi": "four", "sky": "red"})
         q.add_tagged('user_cpu', 100, tags={"hi": "five"}, inherit_tags=True)
@@ -95,7 +100,7 @@ class TestAppOpticsQueue(unittest.TestCase):
 
     def test_inherit_queue_level_tags(self):
         """test if queue level tags are ignored when passing measurement level tags"""
-        conn = appoptics_metrics.connect('key_test')
+        conn = appoptics_metrics.connect('key_test', transport=MockTransport())
 
         q = conn.new_queue(tags={"service": "api", "hi": "four"})
         q.add_tagged('user_cpu', 100, tags={"hi": "five"}, inherit_tags=True)
@@ -105,7 +110,7 @@ class TestAppOpticsQueue(unittest.TestCase):
         assert measurements[0].get('tags', {}) == {'service': 'api', 'hi': 'five'}
 
     def test_constructor_tags(self):
-        conn = appoptics_metrics.connect('key_test', tags={'sky': 'blue'})
+        conn = appoptics_metrics.connect('key_test', transport=MockTransport(), tags={'sky': 'blue'})
         q = conn.new_queue(tags={'sky': 'red', 'coal': 'black'})
         tags = q.get_tags()
 
@@ -391,5 +396,606 @@ class TestAppOpticsQueue(unittest.TestCase):
         assert measurements[0]['time'] == mt1
         assert measurements[0]['value'] == 3.2
 
+class SlowTransport(MockTransport):
+    """Waits for .gate before answering, then takes `delay` seconds"""
+    def __init__(self, delay=0, status=None):
+        MockTransport.__init__(self)
+        self.gate = threading.Event()
+        self.gate.set()
+        self.delay = delay
+        self.status = status
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        self.gate.wait()
+        time.sleep(self.delay)
+        if self.status:
+            self.requests.append((method, url, body, headers))
+            return Response(self.status, [], b'')
+        return MockTransport.request(self, method, url, body, headers, timeout)
+
+
+class TestBackgroundQueue(unittest.TestCase):
+    def setUp(self):
+        server.clean()
+        self.transport = SlowTransport()
+        self.conn = appoptics_metrics.connect('key_test', transport=self.transport, tags={'host': 'web-1'},
+                                              retry_policy=NO_RETRY)
+        self.errors = []
+
+    def new_queue(self, **kwargs):
+        kwargs.setdefault('flush_interval', 60)
+        q = self.conn.new_queue(background=True, on_error=lambda e, chunks: self.errors.append((e, chunks)),
+                                **kwargs)
+        self.addCleanup(q.close, 1)
+        return q
+
+    def sent(self):
+        return sum(len(m.measurements.get('unassigned', [])) for m in self.conn.list_metrics())
+
+    def test_submit_waits_for_the_sender(self):
+        q = self.new_queue()
+        assert isinstance(q, BackgroundQueue)
+        for i in range(450):
+            q.add('temperature', i)
+        assert self.transport.requests == []
+        assert q.submit(timeout=2)
+        assert len(self.transport.requests) == 2
+        assert self.sent() == 450
+
+    def test_flush_count(self):
+        q = self.new_queue(flush_count=5)
+        for i in range(4):
+            q.add('temperature', i)
+        time.sleep(0.05)
+        assert self.transport.requests == []
+        q.add('temperature', 4)
+        wait_for(lambda: len(self.transport.requests) == 1)
+
+    def test_flush_interval(self):
+        q = self.new_queue(flush_interval=0.05)
+        q.add('temperature', 1)
+        wait_for(lambda: len(self.transport.requests) == 1)
+
+    def test_add_does_not_wait_for_the_network(self):
+        self.transport.gate.clear()
+        q = self.new_queue(flush_count=1)
+        start = time.time()
+        for i in range(100):
+            q.add('temperature', i)
+        assert time.time() - start < 0.5
+        self.transport.gate.set()
+        assert q.submit(timeout=2)
+        assert self.sent() == 100
+
+    def test_drop_newest(self):
+        q = self.new_queue(max_buffer=3, overflow='drop_newest')
+        for i in range(5):
+            q.add('temperature', i)
+        assert q.dropped == 2
+        q.submit()
+        values = [m['value'] for m in self.conn.get('temperature').measurements['unassigned']]
+        assert values == [0, 1, 2]
+
+    def test_drop_oldest(self):
+        q = self.new_queue(max_buffer=3, overflow='drop_oldest')
+        for i in range(5):
+            q.add('temperature', i)
+        assert q.dropped == 2
+        q.submit()
+        values = [m['value'] for m in self.conn.get('temperature').measurements['unassigned']]
+        assert values == [2, 3, 4]
+
+    def test_drop_newest_coalesced(self):
+        q = self.new_queue(max_buffer=2, overflow='drop_newest', coalesce=True)
+        posted = []
+        q.connection._mexe = lambda path, method, query_props, retry_policy: posted.append(query_props)
+        q.add('requests', 1)
+        q.add('latency', 1)
+        q.add('errors', 1)
+        # Dropped too, not merged into the dropped measurement
+        q.add('errors', 1)
+        q.add('requests', 1)
+        assert q.dropped == 2
+        q.submit()
+        ms = [m for p in posted for m in p['measurements']]
+        assert sorted((m['name'], m['sum']) for m in ms) == [('latency', 1), ('requests', 2)]
+
+    def test_drop_oldest_coalesced(self):
+        q = self.new_queue(max_buffer=2, overflow='drop_oldest', coalesce=True)
+        posted = []
+        q.connection._mexe = lambda path, method, query_props, retry_policy: posted.append(query_props)
+        q.add('requests', 1)
+        q.add('latency', 1)
+        q.add('errors', 1)
+        # A new measurement, not merged into the dropped one
+        q.add('requests', 2)
+        assert q.dropped == 2
+        q.submit()
+        ms = [m for p in posted for m in p['measurements']]
+        assert sorted((m['name'], m['sum']) for m in ms) == [('errors', 1), ('requests', 2)]
+
+    def test_block(self):
+        q = self.new_queue(max_buffer=3, block_timeout=0.05)
+        for i in range(3):
+            q.add('temperature', i)
+        with self.assertRaises(exceptions.QueueFull):
+            q.add('temperature', 3)
+        # The sender makes room
+        q.submit()
+        q.add('temperature', 3)
+
+    def test_bad_overflow(self):
+        with self.assertRaises(ValueError):
+            self.new_queue(overflow='grow')
+
+    def test_close_drains(self):
+        q = self.new_queue()
+        for i in range(10):
+            q.add('temperature', i)
+        assert q.close(timeout=2)
+        assert self.sent() == 10
+        with self.assertRaises(ValueError):
+            q.add('temperature', 1)
+
+    def test_close_deadline(self):
+        self.transport.delay = 0.05
+        q = self.new_queue()
+        q.MAX_MEASUREMENTS_PER_CHUNK = 1
+        for i in range(20):
+            q.add('temperature', i)
+        assert not q.close(timeout=0.1)
+        wait_for(lambda: self.errors)
+        sent = len(self.transport.requests)
+        assert 0 < sent < 20
+        assert sum(len(c['measurements']) for c in self.errors[0][1]) == 20 - sent
+
+    def test_failed_chunks_go_to_on_error(self):
+        self.transport.status = 500
+        q = self.new_queue()
+        q.add('temperature', 1)
+        q.submit()
+        assert len(self.errors) == 1
+        error, chunks = self.errors[0]
+        assert isinstance(error, exceptions.ServerError)
+        assert chunks[0]['measurements'][0]['name'] == 'temperature'
+
+    def test_submit_report(self):
+        q = self.new_queue()
+        for i in range(450):
+            q.add('temperature', i)
+        report = q.submit(timeout=2)
+        assert report.ok and report.measurements_sent == 450
+        self.transport.status = 500
+        q.add('temperature', 1)
+        report = q.submit(timeout=2)
+        assert not report.ok and report.measurements_failed == 1
+        assert isinstance(report.failed[0][1], exceptions.ServerError)
+
+    def test_submit_timeout(self):
+        self.transport.gate.clear()
+        q = self.new_queue()
+        q.add('temperature', 1)
+        assert q.submit(timeout=0.05) is None
+        self.transport.gate.set()
+
+    def test_context_manager_closes(self):
+        with self.new_queue() as q:
+            q.add('temperature', 1)
+        assert not q._thread.is_alive()
+        assert self.sent() == 1
+
+
+class ConcurrencyTransport(SlowTransport):
+    """Counts the requests in flight; fails those whose body contains b'fail'"""
+    def __init__(self, delay):
+        SlowTransport.__init__(self, delay=delay)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if body and b'fail' in body:
+                time.sleep(self.delay)
+                return Response(500, [], b'')
+            return SlowTransport.request(self, method, url, body, headers, timeout)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+class TestConcurrentSubmit(unittest.TestCase):
+    def setUp(self):
+        server.clean()
+        self.transport = ConcurrencyTransport(delay=0.02)
+        self.conn = appoptics_metrics.connect('key_test', transport=self.transport, tags={'host': 'web-1'},
+                                              retry_policy=NO_RETRY)
+
+    def new_queue(self, names, **kwargs):
+        q = self.conn.new_queue(**kwargs)
+        q.MAX_MEASUREMENTS_PER_CHUNK = 1
+        for name in names:
+            q.add(name, 1)
+        return q
+
+    def test_chunks_are_sent_concurrently(self):
+        q = self.new_queue(['m%d' % i for i in range(8)], concurrency=4)
+        q.submit()
+        assert q.tagged_chunks == []
+        assert len(self.conn.list_metrics()) == 8
+        assert 1 < self.transport.max_in_flight <= 4
+
+    def test_serial_by_default(self):
+        q = self.new_queue(['m%d' % i for i in range(3)])
+        q.submit()
+        assert self.transport.max_in_flight == 1
+
+    def test_errors_are_aggregated(self):
+        q = self.new_queue(['ok1', 'fail1', 'ok2', 'fail2', 'ok3'], concurrency=4)
+        with self.assertRaises(exceptions.SubmitError) as cm:
+            q.submit()
+        errors = cm.exception.errors
+        assert [c['measurements'][0]['name'] for c, _ in errors] == ['fail1', 'fail2']
+        assert all(isinstance(e, exceptions.ServerError) for _, e in errors)
+        # The failed chunks are kept, the others were sent
+        assert [c['measurements'][0]['name'] for c in q.tagged_chunks] == ['fail1', 'fail2']
+        assert sorted(m.name for m in self.conn.list_metrics()) == ['ok1', 'ok2', 'ok3']
+
+    def test_single_error_is_raised_as_is(self):
+        q = self.new_queue(['ok1', 'fail1', 'ok2'], concurrency=4)
+        with self.assertRaises(exceptions.ServerError):
+            q.submit()
+        assert len(q.tagged_chunks) == 1
+
+    def test_report(self):
+        q = self.new_queue(['ok1', 'ok2'])
+        report = q.submit()
+        assert report.ok
+        assert report.measurements_sent == 2
+        assert q.last_report is report
+
+    def test_partial_failure_keeps_only_the_rest(self):
+        q = self.new_queue(['ok1', 'ok2', 'fail1', 'ok3'])
+        with self.assertRaises(exceptions.ServerError):
+            q.submit()
+        report = q.last_report
+        assert [c['measurements'][0]['name'] for c in report.sent] == ['ok1', 'ok2']
+        assert [c['measurements'][0]['name'] for c, _ in report.failed] == ['fail1']
+        # Not sent twice by the next submit
+        assert [c['measurements'][0]['name'] for c in q.tagged_chunks] == ['fail1', 'ok3']
+
+    def test_concurrent_report(self):
+        q = self.new_queue(['ok1', 'fail1', 'ok2', 'fail2', 'ok3'], concurrency=4)
+        with self.assertRaises(exceptions.SubmitError):
+            q.submit()
+        assert sorted(c['measurements'][0]['name'] for c in q.last_report.sent) == ['ok1', 'ok2', 'ok3']
+        assert q.last_report.measurements_failed == 2
+
+
+class TestCoalescing(unittest.TestCase):
+    def setUp(self):
+        server.clean()
+        self.transport = MockTransport()
+        self.conn = appoptics_metrics.connect('key_test', transport=self.transport, tags={'host': 'web-1'})
+
+    def measurements(self, q):
+        return [m for c in q.tagged_chunks for m in c['measurements']]
+
+    def test_same_series_is_merged(self):
+        q = self.conn.new_queue(coalesce=True)
+        for v in (3, 1, 5):
+            q.add('requests', v)
+        q.add('requests', 2, tags={'host': 'web-2'})
+        q.add('latency', 7)
+        ms = self.measurements(q)
+        assert len(ms) == 3
+        assert ms[0] == {'name': 'requests', 'sum': 9, 'count': 3, 'min': 1, 'max': 5, 'tags': {'host': 'web-1'}}
+        assert ms[1]['tags'] == {'host': 'web-2'} and ms[1]['count'] == 1
+
+    def test_tag_order_does_not_matter(self):
+        q = self.conn.new_queue(coalesce=True)
+        q.add('requests', 1, tags={'a': '1', 'b': '2'})
+        q.add('requests', 1, tags={'b': '2', 'a': '1'})
+        assert len(self.measurements(q)) == 1
+
+    def test_times_are_kept_apart(self):
+        q = self.conn.new_queue(coalesce=True)
+        q.add('requests', 1, time=1000)
+        q.add('requests', 1, time=1001)
+        q.add('requests', 1, time=1000)
+        assert [m['count'] for m in self.measurements(q)] == [2, 1]
+
+    def test_period_buckets(self):
+        q = self.conn.new_queue(coalesce_period=60)
+        for t in (1200, 1230, 1259, 1260):
+            q.add('requests', 1, time=t)
+        q.add('requests', 1)
+        ms = self.measurements(q)
+        assert [(m['time'], m['count']) for m in ms[:2]] == [(1200, 3), (1260, 1)]
+        assert ms[2]['time'] % 60 == 0
+
+    def test_aggregated_measurements_merge(self):
+        q = self.conn.new_queue(coalesce=True, tags={'host': 'web-1'})
+        q.add('latency', 4)
+        a = Aggregator(self.conn, tags={'host': 'web-1'})
+        a.add_tagged('latency', 10)
+        a.add_tagged('latency', 2)
+        q.add_aggregator(a)
+        ms = self.measurements(q)
+        assert len(ms) == 1
+        assert (ms[0]['sum'], ms[0]['count'], ms[0]['min'], ms[0]['max']) == (16, 3, 2, 10)
+
+    def test_no_merge_after_submit(self):
+        q = self.conn.new_queue(coalesce=True)
+        q.add('requests', 1)
+        q.submit()
+        q.add('requests', 1)
+        q.submit()
+        assert len(self.transport.requests) == 2
+        assert len(self.conn.get('requests').measurements['unassigned']) == 2
+
+    def test_payload_shrinks(self):
+        q = self.conn.new_queue(coalesce=True)
+        for i in range(10000):
+            q.add('requests', 1, tags={'endpoint': '/%d' % (i % 10)})
+        # The mock server only takes a count of 1
+        posted = []
+        self.conn._mexe = lambda path, method, query_props, retry_policy: posted.append(query_props)
+        q.submit()
+        assert len(posted) == 1
+        assert [m['count'] for m in posted[0]['measurements']] == [1000] * 10
+
+    def test_background_queue(self):
+        q = self.conn.new_queue(background=True, coalesce=True, flush_interval=60)
+        self.addCleanup(q.close, 1)
+        for i in range(1000):
+            q.add('requests', 1)
+        assert len(q._buffer) == 1
+        q.submit(timeout=2)
+        q.add('requests', 1)
+        q.submit(timeout=2)
+        assert len(self.transport.requests) == 2
+
+
+class TestChunking(unittest.TestCase):
+    def setUp(self):
+        server.clean()
+        self.transport = MockTransport()
+        self.conn = appoptics_metrics.connect('key_test', transport=self.transport, tags={'host': 'web-1'})
+
+    def fill(self, q, count=200):
+        for i in range(count):
+            q.add('requests', i, tags={'endpoint': '/api/v1/items/%d' % i, 'user_agent': 'x' * (i % 50)})
+
+    def test_max_body_size(self):
+        for compact in (False, True):
+            server.clean()
+            self.transport.requests = []
+            q = self.conn.new_queue(max_body_size=4096, compact=compact)
+            self.fill(q)
+            q.submit()
+            sizes = [len(body) for _, _, body, _ in self.transport.requests]
+            assert len(sizes) > 1
+            assert max(sizes) <= 4096
+            # Chunks are filled up
+            assert min(sizes[:-1]) > 4096 - 200
+            assert len(self.conn.get('requests').measurements['unassigned']) == 200
+
+    def test_oversized_measurement_goes_alone(self):
+        q = self.conn.new_queue(max_body_size=100)
+        q.add('requests', 1, tags={'endpoint': 'x' * 200})
+        q.add('requests', 2, tags={'endpoint': 'y' * 200})
+        assert [len(c['measurements']) for c in q.tagged_chunks] == [1, 1]
+
+    def test_count_limit_still_applies(self):
+        q = self.conn.new_queue(max_body_size=10 ** 9)
+        for i in range(q.MAX_MEASUREMENTS_PER_CHUNK + 1):
+            q.add('requests', i)
+        assert [len(c['measurements']) for c in q.tagged_chunks] == [q.MAX_MEASUREMENTS_PER_CHUNK, 1]
+
+    def test_measurements_are_counted(self):
+        q = self.conn.new_queue(max_body_size=4096, concurrency=4)
+        self.fill(q)
+        assert q._num_measurements_in_queue() == 200 == sum(len(c['measurements']) for c in q.tagged_chunks)
+        server.fail_next(1, status=503)
+        with self.assertRaises(exceptions.ServerError):
+            q.submit(retry_policy=NO_RETRY)
+        assert q._num_measurements_in_queue() == len(q.tagged_chunks[0]['measurements'])
+        q.submit()
+        assert q._num_measurements_in_queue() == 0
+
+    def test_adaptive_chunk_size(self):
+        sizer = AdaptiveChunkSize(minimum=10, maximum=100, target_latency=1.0, step=10)
+        assert sizer.size == 100
+        sizer.record(100, 0.1, exceptions.ServerError(503))
+        assert sizer.size == 50
+        sizer.record(50, 0.1, exceptions.BadRequest())
+        assert sizer.size == 50
+        sizer.record(50, 0.1)
+        assert sizer.size == 60
+        # Partial chunks do not tell whether more would do
+        sizer.record(5, 0.1)
+        assert sizer.size == 60
+        sizer.record(60, 1.5)
+        assert sizer.size == 40
+        sizer.record(40, 10.0)
+        assert sizer.size == 20
+        for _ in range(5):
+            sizer.record(sizer.size, 0.1, exceptions.TooManyRequests())
+        assert sizer.size == 10
+        for _ in range(20):
+            sizer.record(sizer.size, 0.1)
+        assert sizer.size == 100
+
+    def test_adaptive_queue(self):
+        q = self.conn.new_queue(adaptive=AdaptiveChunkSize(minimum=10, maximum=100))
+        failures = [exceptions.ServerError(503)]
+
+        def mexe(path, method, query_props, retry_policy):
+            if failures:
+                raise failures.pop()
+        self.conn._mexe = mexe
+        self.fill(q, 100)
+        with self.assertRaises(exceptions.ServerError):
+            q.submit()
+        assert q.adaptive.size == 50
+        # New chunks are smaller
+        self.fill(q, 100)
+        assert [len(c['measurements']) for c in q.tagged_chunks] == [100, 50, 50]
+        q.submit()
+        assert q._num_measurements_in_queue() == 0
+
+
+class TestTagHoisting(unittest.TestCase):
+    def setUp(self):
+        server.clean()
+        self.transport = MockTransport()
+        self.conn = appoptics_metrics.connect('key_test', transport=self.transport, tags={'host': 'web-1'})
+        self.posted = []
+        self.conn._mexe = lambda path, method, query_props, retry_policy: self.posted.append(query_props)
+
+    def test_inherited_tags_are_interned(self):
+        q = self.conn.new_queue(tags={'region': 'us-east-1'})
+        q.add('cpu', 1)
+        q.add('mem', 2)
+        q.add('cpu', 3, tags={'core': '0'}, inherit_tags=True)
+        ms = q.tagged_chunks[0]['measurements']
+        assert ms[0]['tags'] is ms[1]['tags']
+        assert ms[0]['tags'] == {'host': 'web-1', 'region': 'us-east-1'}
+        assert ms[2]['tags'] == {'host': 'web-1', 'region': 'us-east-1', 'core': '0'}
+
+    def test_tag_changes_are_seen(self):
+        q = self.conn.new_queue()
+        q.add('cpu', 1)
+        self.conn.add_tags({'az': 'b'})
+        q.add('cpu', 2)
+        q.add_tags({'role': 'db'})
+        q.add('cpu', 3)
+        q.set_tags({'role': 'web'})
+        q.add('cpu', 4)
+        assert [m['tags'] for m in q.tagged_chunks[0]['measurements']] == [
+            {'host': 'web-1'}, {'host': 'web-1', 'az': 'b'}, {'host': 'web-1', 'az': 'b', 'role': 'db'},
+            {'host': 'web-1', 'az': 'b', 'role': 'web'}]
+
+    def test_tags_changed_in_place_are_seen(self):
+        q = self.conn.new_queue(tags={'region': 'us-east-1'})
+        q.add('cpu', 1)
+        self.conn.tags['az'] = 'b'
+        q.add('cpu', 2)
+        q.tags['region'] = 'eu-west-1'
+        q.add('cpu', 3)
+        assert [m['tags'] for m in q.tagged_chunks[0]['measurements']] == [
+            {'host': 'web-1', 'region': 'us-east-1'}, {'host': 'web-1', 'region': 'us-east-1', 'az': 'b'},
+            {'host': 'web-1', 'region': 'eu-west-1', 'az': 'b'}]
+
+    def test_shared_tags_and_time_are_hoisted(self):
+        for compact in (False, True):
+            self.posted = []
+            q = self.conn.new_queue(compact=compact)
+            q.add('cpu', 1, time=1500000000)
+            q.add('mem', 2, time=1500000000)
+            q.submit()
+            assert self.posted == [{'tags': {'host': 'web-1'}, 'time': 1500000000, 'measurements': [
+                {'name': 'cpu', 'sum': 1, 'count': 1}, {'name': 'mem', 'sum': 2, 'count': 1}]}]
+
+    def test_different_tags_are_not_hoisted(self):
+        q = self.conn.new_queue()
+        q.add('cpu', 1, time=1500000000)
+        q.add('cpu', 2, time=1500000060, tags={'host': 'web-2'})
+        q.submit()
+        assert 'tags' not in self.posted[0] and 'time' not in self.posted[0]
+        assert self.posted[0]['measurements'][1]['tags'] == {'host': 'web-2'}
+
+    def test_queued_chunk_is_not_changed(self):
+        q = self.conn.new_queue()
+        q.add('cpu', 1)
+        chunk = q.tagged_chunks[0]
+        report = q.submit()
+        assert report.sent == [chunk]
+        assert chunk['measurements'][0]['tags'] == {'host': 'web-1'}
+
+    def test_server_applies_hoisted_tags(self):
+        del self.conn._mexe
+        q = self.conn.new_queue()
+        q.add('cpu', 1, time=1500000000)
+        q.add('cpu', 2, time=1500000000)
+        q.submit()
+        assert len(self.conn.get('cpu').measurements['unassigned']) == 2
+
+
+class TestThreadSafeQueue(unittest.TestCase):
+    def setUp(self):
+        server.clean()
+        self.conn = appoptics_metrics.connect('key_test', transport=MockTransport(), tags={'host': 'web-1'})
+        self.posted = []
+        self.conn._mexe = lambda path, method, query_props, retry_policy: self.posted.append(query_props)
+        if hasattr(sys, 'setswitchinterval'):
+            # Switch threads as often as possible
+            self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+            sys.setswitchinterval(1e-6)
+
+    def sent(self):
+        return [(m.get('tags', p.get('tags'))['thread'], m['sum']) for p in self.posted for m in p['measurements']]
+
+    def stress(self, threads=16, count=2000, **kwargs):
+        q = self.conn.new_queue(thread_safe=True, **kwargs)
+        start = threading.Event()
+        stop = threading.Event()
+
+        def add(t):
+            start.wait()
+            for i in range(count):
+                q.add('requests', i, tags={'thread': str(t)})
+
+        def submit():
+            start.wait()
+            while not stop.is_set():
+                q.submit()
+
+        adders = [threading.Thread(target=add, args=(t,)) for t in range(threads)]
+        submitter = threading.Thread(target=submit)
+        for thread in adders + [submitter]:
+            thread.start()
+        start.set()
+        for thread in adders:
+            thread.join()
+        stop.set()
+        submitter.join()
+        q.submit()
+        assert q._num_measurements_in_queue() == 0
+        # Nothing lost, nothing sent twice
+        assert sorted(self.sent()) == sorted((str(t), i) for t in range(threads) for i in range(count))
+        assert all(len(p['measurements']) <= q.MAX_MEASUREMENTS_PER_CHUNK for p in self.posted)
+        return q
+
+    def test_stress(self):
+        self.stress()
+
+    def test_stress_auto_submit(self):
+        self.stress(auto_submit_count=500)
+
+    def test_stress_compact_concurrent(self):
+        self.stress(compact=True, concurrency=4)
+
+    def test_order_within_a_thread(self):
+        self.stress(threads=4)
+        for t in range(4):
+            assert [v for thread, v in self.sent() if thread == str(t)] == list(range(2000))
+
+    def test_ended_threads_are_forgotten(self):
+        q = self.conn.new_queue(thread_safe=True)
+        thread = threading.Thread(target=q.add, args=('requests', 1))
+        thread.start()
+        thread.join()
+        assert len(q._buffers) == 1
+        assert q._num_measurements_in_queue() == 1
+        q.submit()
+        assert q._buffers == []
+        assert [m['sum'] for p in self.posted for m in p['measurements']] == [1]
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,157 @@
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import appoptics_metrics
+from appoptics_metrics import aggregator, exceptions, relay
+from appoptics_metrics.relay import Relay, RelayClient, format_line, parse_line
+from mock_connection import MockTransport, server, wait_for
+
+# logging.basicConfig(level=logging.DEBUG)
+
+
+class TestLineProtocol(unittest.TestCase):
+    def test_round_trip(self):
+        line = format_line('requests.latency', 12.5, tags={'host': 'web-1', 'endpoint': '/items'}, time=1500000000)
+        assert line == 'requests.latency:12.5|#endpoint=/items,host=web-1|@1500000000'
+        assert parse_line(line) == ('requests.latency', 12.5, {'host': 'web-1', 'endpoint': '/items'}, 1500000000)
+
+    def test_minimal(self):
+        assert format_line('requests', 1) == 'requests:1'
+        assert parse_line('requests:1\n') == ('requests', 1, {}, None)
+
+    def test_malformed(self):
+        for line in ('requests', ':1', 'requests:x', 'requests:1|#host', 'requests:1|x', 'requests:1|@now'):
+            with self.assertRaises(ValueError):
+                parse_line(line)
+
+    def test_reserved_characters(self):
+        with self.assertRaises(ValueError):
+            format_line('requests', 1, tags={'path': '/a|b'})
+
+
+class TestRelay(unittest.TestCase):
+    def setUp(self):
+        server.clean()
+        self.conn = appoptics_metrics.connect('key_test', transport=MockTransport())
+        self.posted = []
+        self.conn._mexe = lambda path, method, query_props, retry_policy: self.posted.append(query_props)
+        self.now = 1500000005.0
+        for module in (relay, aggregator):
+            self.addCleanup(setattr, module, '_now', module._now)
+            module._now = lambda: self.now
+
+    def new_relay(self, address='127.0.0.1:0', **kwargs):
+        r = Relay(self.conn, address, period=10, tags={'host': 'web-1'}, **kwargs)
+        self.addCleanup(r.close, 1)
+        return r
+
+    def measurements(self):
+        return [dict(m, tags=m.get('tags', p.get('tags')), time=m.get('time', p.get('time')))
+                for p in self.posted for m in p['measurements']]
+
+    def test_aggregation(self):
+        r = self.new_relay()
+        r.handle(b'requests:3|#endpoint=/a\nrequests:1|#endpoint=/a\nrequests:5|#endpoint=/a\n')
+        r.handle(b'requests:2|#endpoint=/b\nbad line\n')
+        assert r.received == 4 and r.malformed == 1
+        # The period is not over
+        r.flush()
+        assert r.aggregator.windows
+        self.now += 10
+        r.flush()
+        wait_for(lambda: len(self.measurements()) == 2)
+        ms = sorted(self.measurements(), key=lambda m: m['tags']['endpoint'])
+        assert ms[0] == {'name': 'requests', 'sum': 9, 'count': 3, 'min': 1, 'max': 5, 'time': 1500000000,
+                         'tags': {'host': 'web-1', 'endpoint': '/a'}}
+        assert ms[1]['count'] == 1
+
+    def test_periods_are_kept_apart(self):
+        self.now = 1500000000.5
+        r = self.new_relay()
+        # Within FLUSH_DELAY of the end of its period
+        r.handle(b'requests:1|@1499999999\nrequests:1\nrequests:1')
+        r.close(1)
+        assert sorted((m['time'], m['count']) for m in self.measurements()) == [(1499999990, 1), (1500000000, 2)]
+
+    def test_lines_of_a_sent_period_are_dropped(self):
+        r = self.new_relay()
+        r.handle(b'requests:1')
+        self.now += 10
+        r.flush()
+        r.handle(b'requests:5|@1500000001')
+        r.close(1)
+        assert r.aggregator.late == 1
+        assert [(m['time'], m['sum']) for m in self.measurements()] == [(1500000000, 1)]
+
+    def test_flush_keeps_what_could_not_be_queued(self):
+        r = self.new_relay()
+        r.handle(b'requests:1|#endpoint=/a\nrequests:2|#endpoint=/b')
+        self.now += 10
+        add, calls = r.queue.add, []
+
+        def fail_once(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 2:
+                raise exceptions.QueueFull("full")
+            add(*args, **kwargs)
+        r.queue.add = fail_once
+        with self.assertRaises(exceptions.QueueFull):
+            r.flush()
+        r.flush()
+        r.close(1)
+        assert sorted(m['sum'] for m in self.measurements()) == [1, 2]
+
+    def test_udp(self):
+        r = self.new_relay()
+        thread = threading.Thread(target=r.serve_forever)
+        thread.start()
+        client = RelayClient('127.0.0.1:%d' % r.address[1], tags={'worker': '1'})
+        self.addCleanup(client.close)
+        for i in range(10):
+            client.add('requests', i)
+        wait_for(lambda: r.received == 10)
+        r.stop()
+        thread.join(2)
+        assert self.measurements() == [{'name': 'requests', 'sum': 45, 'count': 10, 'min': 0, 'max': 9,
+                                        'time': 1500000000, 'tags': {'host': 'web-1', 'worker': '1'}}]
+
+    def test_unix_socket(self):
+        if not hasattr(socket, 'AF_UNIX'):
+            self.skipTest("no unix sockets")
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'relay.sock')
+        r = self.new_relay(path)
+        client = RelayClient(path)
+        self.addCleanup(client.close)
+        client.add('requests', 1)
+        wait_for(lambda: r._receive() or r.received == 1)
+        r.close(1)
+        assert not os.path.exists(path)
+        assert len(self.measurements()) == 1
+
+    def test_client_without_relay(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        client = RelayClient('127.0.0.1:%d' % port)
+        self.addCleanup(client.close)
+        for i in range(3):
+            # Never raises
+            client.add('requests', 1)
+
+    def test_main_needs_a_token(self):
+        old = os.environ.pop('APPOPTICS_TOKEN', None)
+        if old is not None:
+            self.addCleanup(os.environ.__setitem__, 'APPOPTICS_TOKEN', old)
+        with self.assertRaises(SystemExit):
+            relay.main(['--listen', '127.0.0.1:0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,23 +1,176 @@
+import errno
 import logging
+import socket
+import ssl
 import unittest
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+from six.moves import http_client
 import appoptics_metrics
+from appoptics_metrics import exceptions
+from appoptics_metrics.retry import RetryPolicy, NO_RETRY, parse_retry_after
 import mock_connection
 
 # logging.basicConfig(level=logging.DEBUG)
-# Mock the server
-appoptics_metrics.HTTPSConnection = mock_connection.MockConnect
+
+# We don't want to wait for real in these tests
+FAST = RetryPolicy(backoff_base=0.001, max_backoff=0.01)
 
 
 class TestRetries(unittest.TestCase):
     def setUp(self):
-        self.conn = appoptics_metrics.connect('key_test')
+        self.conn = appoptics_metrics.connect('key_test', transport=mock_connection.MockTransport(), retry_policy=FAST)
         mock_connection.server.clean()
 
     def test_list_metrics_with_retries(self):
-        self.conn.fake_n_errors = 1
-        self.conn.backoff_logic = lambda x: 0.1  # We don't want to wait 1 sec for this to finish
+        mock_connection.server.fail_next(1)
         metrics = self.conn.list_metrics()
         assert len(metrics) == 0
 
+    def test_gives_up_after_max_attempts(self):
+        mock_connection.server.fail_next(5, status=503)
+        with self.assertRaises(exceptions.ServerError) as cm:
+            self.conn.list_metrics()
+        assert cm.exception.code == 503
+        # All 5 attempts were used
+        assert mock_connection.server.failures == []
+
+    def test_client_errors_are_not_retried(self):
+        mock_connection.server.fail_next(2, status=400)
+        with self.assertRaises(exceptions.BadRequest):
+            self.conn.list_metrics()
+        assert len(mock_connection.server.failures) == 1
+
+    def test_429_is_retried(self):
+        mock_connection.server.fail_next(1, status=429)
+        assert self.conn.list_metrics() == []
+
+    def test_retry_after_is_honored(self):
+        # Up to max_backoff
+        self.conn.retry_policy = RetryPolicy(backoff_base=0.001)
+        mock_connection.server.fail_next(1, status=429, headers={'Retry-After': '2'})
+        with patch('time.sleep') as sleep:
+            self.conn.list_metrics()
+        sleep.assert_called_once_with(2)
+
+    def test_long_retry_after_is_not_waited_for(self):
+        mock_connection.server.fail_next(1, status=429, headers={'Retry-After': '3600'})
+        with patch('time.sleep') as sleep:
+            with self.assertRaises(exceptions.TooManyRequests):
+                self.conn.list_metrics()
+        assert not sleep.called
+
+    def test_certificate_errors_are_not_retried(self):
+        # ssl.SSLCertVerificationError on py3.7+
+        error = getattr(ssl, 'SSLCertVerificationError', ssl.SSLError)('certificate verify failed')
+        with patch.object(self.conn.transport, 'request', side_effect=error) as request:
+            with self.assertRaises(ssl.SSLError):
+                self.conn.list_metrics()
+        assert request.call_count == 1
+
+    def test_max_retry_after(self):
+        self.conn.retry_policy = RetryPolicy(backoff_base=0.001, max_backoff=0.01, max_retry_after=60)
+        mock_connection.server.fail_next(1, status=503, headers={'Retry-After': '45'})
+        with patch('time.sleep') as sleep:
+            self.conn.list_metrics()
+        sleep.assert_called_once_with(45)
+
+    def test_retry_after_is_ignored_when_disabled(self):
+        self.conn.retry_policy = RetryPolicy(backoff_base=0.001, respect_retry_after=False)
+        mock_connection.server.fail_next(1, status=429, headers={'Retry-After': '2'})
+        with patch('time.sleep') as sleep:
+            self.conn.list_metrics()
+        assert sleep.call_args[0][0] < 1
+
+    def test_deadline(self):
+        self.conn.retry_policy = RetryPolicy(backoff_base=10, jitter=None, deadline=5)
+        mock_connection.server.fail_next(1)
+        with patch('time.sleep') as sleep:
+            with self.assertRaises(exceptions.ServerError):
+                self.conn.list_metrics()
+        assert not sleep.called
+
+    def test_per_call_policy(self):
+        mock_connection.server.fail_next(1)
+        with self.assertRaises(exceptions.ServerError):
+            self.conn.with_retry_policy(NO_RETRY).list_metrics()
+        # The connection itself still retries
+        mock_connection.server.fail_next(1)
+        assert self.conn.list_metrics() == []
+
+    def test_per_call_policy_on_submit(self):
+        self.conn.set_tags({'sky': 'blue'})
+        mock_connection.server.fail_next(1)
+        with self.assertRaises(exceptions.ServerError):
+            self.conn.submit('temperature', 1, retry_policy=NO_RETRY)
+
+    def test_timeouts(self):
+        calls = []
+
+        class TimingOutTransport(mock_connection.MockTransport):
+            def request(self, *args, **kwargs):
+                calls.append(1)
+                if len(calls) == 1:
+                    raise socket.timeout('timed out')
+                return mock_connection.MockTransport.request(self, *args, **kwargs)
+
+        with patch.object(self.conn, 'transport', TimingOutTransport()):
+            assert self.conn.list_metrics() == []
+            assert len(calls) == 2
+
+            calls[:] = []
+            self.conn.retry_policy = RetryPolicy(backoff_base=0.001, retry_on_timeout=False)
+            with self.assertRaises(socket.timeout):
+                self.conn.list_metrics()
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_exponential_backoff_is_capped(self):
+        policy = RetryPolicy(backoff_base=1, max_backoff=5, jitter=None)
+        assert [policy.backoff(n) for n in range(1, 6)] == [1, 2, 4, 5, 5]
+
+    def test_full_jitter(self):
+        policy = RetryPolicy(backoff_base=1, max_backoff=5)
+        for n in range(1, 10):
+            assert 0 <= policy.backoff(n) <= min(5, 2 ** (n - 1))
+
+    def test_decorrelated_jitter(self):
+        policy = RetryPolicy(backoff_base=1, max_backoff=5, jitter='decorrelated')
+        delay = None
+        for n in range(1, 10):
+            previous = delay or 1
+            delay = policy.backoff(n, delay)
+            assert 1 <= delay <= min(5, previous * 3)
+
+    def test_invalid_jitter(self):
+        with self.assertRaises(ValueError):
+            RetryPolicy(jitter='sometimes')
+
+    def test_retryable(self):
+        policy = RetryPolicy(retry_on_connection_error=False)
+        assert policy.is_retryable(exceptions.ServerError(502))
+        assert policy.is_retryable(exceptions.TooManyRequests())
+        assert not policy.is_retryable(exceptions.NotFound())
+        assert not policy.is_retryable(socket.error('reset'))
+        assert policy.is_retryable(socket.timeout())
+        assert not policy.is_retryable(ValueError())
+        assert not RetryPolicy(retry_statuses=[503]).is_retryable(exceptions.ServerError(502))
+
+    def test_only_broken_connections_are_retried(self):
+        policy = RetryPolicy()
+        assert policy.is_retryable(socket.error(errno.ECONNRESET, 'Connection reset by peer'))
+        assert policy.is_retryable(http_client.BadStatusLine(''))
+        assert not policy.is_retryable(ssl.SSLError('certificate verify failed'))
+        assert not policy.is_retryable(socket.gaierror(-2, 'Name or service not known'))
+
+    def test_parse_retry_after(self):
+        assert parse_retry_after('120') == 120
+        assert parse_retry_after(None) is None
+        assert parse_retry_after('soon') is None
+        assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT', now=1445412470) == 10
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,83 @@
+import json
+import random
+import unittest
+from appoptics_metrics.sketch import DDSketch
+
+
+def exact(values, q):
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))]
+
+
+class TestDDSketch(unittest.TestCase):
+    def assert_accurate(self, sketch, values, accuracy=0.01):
+        for q in (0, 0.1, 0.5, 0.9, 0.95, 0.99, 1):
+            expected = exact(values, q)
+            assert abs(sketch.quantile(q) - expected) <= accuracy * abs(expected) + 1e-9, (q, expected)
+
+    def test_relative_accuracy(self):
+        rnd = random.Random(42)
+        values = [rnd.lognormvariate(3, 1.5) for _ in range(20000)]
+        sketch = DDSketch(0.01)
+        for v in values:
+            sketch.add(v)
+        assert sketch.count == 20000
+        assert abs(sketch.sum - sum(values)) < 1e-6 * sum(values)
+        self.assert_accurate(sketch, values)
+
+    def test_negative_and_zero_values(self):
+        values = [-100, -10, -1, 0, 0, 1, 10, 100, 1000]
+        sketch = DDSketch(0.02)
+        for v in values:
+            sketch.add(v)
+        self.assert_accurate(sketch, values, 0.02)
+        assert sketch.quantile(0) == -100 and sketch.quantile(1) == 1000
+
+    def test_empty(self):
+        assert DDSketch().quantile(0.5) is None
+
+    def test_fixed_memory(self):
+        sketch = DDSketch(0.01, max_bins=100)
+        values = [10 ** (i / 10.0) for i in range(-300, 300)]
+        for v in values:
+            sketch.add(v)
+        assert len(sketch.positive) == 100
+        # The high quantiles keep their accuracy
+        expected = exact(values, 0.99)
+        assert abs(sketch.quantile(0.99) - expected) <= 0.01 * expected
+
+    def test_merge(self):
+        rnd = random.Random(7)
+        values = [rnd.expovariate(0.1) for _ in range(10000)]
+        parts = [DDSketch(), DDSketch(), DDSketch()]
+        for i, v in enumerate(values):
+            parts[i % 3].add(v)
+        merged = DDSketch()
+        for part in parts:
+            merged.merge(part)
+        assert merged.count == 10000
+        self.assert_accurate(merged, values)
+
+    def test_merge_needs_the_same_accuracy(self):
+        with self.assertRaises(ValueError):
+            DDSketch(0.01).merge(DDSketch(0.02))
+
+    def test_serialization(self):
+        sketch = DDSketch()
+        for v in (-3, 0, 1.5, 2, 700):
+            sketch.add(v)
+        # e.g. sent by another process
+        copy = DDSketch.from_dict(json.loads(json.dumps(sketch.to_dict())))
+        assert copy.quantiles([0, 0.5, 1]) == sketch.quantiles([0, 0.5, 1])
+        copy.merge(sketch)
+        assert copy.count == 10
+
+    def test_bad_arguments(self):
+        with self.assertRaises(ValueError):
+            DDSketch(0)
+        with self.assertRaises(ValueError):
+            DDSketch().quantile(1.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,16 +3,14 @@ import unittest
 import appoptics_metrics
 from appoptics_metrics import Space, Chart
 from appoptics_metrics.streams import Stream
-from mock_connection import MockConnect, server
+from mock_connection import MockTransport, server
 
 # logging.basicConfig(level=logging.DEBUG)
-# Mock the server
-appoptics_metrics.HTTPSConnection = MockConnect
 
 
 class SpacesTest(unittest.TestCase):
     def setUp(self):
-        self.conn = appoptics_metrics.connect('key_test')
+        self.conn = appoptics_metrics.connect('key_test', transport=MockTransport())
         server.clean()
 
 
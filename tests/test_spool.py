@@ -0,0 +1,211 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import appoptics_metrics
+from appoptics_metrics import exceptions, spool as spool_module
+from appoptics_metrics.retry import NO_RETRY
+from appoptics_metrics.spool import Spool
+from mock_connection import MockTransport, server, wait_for
+
+# logging.basicConfig(level=logging.DEBUG)
+
+
+def chunk(*values):
+    return {'measurements': [{'name': 'cpu', 'tags': {'host': 'a'}, 'sum': v, 'count': 1} for v in values]}
+
+
+class SpoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def open(self, **kwargs):
+        spool = Spool(self.directory, **kwargs)
+        self.addCleanup(spool.close)
+        return spool
+
+    def segments(self):
+        return sorted(n for n in os.listdir(self.directory) if n.endswith('.seg'))
+
+
+class TestSpool(SpoolTestCase):
+    def test_fifo(self):
+        spool = self.open()
+        for i in range(3):
+            spool.append(chunk(i))
+        assert len(spool) == 3
+        assert spool.head() == chunk(0)
+        # head() leaves it there
+        assert spool.head() == chunk(0)
+        spool.pop()
+        assert spool.head() == chunk(1)
+        spool.pop()
+        spool.pop()
+        assert spool.head() is None
+        assert len(spool) == 0
+
+    def test_replay_after_restart(self):
+        spool = self.open()
+        for i in range(3):
+            spool.append(chunk(i))
+        spool.pop()
+        spool.close()
+        spool = self.open()
+        assert len(spool) == 2
+        assert spool.head() == chunk(1)
+
+    def test_torn_record_is_cut_off(self):
+        spool = self.open()
+        spool.append(chunk(1))
+        spool.append(chunk(2))
+        spool.close()
+        path = os.path.join(self.directory, self.segments()[-1])
+        size = os.path.getsize(path)
+        with open(path, 'ab') as f:
+            # A crash in the middle of a write
+            f.write(b'\x40\x00\x00\x00\x01\x02\x03\x04{"measurem')
+        spool = self.open()
+        assert len(spool) == 2
+        assert os.path.getsize(path) == size
+        spool.append(chunk(3))
+        assert [spool.head(), spool.pop(), spool.head(), spool.pop(), spool.head()] == \
+            [chunk(1), None, chunk(2), None, chunk(3)]
+
+    def test_corrupted_record_is_cut_off(self):
+        spool = self.open()
+        spool.append(chunk(1))
+        spool.append(chunk(2))
+        spool.close()
+        path = os.path.join(self.directory, self.segments()[-1])
+        with open(path, 'r+b') as f:
+            f.seek(-3, os.SEEK_END)
+            f.write(b'XXX')
+        spool = self.open()
+        assert len(spool) == 1
+        assert spool.head() == chunk(1)
+
+    def test_segments(self):
+        record = len(spool_module._HEADER.pack(0, 0)) + len(Spool(self.directory).codec.dumps(chunk(1)))
+        spool = self.open(segment_size=record * 2)
+        for i in range(5):
+            spool.append(chunk(i))
+        assert len(self.segments()) == 3
+        values = []
+        while spool.head() is not None:
+            values.append(spool.head()['measurements'][0]['sum'])
+            spool.pop()
+        assert values == [0, 1, 2, 3, 4]
+        # The sent segments are deleted
+        assert len(self.segments()) == 1
+
+    def test_oldest_segments_are_evicted(self):
+        record = len(spool_module._HEADER.pack(0, 0)) + len(Spool(self.directory).codec.dumps(chunk(1)))
+        spool = self.open(segment_size=record * 2, max_bytes=record * 4)
+        for i in range(7):
+            spool.append(chunk(i))
+        assert spool.size <= record * 4
+        assert spool.evicted == 4
+        assert len(spool) == 3
+        assert spool.head() == chunk(4)
+
+    def test_restart_after_segment_sent(self):
+        record = len(spool_module._HEADER.pack(0, 0)) + len(Spool(self.directory).codec.dumps(chunk(1)))
+        spool = self.open(segment_size=record * 2)
+        for i in range(5):
+            spool.append(chunk(i))
+        for i in range(3):
+            spool.pop()
+        spool.close()
+        spool = self.open(segment_size=record * 2)
+        assert len(spool) == 2
+        assert spool.head() == chunk(3)
+
+    def test_fsync_policy(self):
+        with self.assertRaises(ValueError):
+            Spool(self.directory, fsync='sometimes')
+        for fsync in ('always', 'segment', 'never', 0.5):
+            spool = self.open(fsync=fsync)
+            spool.append(chunk(1))
+            spool.close()
+        assert len(self.open()) == 4
+
+
+class TestSpooledQueue(SpoolTestCase):
+    def setUp(self):
+        SpoolTestCase.setUp(self)
+        server.clean()
+        self.transport = MockTransport()
+        self.conn = appoptics_metrics.connect('key_test', transport=self.transport, tags={'host': 'web-1'},
+                                              retry_policy=NO_RETRY)
+
+    def test_submit(self):
+        spool = self.open()
+        q = self.conn.new_queue(spool=spool)
+        q.MAX_MEASUREMENTS_PER_CHUNK = 2
+        for i in range(5):
+            q.add('temperature', i)
+        # The full chunks are on disk already
+        assert len(spool) == 2
+        assert len(q.tagged_chunks) == 1
+        assert q._num_measurements_in_queue() == 5
+        q.submit()
+        assert len(spool) == 0
+        assert len(self.transport.requests) == 3
+        assert [m['value'] for m in self.conn.get('temperature').measurements['unassigned']] == list(range(5))
+
+    def test_unsent_chunks_survive_a_restart(self):
+        q = self.conn.new_queue(spool=self.open())
+        q.add('temperature', 1)
+        server.fail_next(1, status=503)
+        with self.assertRaises(exceptions.ServerError):
+            q.submit()
+        q.spool.close()
+        q = self.conn.new_queue(spool=self.open())
+        q.add('temperature', 2)
+        q.submit()
+        assert [m['value'] for m in self.conn.get('temperature').measurements['unassigned']] == [1, 2]
+
+    def test_refused_chunks_are_dropped(self):
+        q = self.conn.new_queue(spool=self.open())
+        q.add('temperature', 1)
+        server.fail_next(1, status=400)
+        with self.assertRaises(exceptions.BadRequest):
+            q.submit()
+        assert len(q.spool) == 0
+
+    def test_circuit_open_buffer_keeps_spooled_chunks(self):
+        q = self.conn.new_queue(spool=self.open(), on_circuit_open='buffer')
+        q.add('temperature', 1)
+        self.conn._mexe = mock_open_circuit
+        q.submit()
+        assert len(q.spool) == 1
+
+    def test_drain_thread(self):
+        spool = self.open()
+        spool.append(chunk(1))
+        q = self.conn.new_queue(spool=spool, drain_rate=100)
+        q.add('temperature', 2)
+        q.submit()
+        wait_for(lambda: len(spool) == 0)
+        assert len(self.transport.requests) == 2
+
+    def test_drain_thread_retries(self):
+        old, spool_module.DRAIN_BACKOFF = spool_module.DRAIN_BACKOFF, 0.01
+        self.addCleanup(setattr, spool_module, 'DRAIN_BACKOFF', old)
+        server.fail_next(2, status=503)
+        q = self.conn.new_queue(spool=self.open(), drain_rate=0)
+        q.add('temperature', 1)
+        q.submit()
+        wait_for(lambda: len(q.spool) == 0)
+        assert len(self.transport.requests) == 3
+        assert q.spool.close(1)
+
+
+def mock_open_circuit(*args, **kwargs):
+    raise exceptions.CircuitOpenError()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import json
+import logging
+import socket
+import unittest
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+import appoptics_metrics
+from appoptics_metrics.tracing import Tracer, LoggingTracer
+from appoptics_metrics.retry import RetryPolicy, NO_RETRY
+from mock_connection import MockTransport, server
+
+# logging.basicConfig(level=logging.DEBUG)
+
+
+class RecordingTracer(Tracer):
+    def __init__(self):
+        self.started = []
+        self.ended = []
+
+    def request_start(self, trace):
+        self.started.append(trace)
+
+    def request_end(self, trace):
+        self.ended.append(trace)
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.conn = appoptics_metrics.connect('key_test', transport=MockTransport(), tags={'sky': 'blue'})
+        server.clean()
+
+    def test_no_work_without_tracers(self):
+        with patch('appoptics_metrics.Trace') as trace_class:
+            with patch('json.dumps', wraps=json.dumps) as dumps:
+                with patch.object(self.conn.codec, 'dumps', wraps=self.conn.codec.dumps) as encode:
+                    self.conn.submit('temperature', 1)
+                    self.conn.list_metrics()
+        assert not trace_class.called
+        # The payload is serialized exactly once, and nothing is pretty-printed
+        # (the mock server serializes its responses with json.dumps too)
+        assert encode.call_count == 1
+        assert all('indent' not in c[1] for c in dumps.call_args_list)
+
+    def test_request_start_and_end(self):
+        tracer = RecordingTracer()
+        self.conn.add_tracer(tracer)
+        self.conn.submit('temperature', 1)
+        self.conn.list_metrics()
+
+        assert [t.method for t in tracer.started] == ['POST', 'GET']
+        post, get = tracer.ended
+        assert post.uri == '/v1/measurements'
+        assert post.status == 200
+        assert post.bytes_sent > 0
+        assert post.elapsed >= 0
+        assert get.bytes_sent == 0
+        assert get.bytes_received == len(get.response_body) > 0
+
+    def test_each_retry_is_traced(self):
+        tracer = RecordingTracer()
+        self.conn.add_tracer(tracer)
+        self.conn.retry_policy = RetryPolicy(backoff_base=0)
+        server.fail_next(1)
+        self.conn.list_metrics()
+        assert [t.status for t in tracer.ended] == [500, 200]
+
+    def test_error_is_traced(self):
+        tracer = RecordingTracer()
+        self.conn.add_tracer(tracer)
+
+        with patch.object(self.conn.transport, 'request', side_effect=socket.error('boom')):
+            with self.assertRaises(socket.error):
+                self.conn.with_retry_policy(NO_RETRY).list_metrics()
+        assert tracer.ended[0].status is None
+        assert isinstance(tracer.ended[0].error, socket.error)
+
+    def test_remove_tracer(self):
+        tracer = RecordingTracer()
+        self.conn.add_tracer(tracer)
+        self.conn.remove_tracer(tracer)
+        self.conn.list_metrics()
+        assert tracer.started == []
+
+    def test_logging_tracer(self):
+        self.conn.add_tracer(LoggingTracer())
+        with self.assertLogs('appoptics-metrics', level='DEBUG') as logs:
+            self.conn.submit('temperature', 1)
+        output = "\n".join(logs.output)
+        assert 'method=POST uri=/v1/measurements' in output
+        # Pretty-printed request body
+        assert '"name": "temperature"' in output
+        assert 'status code(<-): 200' in output
+
+
+if __name__ == '__main__':
+    unittest.main()
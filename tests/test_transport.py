@@ -0,0 +1,100 @@
+import errno
+import logging
+import socket
+import unittest
+import appoptics_metrics
+from appoptics_metrics import transport
+from appoptics_metrics.transport import Transport, HTTPClientTransport, Response
+from mock_connection import MockConnect, MockTransport, server
+
+# logging.basicConfig(level=logging.DEBUG)
+
+
+class TestResponse(unittest.TestCase):
+    def test_headers_are_case_insensitive(self):
+        resp = Response(200, [('Content-Type', 'application/json')], b'{}', 'OK')
+        assert resp.getheader('content-type') == 'application/json'
+        assert resp.getheader('CONTENT-TYPE') == 'application/json'
+        assert resp.getheader('retry-after', 'x') == 'x'
+        assert resp.read() == b'{}'
+
+
+class TestHTTPClientTransport(unittest.TestCase):
+    def setUp(self):
+        server.clean()
+        self.opened = []
+
+        def factory(scheme, host, timeout):
+            self.opened.append((scheme, host, timeout))
+            return MockConnect(host, timeout=timeout)
+
+        self.transport = HTTPClientTransport(connection_factory=factory)
+
+    def test_request(self):
+        resp = self.transport.request('GET', 'https://api.appoptics.com/v1/metrics', timeout=5)
+        assert resp.status == 200
+        assert resp.read() == server.list_of_metrics()
+        assert self.opened == [('https', 'api.appoptics.com', 5)]
+        # Back in the pool for the next request
+        self.transport.request('GET', 'https://api.appoptics.com/v1/metrics')
+        assert len(self.opened) == 1
+        assert self.transport.pool.num_idle(('https', 'api.appoptics.com')) == 1
+
+    def test_close(self):
+        self.transport.request('GET', 'https://api.appoptics.com/v1/metrics')
+        self.transport.close()
+        assert self.transport.pool.num_idle(('https', 'api.appoptics.com')) == 0
+
+    def test_is_the_default(self):
+        conn = appoptics_metrics.connect('key_test', pool_maxsize=3)
+        assert isinstance(conn.transport, HTTPClientTransport)
+        assert conn.pool is conn.transport.pool
+        assert conn.pool.maxsize == 3
+
+
+class TestCustomTransport(unittest.TestCase):
+    def setUp(self):
+        server.clean()
+
+    def test_connection_uses_transport(self):
+        mock = MockTransport()
+        conn = appoptics_metrics.connect('key_test', transport=mock, tags={'sky': 'blue'})
+        assert conn.pool is None
+        conn.submit('temperature', 1)
+        assert conn.list_metrics()[0].name == 'temperature'
+        assert [(method, url) for method, url, body, headers in mock.requests] == [
+            ('POST', 'https://api.appoptics.com/v1/measurements'),
+            ('GET', 'https://api.appoptics.com/v1/metrics')]
+
+    def test_transport_errors_are_retried(self):
+        class FlakyTransport(MockTransport):
+            calls = 0
+
+            def request(self, *args, **kwargs):
+                FlakyTransport.calls += 1
+                if FlakyTransport.calls == 1:
+                    raise socket.error(errno.ECONNREFUSED, 'Connection refused')
+                return MockTransport.request(self, *args, **kwargs)
+
+        conn = appoptics_metrics.connect('key_test', transport=FlakyTransport())
+        conn.retry_policy.backoff_base = 0
+        assert conn.list_metrics() == []
+        assert FlakyTransport.calls == 2
+
+    def test_base_transport(self):
+        with self.assertRaises(NotImplementedError):
+            Transport().request('GET', 'https://api.appoptics.com/v1/metrics')
+
+    @unittest.skipUnless(transport.urllib3 is None, "urllib3 is installed")
+    def test_urllib3_is_optional(self):
+        with self.assertRaises(ImportError):
+            transport.Urllib3Transport()
+
+    @unittest.skipUnless(transport.httpx is None, "httpx is installed")
+    def test_httpx_is_optional(self):
+        with self.assertRaises(ImportError):
+            transport.HttpxTransport()
+
+
+if __name__ == '__main__':
+    unittest.main()